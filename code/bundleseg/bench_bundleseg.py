@@ -0,0 +1,261 @@
+'''
+Benchmarks for the bundleseg helpers
+
+Usage:
+    python bench_bundleseg.py prefilter --tractogram WB.trk --config CONFIG.json --models_dir MODELS_DIR [--transfo XFM.mat] [--inverse]
+    python bench_bundleseg.py qbx_cache --tractogram WB.trk [--cache_dir DIR]
+    python bench_bundleseg.py chunked --tractogram WB.trk --config CONFIG.json --models_dir MODELS_DIR --transfo XFM.mat --chunk_size N
+'''
+
+# Standard library imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
+import os
+from os.path import join as ospj
+import resource
+import shutil
+import tempfile
+from time import perf_counter
+
+# Third-party imports
+import numpy as np
+
+# DIPY imports
+from dipy.io.streamline import load_trk
+from dipy.segment.bundles import RecoBundles, qbx_and_merge
+from dipy.tracking.streamline import transform_streamlines
+
+# Local imports
+from bundleseg_stream import run_bundleseg, run_bundleseg_chunked
+from qbx_cache import cached_qbx_and_merge
+from spatial_prefilter import get_candidates, get_model_paths, load_model_envelopes
+
+
+def recognize_bundles(streamlines, indices, models, config, seed=0):
+    """
+    Recognizes every model with dipy's RecoBundles among a subset of the streamlines.
+    Returns:
+        Dictionary mapping bundle -> sorted indices (into streamlines) of the recognized streamlines, and the
+        duration (s) including the whole-brain clustering
+    """
+    start = perf_counter()
+    rb = RecoBundles(streamlines[indices], clust_thr=15, rng=np.random.default_rng(seed), verbose=False)
+    recognized = {}
+    for bundle_file, model in models.items():
+        _, labels = rb.recognize(model_bundle=model, model_clust_thr=5, reduction_thr=10, pruning_thr=config[bundle_file])
+        recognized[bundle_file] = np.sort(indices[np.asarray(labels, dtype=np.intp)])
+    return recognized, perf_counter() - start
+
+
+def recognize_bundles_per_model(streamlines, candidates, models, config, seed=0):
+    """
+    Recognizes every model with RecoBundles among its own candidate streamlines only.
+    Returns:
+        Dictionary mapping bundle -> sorted indices of the recognized streamlines, and the duration (s)
+    """
+    start = perf_counter()
+    recognized = {}
+    for bundle_file, model in models.items():
+        indices = np.flatnonzero(candidates[bundle_file])
+        rb = RecoBundles(streamlines[indices], clust_thr=15, rng=np.random.default_rng(seed), verbose=False)
+        _, labels = rb.recognize(model_bundle=model, model_clust_thr=5, reduction_thr=10, pruning_thr=config[bundle_file])
+        recognized[bundle_file] = np.sort(indices[np.asarray(labels, dtype=np.intp)])
+    return recognized, perf_counter() - start
+
+
+def bench_prefilter(args):
+    """
+    Bundles recognized per second by RecoBundles on the whole tractogram vs on the spatially pre-filtered one
+    (spatial_prefilter.py, the union of all model envelopes) and vs on each model's own candidates, and how many
+    streamlines recognized in the whole tractogram fall outside the envelopes.
+    """
+    config = json.load(open(args.config))
+    if args.transfo is None:
+        model_to_subject = np.eye(4)
+    else:
+        from scilpy.io.utils import load_matrix_in_any_format
+
+        model_to_subject = load_matrix_in_any_format(args.transfo)
+    if args.inverse:
+        model_to_subject = np.linalg.inv(model_to_subject)
+
+    start = perf_counter()
+    envelopes = load_model_envelopes(args.models_dir, config, registration_margin_mm=args.margin, cell_mm=args.cell_mm)
+    keep = get_candidates(args.tractogram, envelopes, model_to_subject)
+    prefilter_seconds = perf_counter() - start
+    print(f"Pre-filter: kept {keep.sum()} of {len(keep)} streamlines ({100 * keep.mean():.1f}%) in {prefilter_seconds:.2f} s")
+
+    # One model per bundle (the first atlas folder), moved into subject space as bundleseg does
+    streamlines = load_trk(args.tractogram, reference="same", bbox_valid_check=False).streamlines
+    models = {bundle_file: transform_streamlines(load_trk(model_paths[0], reference="same", bbox_valid_check=False).streamlines,
+                                                 model_to_subject)
+              for bundle_file, model_paths in get_model_paths(args.models_dir, config).items() if len(model_paths) > 0}
+
+    # Candidates of every model on its own (computed from the streamlines already in memory)
+    start = perf_counter()
+    subject_to_model = np.linalg.inv(model_to_subject)
+    points = streamlines.get_data() @ subject_to_model[:3, :3].T + subject_to_model[:3, 3]
+    lengths = np.asarray(streamlines._lengths)
+    candidates = {bundle_file: envelopes.candidates(points, lengths, label=bundle_file) for bundle_file in models}
+    candidates_seconds = perf_counter() - start
+
+    full, full_seconds = recognize_bundles(streamlines, np.arange(len(streamlines)), models, config, seed=args.seed)
+    filtered, filtered_seconds = recognize_bundles(streamlines, np.flatnonzero(keep), models, config, seed=args.seed)
+    per_model, per_model_seconds = recognize_bundles_per_model(streamlines, candidates, models, config, seed=args.seed)
+
+    # Recognition differs between runs whenever the whole-brain clustering differs; streamlines outside the
+    # envelopes are the only ones the pre-filter itself can lose
+    for bundle_file in models:
+        outside = np.count_nonzero(~candidates[bundle_file][full[bundle_file]])
+        print(f"{bundle_file}: {100 * candidates[bundle_file].mean():.1f}% candidates; recognized "
+              f"{full[bundle_file].size} (whole), {filtered[bundle_file].size} (pre-filtered), "
+              f"{per_model[bundle_file].size} (per model); whole-tractogram recognitions outside the envelope: {outside}")
+    n_models = len(models)
+    print(f"Whole tractogram: {full_seconds:.2f} s ({n_models / full_seconds:.2f} bundles/s)")
+    print(f"Pre-filtered: {filtered_seconds:.2f} s + {prefilter_seconds:.2f} s pre-filter "
+          f"({n_models / (filtered_seconds + prefilter_seconds):.2f} bundles/s, "
+          f"{full_seconds / (filtered_seconds + prefilter_seconds):.2f}x)")
+    print(f"Per-model candidates: {per_model_seconds:.2f} s + {prefilter_seconds + candidates_seconds:.2f} s pre-filter "
+          f"({n_models / (per_model_seconds + prefilter_seconds + candidates_seconds):.2f} bundles/s, "
+          f"{full_seconds / (per_model_seconds + prefilter_seconds + candidates_seconds):.2f}x)")
+
+
+def bench_qbx_cache(args):
+    """
+    Duration of the whole-brain QuickBundlesX clustering of bundleseg computed, then reused from the on-disk cache
+    (qbx_cache.py), and whether the reused clusters and random generator state match a fresh clustering.
+    """
+    streamlines = load_trk(args.tractogram, reference="same", bbox_valid_check=False).streamlines
+    thresholds = [40, 30, 20, args.clust_thr]
+    cache_dir = tempfile.mkdtemp(prefix="qbx_cache_") if args.cache_dir is None else args.cache_dir
+    cached = cached_qbx_and_merge(cache_dir)
+    try:
+        durations = []
+        for f in [qbx_and_merge, cached, cached]:
+            rng = np.random.RandomState(args.seed)
+            start = perf_counter()
+            clusters = f(streamlines, thresholds, nb_pts=12, rng=rng)
+            durations.append(perf_counter() - start)
+            if f is qbx_and_merge:
+                reference, reference_draw = clusters, rng.random_sample(8)
+        identical = (len(clusters) == len(reference)
+                     and all(np.array_equal(a.indices, b.indices) and np.allclose(a.centroid, b.centroid)
+                             for a, b in zip(clusters, reference))
+                     and np.array_equal(rng.random_sample(8), reference_draw))
+        print(f"{len(reference)} clusters of {len(streamlines)} streamlines; cached clusters and generator state identical: {identical}")
+        print(f"Clustering: {durations[0]:.2f} s; first cached call: {durations[1]:.2f} s; "
+              f"reused: {durations[2]:.2f} s ({durations[0] / durations[2]:.1f}x)")
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def timed_bundleseg(in_tractogram, out_dir, bundleseg_args, chunk_size=None):
+    """
+    Runs bundleseg on the whole tractogram or in chunks (see bundleseg_stream.py), in a process of its own.
+    Returns:
+        Duration (s) and peak resident memory (MB) of the process and of its largest voting process
+    """
+    start = perf_counter()
+    if chunk_size is None:
+        run_bundleseg(in_tractogram, out_dir, bundleseg_args)
+    else:
+        run_bundleseg_chunked(in_tractogram, out_dir, bundleseg_args, chunk_size, work_dir=os.path.dirname(out_dir))
+    return (perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def get_streamline_keys(trk_path):
+    """
+    Identifies every streamline of a .trk file by a hash of its points.
+    """
+    streamlines = load_trk(trk_path, reference="same", bbox_valid_check=False).streamlines
+    return {hashlib.sha1(np.asarray(streamline, dtype=np.float32).tobytes()).hexdigest() for streamline in streamlines}
+
+
+def compare_bundles(dir_a, dir_b):
+    """
+    Per-bundle overlap (Dice of the recognized streamlines) between two bundleseg output directories.
+    Returns:
+        Dictionary mapping bundle -> (n_a, n_b, n_shared, dice)
+    """
+    bundle_files = sorted({f for d in [dir_a, dir_b] for f in os.listdir(d) if f.endswith(".trk")})
+    overlap = {}
+    for bundle_file in bundle_files:
+        a, b = [get_streamline_keys(ospj(d, bundle_file)) if os.path.exists(ospj(d, bundle_file)) else set()
+                for d in [dir_a, dir_b]]
+        n_shared = len(a & b)
+        overlap[bundle_file] = (len(a), len(b), n_shared, 2 * n_shared / max(len(a) + len(b), 1))
+    return overlap
+
+
+def bench_chunked(args):
+    """
+    Bundles recognized by bundleseg on the whole tractogram and in chunks (bundleseg_stream.py), with the per-bundle
+    overlap of the chunked run and of a second whole run with the whole run (bundleseg's voting is not exactly
+    reproducible between runs, which bounds the overlap any chunk size can reach), and the duration and peak memory
+    of each run.
+    """
+    bundleseg_args = [args.config, args.models_dir, args.transfo, "--processes", str(args.processes)]
+    if args.inverse:
+        bundleseg_args.append("--inverse")
+    work_dir = tempfile.mkdtemp(prefix="bench_chunked_")
+    runs = {"whole": None, "whole (rerun)": None, f"chunks of {args.chunk_size}": args.chunk_size}
+    try:
+        stats = {}
+        for i, (run, chunk_size) in enumerate(runs.items()):
+            # A fresh process per run, so that peak memory is measured per run
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as executor:
+                stats[run] = executor.submit(timed_bundleseg, args.tractogram, ospj(work_dir, f"run-{i}"), bundleseg_args,
+                                             chunk_size).result()
+        for run, (seconds, self_mb, voting_mb) in stats.items():
+            print(f"{run}: {seconds:.1f} s, peak memory {self_mb:.0f} MB (largest voting process {voting_mb:.0f} MB)")
+        for i, run in enumerate(list(runs)[1:], start=1):
+            print(f"Overlap of {run} with whole:")
+            for bundle_file, (n_whole, n_run, n_shared, dice) in compare_bundles(ospj(work_dir, "run-0"), ospj(work_dir, f"run-{i}")).items():
+                print(f"  {bundle_file}: {n_whole} (whole), {n_run} ({run}), {n_shared} shared, Dice {dice:.4f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks for the bundleseg helpers.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("prefilter", help=bench_prefilter.__doc__.strip())
+    p.add_argument("--tractogram", required=True, help="Whole-brain .trk tractogram")
+    p.add_argument("--config", required=True, help="bundleseg config (.json)")
+    p.add_argument("--models_dir", required=True, help="Parent folder of the atlas model folders")
+    p.add_argument("--transfo", default=None, help="bundleseg transform (default: identity)")
+    p.add_argument("--inverse", action="store_true", help="Invert the transform, as bundleseg's --inverse")
+    p.add_argument("--margin", type=float, default=10.0, help="Registration margin of the envelopes (mm)")
+    p.add_argument("--cell_mm", type=float, default=4.0, help="Grid cell size (mm)")
+    p.add_argument("--seed", type=int, default=0, help="Random seed of the clustering")
+    p.set_defaults(func=bench_prefilter)
+
+    p = subparsers.add_parser("qbx_cache", help=bench_qbx_cache.__doc__.strip())
+    p.add_argument("--tractogram", required=True, help="Whole-brain .trk tractogram")
+    p.add_argument("--cache_dir", default=None, help="Cache directory (default: a temporary directory, removed afterwards)")
+    p.add_argument("--clust_thr", type=float, default=15, help="Finest clustering threshold (mm)")
+    p.add_argument("--seed", type=int, default=0, help="Random seed of the clustering")
+    p.set_defaults(func=bench_qbx_cache)
+
+    p = subparsers.add_parser("chunked", help=bench_chunked.__doc__.strip())
+    p.add_argument("--tractogram", required=True, help="Whole-brain .trk tractogram")
+    p.add_argument("--config", required=True, help="bundleseg config (.json)")
+    p.add_argument("--models_dir", required=True, help="Parent folder of the atlas model folders")
+    p.add_argument("--transfo", required=True, help="bundleseg transform")
+    p.add_argument("--inverse", action="store_true", help="Invert the transform, as bundleseg's --inverse")
+    p.add_argument("--chunk_size", type=int, required=True, help="Number of streamlines per chunk")
+    p.add_argument("--processes", type=int, default=8, help="Number of bundleseg voting processes")
+    p.set_defaults(func=bench_chunked)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,194 @@
+'''
+Streaming bundleseg for whole-brain tractograms too large to hold in memory. The .trk file is split into
+consecutive chunks of a fixed number of streamlines, bundleseg recognizes and votes on each chunk against the
+atlas models, and the recognized bundles of every chunk are concatenated. The memory of bundleseg itself (the
+tractogram, its clustering and the buffers of the voting processes) is then bounded by the chunk size rather than
+by the seed count of the tractography. The bundles are concatenated by copying their streamline records, and
+run_bundleseg.py builds their density maps one bundle at a time, so after bundleseg memory is bounded by the
+largest bundle, which grows with the seed count.
+
+Chunks and bundles are split and concatenated without decoding or rounding points, and only one chunk is on disk
+at a time. Every streamline is voted on by the same models as in a whole-tractogram run, but everything bundleseg
+derives from the tractogram is computed per chunk: the whole-brain QuickBundlesX clustering, the neighbourhood of
+each model shortlisted from it, and the local SLR of each model to that neighbourhood, before pruning. A chunked
+run is therefore a different segmentation, not a partition of the whole one: streamlines near the pruning
+threshold, and bundles whose local registration is fitted to a sparse chunk, can be recognized differently.
+bench_bundleseg.py chunked compares the per-bundle overlap of a chunked and a whole run with that of two whole runs
+(bundleseg's voting is not exactly reproducible between runs); use the largest chunks that fit in memory and check
+that overlap on one subject before chunking a cohort
+'''
+
+# Standard library imports
+import logging
+import os
+from os.path import join as ospj
+import shutil
+import sys
+import tempfile
+
+# Third-party imports
+import numpy as np
+from nibabel.streamlines.trk import header_2_dtype
+
+TRK_HEADER_SIZE = header_2_dtype.itemsize
+NB_STREAMLINES_OFFSET = header_2_dtype.fields["nb_streamlines"][1]
+
+
+def read_trk_header(f):
+    """
+    Reads the header of an open .trk file.
+    Returns:
+        Raw header bytes and the parsed header (a structured array with the byte order of the file)
+    """
+    raw = f.read(TRK_HEADER_SIZE)
+    header = np.frombuffer(raw, dtype=header_2_dtype)
+    if header["hdr_size"][0] != TRK_HEADER_SIZE:
+        header = np.frombuffer(raw, dtype=header_2_dtype.newbyteorder())
+        if header["hdr_size"][0] != TRK_HEADER_SIZE:
+            raise ValueError(f"{getattr(f, 'name', f)} is not a .trk file")
+    return raw, header
+
+
+def iter_trk_records(f, header):
+    """
+    Yields the raw bytes of every streamline record (point count, points and scalars, properties) of an open .trk
+    file positioned after its header.
+    """
+    count_dtype = header.dtype["nb_streamlines"]
+    n_values_per_point = 3 + int(header["nb_scalars_per_point"][0])
+    n_properties = int(header["nb_properties_per_streamline"][0])
+    while True:
+        count = f.read(4)
+        if len(count) < 4:
+            return
+        n_points = int(np.frombuffer(count, dtype=count_dtype)[0])
+        yield count + f.read(4 * (n_points * n_values_per_point + n_properties))
+
+
+def set_trk_count(f, header, n_streamlines):
+    """
+    Writes the streamline count into the header of a .trk file open for writing.
+    """
+    f.seek(NB_STREAMLINES_OFFSET)
+    f.write(np.array(n_streamlines, dtype=header.dtype["nb_streamlines"]).tobytes())
+
+
+def iter_trk_chunks(trk_path, out_dir, chunk_size):
+    """
+    Splits a .trk file into .trk files of at most chunk_size streamlines, one at a time: each chunk is written when
+    the previous one has been consumed, so the caller can process and delete it before the next is read.
+    Args:
+        trk_path: input .trk file
+        out_dir: directory of the chunk files
+        chunk_size: number of streamlines per chunk
+    Yields:
+        Path of each chunk file
+    """
+    with open(trk_path, "rb") as f:
+        raw_header, header = read_trk_header(f)
+        records = iter_trk_records(f, header)
+        for i in range(sys.maxsize):
+            chunk_path = ospj(out_dir, f"chunk-{i:04d}.trk")
+            n_streamlines = 0
+            with open(chunk_path, "wb") as out:
+                out.write(raw_header)
+                for record in records:
+                    out.write(record)
+                    n_streamlines += 1
+                    if n_streamlines == chunk_size:
+                        break
+                set_trk_count(out, header, n_streamlines)
+            if n_streamlines == 0:
+                os.remove(chunk_path)
+                return
+            yield chunk_path
+            if n_streamlines < chunk_size:
+                return
+
+
+def concatenate_trks(trk_paths, out_path):
+    """
+    Concatenates .trk files with the same header (e.g. the same bundle recognized in several chunks) by copying
+    their streamline records.
+    """
+    tmp_path = f"{out_path}.tmp"
+    n_streamlines = 0
+    with open(tmp_path, "wb") as out:
+        for i, trk_path in enumerate(trk_paths):
+            with open(trk_path, "rb") as f:
+                raw_header, header = read_trk_header(f)
+                if i == 0:
+                    first_header = raw_header
+                    out.write(raw_header)
+                elif (raw_header[:NB_STREAMLINES_OFFSET] != first_header[:NB_STREAMLINES_OFFSET]
+                      or raw_header[NB_STREAMLINES_OFFSET + 4:] != first_header[NB_STREAMLINES_OFFSET + 4:]):
+                    raise ValueError(f"{trk_path} does not have the same header as {trk_paths[0]}")
+                for record in iter_trk_records(f, header):
+                    out.write(record)
+                    n_streamlines += 1
+        set_trk_count(out, header, n_streamlines)
+    os.replace(tmp_path, out_path)
+
+
+def run_bundleseg(in_tractogram, out_dir, bundleseg_args):
+    """
+    Runs scil_tractogram_segment_with_bundleseg.py on one tractogram.
+    Args:
+        in_tractogram: whole-brain tractogram
+        out_dir: output directory (emptied first)
+        bundleseg_args: the script's other arguments (config file, models directory, transform and options)
+    """
+    from scil_tractogram_segment_with_bundleseg import main as bundleseg_main
+
+    argv = sys.argv
+    sys.argv = ["scil_tractogram_segment_with_bundleseg.py", in_tractogram] + list(bundleseg_args) + ["--out_dir", out_dir, "-f"]
+    try:
+        bundleseg_main()
+    finally:
+        sys.argv = argv
+        # main() adds a log file handler for its output directory on every call
+        logger = logging.getLogger("BundleSeg")
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                handler.close()
+                logger.removeHandler(handler)
+
+
+def run_bundleseg_chunked(in_tractogram, out_dir, bundleseg_args, chunk_size, work_dir=None):
+    """
+    Runs bundleseg on consecutive chunks of a .trk tractogram and concatenates the bundles recognized in every
+    chunk into out_dir (with the log of every chunk appended to out_dir/logfile.txt).
+    Args:
+        in_tractogram: whole-brain .trk tractogram
+        out_dir: output directory of the bundles (emptied first, as run_bundleseg does)
+        bundleseg_args: the script's other arguments (see run_bundleseg)
+        chunk_size: number of streamlines per chunk
+        work_dir: parent directory of the chunk files and per-chunk outputs (default: next to out_dir); they are
+                  removed afterwards
+    """
+    if work_dir is None:
+        work_dir = os.path.dirname(os.path.abspath(out_dir))
+    work_dir = tempfile.mkdtemp(prefix="bundleseg_chunks_", dir=work_dir)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    try:
+        chunk_out_dirs = []
+        for chunk_path in iter_trk_chunks(in_tractogram, work_dir, chunk_size):
+            chunk_out_dir = chunk_path.replace(".trk", "_bundles")
+            print(f"Bundleseg on {os.path.basename(chunk_path)} of {in_tractogram}")
+            run_bundleseg(chunk_path, chunk_out_dir, bundleseg_args)
+            os.remove(chunk_path)
+            chunk_out_dirs.append(chunk_out_dir)
+
+        bundle_files = sorted({bundle_file for chunk_out_dir in chunk_out_dirs
+                               for bundle_file in os.listdir(chunk_out_dir) if bundle_file.endswith(".trk")})
+        for bundle_file in bundle_files:
+            concatenate_trks([ospj(chunk_out_dir, bundle_file) for chunk_out_dir in chunk_out_dirs
+                              if os.path.exists(ospj(chunk_out_dir, bundle_file))],
+                             ospj(out_dir, bundle_file))
+        with open(ospj(out_dir, "logfile.txt"), "a") as log:
+            for chunk_out_dir in chunk_out_dirs:
+                if os.path.exists(ospj(chunk_out_dir, "logfile.txt")):
+                    log.write(open(ospj(chunk_out_dir, "logfile.txt")).read())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
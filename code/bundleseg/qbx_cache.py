@@ -0,0 +1,168 @@
+'''
+On-disk cache of the whole-brain QuickBundlesX clustering that bundleseg computes before recognizing any bundle.
+scilpy's VotingScheme clusters the subject tractogram once per run with qbx_and_merge and shares the clusters with
+every bundle and atlas vote. Reruns of the same subject, e.g. with new config_*.json thresholds or with
+--modify_distance_thr explorations, recompute the same clustering. Within a run, qbx_cache() replaces the
+qbx_and_merge used by scilpy.segment.voting_scheme with cached_qbx_and_merge, which stores the clusters under a key
+made of a hash of the exact streamlines clustered (so any change of tractogram or of the transform applied to it
+gives a new key) and the clustering parameters, including the random generator state. The generator is left in
+the state the clustering would have left it in, so a cached run draws the same random numbers as an uncached one.
+Entries are never evicted, so the cache is opt-in (run_bundleseg.py --qbx_cache) and is meant for subjects that are
+rerun on the same streamlines; entries of chunks or pre-filtered tractograms are only reused by runs with the same
+--chunk_size or --prefilter, and any entry can be deleted at any time
+
+Example:
+    with qbx_cache(cache_dir):
+        bundleseg_main()
+'''
+
+# Standard library imports
+from contextlib import contextmanager
+import hashlib
+import inspect
+import json
+import os
+from os.path import join as ospj
+
+# Third-party imports
+import numpy as np
+
+
+def hash_streamlines(streamlines):
+    """
+    Content hash of the points and offsets of an ArraySequence (or a list of streamlines).
+    """
+    from nibabel.streamlines import ArraySequence
+
+    if not isinstance(streamlines, ArraySequence):
+        streamlines = ArraySequence(streamlines)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(streamlines._lengths, dtype=np.int64).tobytes())
+    data = streamlines._data
+    if streamlines.is_sliced_view:
+        data = streamlines.copy()._data
+    digest.update(str(data.dtype).encode())
+    digest.update(memoryview(np.ascontiguousarray(data)).cast("B"))
+    return digest.hexdigest()
+
+
+def get_rng_state(rng):
+    """
+    JSON-serializable state of a np.random.RandomState or np.random.Generator (None if rng is None).
+    """
+    if rng is None:
+        return None
+    if isinstance(rng, np.random.RandomState):
+        name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+        return {"type": "RandomState", "state": [name, keys.tolist(), pos, has_gauss, cached_gaussian]}
+    return {"type": "Generator", "state": rng.bit_generator.state}
+
+
+def set_rng_state(rng, state):
+    if state is None:
+        return
+    if state["type"] == "RandomState":
+        name, keys, pos, has_gauss, cached_gaussian = state["state"]
+        rng.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    else:
+        rng.bit_generator.state = state["state"]
+
+
+def get_cache_key(streamlines, parameters, rng):
+    """
+    Key of a clustering: streamline content hash, then a hash of the parameters and random generator state.
+    """
+    parameters = dict(parameters, rng=get_rng_state(rng))
+    parameter_hash = hashlib.blake2b(json.dumps(parameters, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+    return f"{hash_streamlines(streamlines)}_{parameter_hash}"
+
+
+def save_cluster_map(path, cluster_map, rng_state):
+    """
+    Writes the centroids and member indices of a ClusterMapCentroid, and the generator state after clustering
+    (atomically, so readers never see a partial file). Indices are stored as uint32, as scilpy keeps them after
+    clustering.
+    """
+    clusters = list(cluster_map)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path,
+             centroids=np.asarray([cluster.centroid for cluster in clusters], dtype=np.float32),
+             sizes=np.asarray([len(cluster.indices) for cluster in clusters], dtype=np.int64),
+             indices=np.concatenate([np.asarray(cluster.indices, dtype=np.uint32) for cluster in clusters]) if clusters
+             else np.zeros(0, dtype=np.uint32),
+             rng_state=json.dumps(rng_state))
+    os.replace(tmp_path, path)
+
+
+def load_cluster_map(path, streamlines):
+    """
+    Reads a cluster map written by save_cluster_map.
+    Returns:
+        ClusterMapCentroid referring to streamlines, and the generator state after clustering
+    """
+    from dipy.segment.clustering import ClusterCentroid, ClusterMapCentroid
+
+    with np.load(path) as npz:
+        centroids, sizes, indices = npz["centroids"], npz["sizes"], npz["indices"]
+        rng_state = json.loads(str(npz["rng_state"]))
+    cluster_map = ClusterMapCentroid()
+    for centroid, cluster_indices in zip(centroids, np.split(indices, np.cumsum(sizes)[:-1])):
+        cluster_map.add_cluster(ClusterCentroid(centroid=centroid, indices=cluster_indices.tolist()))
+    cluster_map.refdata = streamlines
+    return cluster_map, rng_state
+
+
+def cached_qbx_and_merge(cache_dir, qbx_and_merge=None):
+    """
+    Wraps qbx_and_merge (dipy.segment.bundles) with an on-disk cache in cache_dir.
+    Returns:
+        Function with the signature of qbx_and_merge
+    """
+    if qbx_and_merge is None:
+        from dipy.segment.bundles import qbx_and_merge
+
+    signature = inspect.signature(qbx_and_merge)
+
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        parameters = {name: value for name, value in bound.arguments.items() if name not in ["streamlines", "rng", "verbose"]}
+        streamlines, rng = bound.arguments["streamlines"], bound.arguments.get("rng")
+
+        # Without a seeded generator the clustering is not reproducible, so there is nothing to reuse
+        if rng is None:
+            return qbx_and_merge(*args, **kwargs)
+
+        cache_path = ospj(cache_dir, f"qbx_{get_cache_key(streamlines, parameters, rng)}.npz")
+        if os.path.exists(cache_path):
+            print(f"Reusing the whole-brain clustering in {cache_path}")
+            cluster_map, rng_state = load_cluster_map(cache_path, streamlines)
+            set_rng_state(rng, rng_state)
+            return cluster_map
+
+        cluster_map = qbx_and_merge(*args, **kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        save_cluster_map(cache_path, cluster_map, get_rng_state(rng))
+        return cluster_map
+
+    return wrapper
+
+
+@contextmanager
+def qbx_cache(cache_dir):
+    """
+    Makes scilpy's VotingScheme reuse cached whole-brain clusterings (see cached_qbx_and_merge) within the block.
+    """
+    from scilpy.segment import voting_scheme
+
+    if not hasattr(voting_scheme, "qbx_and_merge"):
+        print("scilpy.segment.voting_scheme does not use qbx_and_merge; the whole-brain clustering is not cached")
+        yield
+        return
+
+    original = voting_scheme.qbx_and_merge
+    voting_scheme.qbx_and_merge = cached_qbx_and_merge(cache_dir, original)
+    try:
+        yield
+    finally:
+        voting_scheme.qbx_and_merge = original
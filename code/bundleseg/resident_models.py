@@ -0,0 +1,63 @@
+'''
+Keeps the atlas model bundles of bundleseg resident in memory across subjects. scilpy's VotingScheme reads every
+model .trk file again for every subject (in single_recognize, through nibabel.streamlines.load), so a batch of
+subjects reads and decodes the same HCP1065 models once per subject and atlas vote. resident_models() loads them
+once and serves them to nibabel.streamlines.load for the duration of the block. Processes forked inside the block
+(the subject workers and their voting pools) inherit the loaded models, and their point buffers stay shared
+copy-on-write pages since bundleseg only reads them
+
+Example:
+    with resident_models(model_paths):
+        for group, sub in subjects:
+            segment_subject(group, sub)
+'''
+
+# Standard library imports
+from contextlib import contextmanager
+import os
+from time import perf_counter
+
+# Third-party imports
+import nibabel as nib
+
+
+class ResidentModels:
+    """
+    Model tractograms loaded once and served to later loads of the same paths.
+    Args:
+        model_paths: paths of the model .trk files
+    """
+
+    def __init__(self, model_paths):
+        self.load_file = nib.streamlines.load
+        start = perf_counter()
+        self.models = {os.path.abspath(path): self.load_file(path) for path in model_paths}
+        self.load_seconds = perf_counter() - start
+        self.n_streamlines = sum(len(model.streamlines) for model in self.models.values())
+
+    def load(self, fileobj, lazy_load=False):
+        """
+        Drop-in replacement of nibabel.streamlines.load: resident models are returned as loaded, any other file is
+        loaded from disk.
+        """
+        if not lazy_load and isinstance(fileobj, (str, os.PathLike)):
+            model = self.models.get(os.path.abspath(fileobj))
+            if model is not None:
+                return model
+        return self.load_file(fileobj, lazy_load=lazy_load)
+
+
+@contextmanager
+def resident_models(model_paths):
+    """
+    Loads the model bundles once and makes nibabel.streamlines.load return them within the block.
+    Yields:
+        The ResidentModels
+    """
+    models = ResidentModels(model_paths)
+    print(f"Loaded {len(models.models)} model bundles ({models.n_streamlines} streamlines) in {models.load_seconds:.2f} s")
+    nib.streamlines.load = models.load
+    try:
+        yield models
+    finally:
+        nib.streamlines.load = models.load_file
@@ -1,8 +1,10 @@
+import argparse
+from contextlib import nullcontext
 import sys
 import os
-from scil_tractogram_segment_with_bundleseg import main as bundleseg_main
+import shutil
+import tempfile
 from datetime import datetime
-from dipy.tracking.utils import density_map
 from dipy.io.streamline import load_trk, save_trk
 from dipy.io.stateful_tractogram import Space, StatefulTractogram
 from dipy.io.utils import create_nifti_header, get_reference_info
@@ -10,67 +12,153 @@ import nibabel as nib
 import numpy as np
 from os.path import join as ospj
 
+# Density maps are shared with the pyafq pipeline
+sys.path.insert(0, ospj(os.path.dirname(os.path.abspath(__file__)), "..", "pyafq"))
+from density import DensityMaps
+from bundleseg_stream import run_bundleseg, run_bundleseg_chunked
+from qbx_cache import qbx_cache
+from spatial_prefilter import prefilter_tractogram
+
 import warnings
 warnings.filterwarnings("ignore")
 
-group = sys.argv[1]
-sub = sys.argv[2]
-
-# Load in inputs for bundleseg
-in_tractograms = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/trekker/{group}/{sub}/{sub}_space-ACPC_desc-preproc_trekker.trk"
+# bundleseg config and atlas models (the same for every subject)
 in_config_file = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/code/bundleseg/config/config_HCP1065_association_projection.json"
 in_directory = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/atlases/HCP1065/association_projection_bundleseg"
-if group in ["penn_epilepsy", "penn_controls", "hcpaging"]:
-    in_transfo = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/acpc_mni_xfm/{group}/{sub}/{sub}_from-ACPC_to-MNI152NLin2009cAsym_AffineTransform.mat"
-elif group == "hcpya":
-    in_transfo = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/acpc_mni_xfm/{group}/{sub}/{sub}_from-T1w_to-MNI152NLin2009cAsym_AffineTransform.mat"
-
-out_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg/{group}/{sub}"
-if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
-
-# Define directories for anatomical reference
-qsiprep_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsiprep/{group}"
-hcp_raw_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/hcpya/hcp1200/HCP1200"
-
-# The bundleseg script expects: script_name, tractograms, config_file, directory, transfo, [optional args]
-sys.argv = [
-    "scil_tractogram_segment_with_bundleseg.py",
-    in_tractograms,
-    in_config_file,
-    in_directory,
-    in_transfo,
-    "--out_dir", out_dir,
-    "-f",
-    "--processes", "8"
-    ]
-
-
-print(f"Bundleseg started at {group} {sub} at {datetime.now()}")
-bundleseg_main()
-print(f"Bundleseg finished at {datetime.now()}\n")
-
-# Iterate over .trk files in out_dir
-print("Saving .trk files as .nii.gz files in ACPC space")
-for trk_file in os.listdir(out_dir):
-    if trk_file.endswith(".trk"):
-
-        # Get T1w as anatomical reference
-        if group in ["penn_epilepsy", "penn_controls", "hcpaging"]:
-            t1w = nib.load(ospj(qsiprep_dir, sub, "anat", f"{sub}_space-ACPC_desc-preproc_T1w.nii.gz"))
-        elif group == "hcpya":
-            hcp_sub = sub.replace("sub-", "")
-            t1w = nib.load(ospj(hcp_raw_dir, hcp_sub, "T1w", "T1w_acpc_dc_restore.nii.gz"))
-        acpc_affine, acpc_dimensions, acpc_voxel_sizes, acpc_voxel_order = get_reference_info(t1w)
-        acpc_nifti_header = create_nifti_header(acpc_affine, acpc_dimensions, acpc_voxel_sizes)
-    
-        # Load in .trk file
-        trk = load_trk(ospj(out_dir, trk_file), reference=t1w)
-        
-        # Save segmented streamlines as .nii.gz files in ACPC space
-        trk.to_vox()
-        trk.to_corner()
-        segmented_acpc_density = density_map(trk.streamlines, np.eye(4), acpc_dimensions)
-        nib.save(nib.Nifti1Image(segmented_acpc_density, acpc_affine, acpc_nifti_header), ospj(out_dir, trk_file.replace(".trk", ".nii.gz")))
-
-        print(f"-- Saved {trk_file.replace('.trk', '.nii.gz')}")
\ No newline at end of file
+
+
+def get_bundleseg_inputs(group, sub):
+    """
+    Paths of a subject's bundleseg inputs and outputs.
+    Returns:
+        Whole-brain tractogram, ACPC -> MNI transform, output directory and whole-brain clustering cache directory
+    """
+    in_tractograms = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/trekker/{group}/{sub}/{sub}_space-ACPC_desc-preproc_trekker.trk"
+    if group in ["penn_epilepsy", "penn_controls", "hcpaging"]:
+        in_transfo = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/acpc_mni_xfm/{group}/{sub}/{sub}_from-ACPC_to-MNI152NLin2009cAsym_AffineTransform.mat"
+    elif group == "hcpya":
+        in_transfo = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/acpc_mni_xfm/{group}/{sub}/{sub}_from-T1w_to-MNI152NLin2009cAsym_AffineTransform.mat"
+    out_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg/{group}/{sub}"
+    # Whole-brain clusterings are kept outside out_dir, which bundleseg empties on every run
+    qbx_cache_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg_qbx_cache/{group}/{sub}"
+    return in_tractograms, in_transfo, out_dir, qbx_cache_dir
+
+
+def get_t1w(group, sub):
+    """
+    Loads a subject's T1w image in ACPC space, the anatomical reference of the bundles.
+    """
+    qsiprep_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsiprep/{group}"
+    hcp_raw_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/hcpya/hcp1200/HCP1200"
+    if group in ["penn_epilepsy", "penn_controls", "hcpaging"]:
+        return nib.load(ospj(qsiprep_dir, sub, "anat", f"{sub}_space-ACPC_desc-preproc_T1w.nii.gz"))
+    elif group == "hcpya":
+        hcp_sub = sub.replace("sub-", "")
+        return nib.load(ospj(hcp_raw_dir, hcp_sub, "T1w", "T1w_acpc_dc_restore.nii.gz"))
+
+
+def save_bundle_niftis(group, sub, out_dir):
+    """
+    Saves every bundle .trk file in out_dir as a density map (.nii.gz) in ACPC space.
+    """
+    # Get T1w as anatomical reference
+    t1w = get_t1w(group, sub)
+    acpc_affine, acpc_dimensions, acpc_voxel_sizes, acpc_voxel_order = get_reference_info(t1w)
+    acpc_nifti_header = create_nifti_header(acpc_affine, acpc_dimensions, acpc_voxel_sizes)
+
+    # Load in each .trk file in out_dir in voxel (corner) space and save its density map in ACPC space, one bundle at
+    # a time so that memory is bounded by the largest bundle
+    print("Saving .trk files as .nii.gz files in ACPC space")
+    for trk_file in sorted(os.listdir(out_dir)):
+        if trk_file.endswith(".trk"):
+            trk = load_trk(ospj(out_dir, trk_file), reference=t1w)
+            trk.to_vox()
+            trk.to_corner()
+            bundle_density = DensityMaps({trk_file: trk.streamlines}, np.eye(4), acpc_dimensions)
+            bundle_density.save_niftis({trk_file: ospj(out_dir, trk_file.replace(".trk", ".nii.gz"))}, acpc_affine, acpc_nifti_header)
+            del trk, bundle_density
+            print(f"-- Saved {trk_file.replace('.trk', '.nii.gz')}")
+
+
+def segment_subject(group, sub, chunk_size=None, prefilter=False, use_qbx_cache=False, processes=8):
+    """
+    Segments a subject's trekker tractogram into HCP1065 bundles with bundleseg and saves their density maps.
+    Args:
+        group, sub: subject group and label
+        chunk_size: stream the tractogram through bundleseg in chunks of this many streamlines (default: whole)
+        prefilter: only pass bundleseg the streamlines that come near some atlas model
+        use_qbx_cache: cache the whole-brain clustering, and reuse the one cached by a previous run on the same
+                       streamlines (see qbx_cache.py)
+        processes: number of bundleseg voting processes
+    """
+    in_tractograms, in_transfo, out_dir, qbx_cache_dir = get_bundleseg_inputs(group, sub)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    # The bundleseg script expects: tractograms, config_file, directory, transfo, [optional args]
+    bundleseg_args = [
+        in_config_file,
+        in_directory,
+        in_transfo,
+        # RAM does not grow with --processes by the size of the tractogram: scilpy's VotingScheme clusters the
+        # streamlines, writes them once to a float16 memmap (streamlines_to_memmap) and frees them before forking the
+        # voting pool, and each worker reads back only its model's neighbours (reconstruct_streamlines_from_memmap)
+        # through the shared page cache. An extra process only adds its model, neighbours and the cluster centroids
+        # (peak PSS 346 MB with 1 process and 681 MB with 8 on a 52k-streamline tractogram), so moving the memmap to
+        # /dev/shm would share nothing more
+        "--processes", str(processes)
+        ]
+
+    print(f"Bundleseg started at {group} {sub} at {datetime.now()}")
+
+    # Drop the streamlines that no model can recognize before bundleseg loads the tractogram (the filtered copy is
+    # removed even if bundleseg fails)
+    prefilter_dir = None
+    try:
+        if prefilter:
+            prefilter_dir = tempfile.mkdtemp(prefix="bundleseg_prefilter_", dir=os.path.dirname(out_dir))
+            prefiltered_tractogram = ospj(prefilter_dir, os.path.basename(in_tractograms))
+            n_streamlines, n_kept = prefilter_tractogram(in_tractograms, prefiltered_tractogram, in_config_file, in_directory, in_transfo)
+            print(f"Pre-filter kept {n_kept} of {n_streamlines} streamlines at {datetime.now()}")
+            in_tractograms = prefiltered_tractogram
+
+        # With --qbx_cache, reruns on the same streamlines (e.g. with new config thresholds) reuse the cached whole-brain
+        # clustering
+        with (qbx_cache(qbx_cache_dir) if use_qbx_cache else nullcontext()):
+            if chunk_size is None:
+                run_bundleseg(in_tractograms, out_dir, bundleseg_args)
+            else:
+                run_bundleseg_chunked(in_tractograms, out_dir, bundleseg_args, chunk_size)
+    finally:
+        if prefilter_dir is not None:
+            shutil.rmtree(prefilter_dir, ignore_errors=True)
+    print(f"Bundleseg finished at {datetime.now()}\n")
+
+    save_bundle_niftis(group, sub, out_dir)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Segment a subject's trekker tractogram into HCP1065 bundles with bundleseg.")
+    parser.add_argument("group", help="Subject group")
+    parser.add_argument("sub", help="Subject label")
+    parser.add_argument("chunk_size", nargs="?", type=int, default=None,
+                        help="Stream the tractogram through bundleseg in chunks of this many streamlines, so the memory of "
+                             "bundleseg is bounded by the chunk size instead of the seed count; the segmentation is "
+                             "computed per chunk and can differ from a whole run (see bundleseg_stream.py)")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Only pass bundleseg the streamlines that come near some atlas model (see spatial_prefilter.py)")
+    parser.add_argument("--qbx_cache", action="store_true",
+                        help="Cache the whole-brain QuickBundlesX clustering, and reuse the one cached by a previous run "
+                             "on the same streamlines, e.g. when rerunning with new config thresholds (see qbx_cache.py; "
+                             "entries are never evicted)")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    segment_subject(args.group, args.sub, chunk_size=args.chunk_size, prefilter=args.prefilter,
+                    use_qbx_cache=args.qbx_cache)
+
+
+if __name__ == "__main__":
+    main()
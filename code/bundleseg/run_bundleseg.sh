@@ -2,7 +2,9 @@
 
 group=${1}
 sub=${2}
+# Optional: number of streamlines per bundleseg chunk (see bundleseg_stream.py), --prefilter and/or --qbx_cache
+extra_args=${@:3}
 
 source activate /mnt/sauce/littlab/users/mjaskir/software/miniconda3/envs/structural_tractometry
 
-python run_bundleseg.py ${group} ${sub}
\ No newline at end of file
+python run_bundleseg.py ${group} ${sub} ${extra_args}
\ No newline at end of file
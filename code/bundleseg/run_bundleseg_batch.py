@@ -0,0 +1,98 @@
+'''
+Segments a batch of subjects with bundleseg in a single Python process, with the atlas models and config loaded
+once. run_bundleseg.sh starts a fresh process per subject, and each one imports scilpy and dipy and reads every
+HCP1065 model bundle again (once per atlas vote). Here the models are loaded before the subject workers are
+forked (see resident_models.py), and subjects are streamed through a pool of --jobs workers. Each worker runs
+bundleseg with --processes voting processes, so a node runs jobs x processes processes. Outputs are written per
+subject exactly as run_bundleseg.py writes them. A failed subject is reported and the batch continues
+
+Usage:
+    python run_bundleseg_batch.py SUBJECTS.txt [--jobs 1] [--processes 8] [--chunk_size N] [--prefilter] [--qbx_cache]
+where SUBJECTS.txt lists one "group sub" pair per line
+'''
+
+# Standard library imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import json
+import multiprocessing
+from time import perf_counter
+
+# Local imports
+from resident_models import resident_models
+from run_bundleseg import in_config_file, in_directory, segment_subject
+from spatial_prefilter import get_model_paths
+
+
+def read_subjects(subjects_file):
+    """
+    Reads (group, sub) pairs, one whitespace-separated pair per line (blank lines and # comments are skipped).
+    """
+    subjects = []
+    for line in open(subjects_file):
+        line = line.split("#")[0].strip()
+        if line:
+            group, sub = line.split()
+            subjects.append((group, sub))
+    return subjects
+
+
+def timed_segment_subject(group, sub, **kwargs):
+    """
+    segment_subject, returning its duration (s).
+    """
+    start = perf_counter()
+    segment_subject(group, sub, **kwargs)
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment a batch of subjects with bundleseg, loading the atlas models once.")
+    parser.add_argument("subjects_file", help="Text file with one 'group sub' pair per line")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of subjects segmented at a time")
+    parser.add_argument("--processes", type=int, default=8, help="Number of bundleseg voting processes per subject")
+    parser.add_argument("--chunk_size", type=int, default=None, help="See run_bundleseg.py")
+    parser.add_argument("--prefilter", action="store_true", help="See run_bundleseg.py")
+    parser.add_argument("--qbx_cache", action="store_true", help="See run_bundleseg.py")
+    args = parser.parse_args()
+
+    subjects = read_subjects(args.subjects_file)
+    print(f"Bundleseg batch of {len(subjects)} subjects started at {datetime.now()}")
+    start = perf_counter()
+
+    # Models of every bundle in the config, across the atlas folders
+    config = json.load(open(in_config_file))
+    model_paths = [path for paths in get_model_paths(in_directory, config).values() for path in paths]
+
+    durations = {}
+    failed = []
+    with resident_models(model_paths) as models:
+        # Forked workers inherit the resident models
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {executor.submit(timed_segment_subject, group, sub, chunk_size=args.chunk_size,
+                                       prefilter=args.prefilter, use_qbx_cache=args.qbx_cache,
+                                       processes=args.processes): (group, sub)
+                       for group, sub in subjects}
+            for future in as_completed(futures):
+                group, sub = futures[future]
+                try:
+                    durations[(group, sub)] = future.result()
+                    print(f"-- {group} {sub} segmented in {durations[(group, sub)]:.1f} s ({len(durations)} of {len(subjects)})")
+                except Exception as e:
+                    failed.append((group, sub))
+                    print(f"-- {group} {sub} failed: {e!r}")
+
+    wall_seconds = perf_counter() - start
+    print(f"Bundleseg batch finished at {datetime.now()}")
+    print(f"{len(durations)} subjects segmented, {len(failed)} failed, in {wall_seconds:.1f} s "
+          f"(models loaded once in {models.load_seconds:.1f} s)")
+    if len(durations) > 0:
+        print(f"Per subject: {sum(durations.values()) / len(durations):.1f} s on average in a worker, "
+              f"{wall_seconds / len(durations):.1f} s amortized over the batch with {args.jobs} jobs")
+    for group, sub in failed:
+        print(f"Failed: {group} {sub}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+# Text file with one "group sub" pair per line
+subjects_file=${1}
+# Optional: --jobs, --processes, --chunk_size, --prefilter and/or --qbx_cache (see run_bundleseg_batch.py)
+extra_args=${@:2}
+
+source activate /mnt/sauce/littlab/users/mjaskir/software/miniconda3/envs/structural_tractometry
+
+python run_bundleseg_batch.py ${subjects_file} ${extra_args}
@@ -0,0 +1,213 @@
+'''
+Spatial pre-filter of a whole-brain tractogram before bundleseg. Most streamlines cannot belong to a given atlas
+model because they never come near it, yet bundleseg matches every model against the entire tractogram. A
+uniform grid over model space is built once per subject. Each model marks the cells within its pruning distance
+(plus a registration margin) of its streamlines, and the subject's streamlines are looked up in that grid.
+bundleseg then receives only the streamlines that enter the envelope of at least one model.
+
+The filter is conservative: a streamline recognized by a model has a mean point-to-point distance to some model
+streamline below the pruning threshold, so at least one of its points lies within that distance of the model.
+Model streamlines are densified before they are rasterized, so that the envelopes cover their whole polylines and
+not only their stored points (compressed models can have segments much longer than a grid cell), wherever
+pruning resamples them. The registration margin covers the local registration of the model to the subject that
+bundleseg performs before pruning
+
+Transforms are read with scilpy's own loader, as bundleseg reads them: the matrix passed to bundleseg (inverted
+with --inverse) moves model streamlines into subject space
+'''
+
+# Standard library imports
+import json
+import os
+from os.path import join as ospj
+
+# Third-party imports
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+# Local imports
+from bundleseg_stream import iter_trk_records, read_trk_header, set_trk_count
+
+
+def get_model_paths(models_directory, config):
+    """
+    Model .trk files of every bundle in the bundleseg config, across the atlas folders of the models directory.
+    Returns:
+        Dictionary mapping bundle file name (e.g. 'AF_L.trk') -> list of model paths
+    """
+    atlas_dirs = sorted(ospj(models_directory, d) for d in os.listdir(models_directory)
+                        if os.path.isdir(ospj(models_directory, d)))
+    return {bundle_file: [ospj(atlas_dir, bundle_file) for atlas_dir in atlas_dirs
+                          if os.path.exists(ospj(atlas_dir, bundle_file))]
+            for bundle_file in config}
+
+
+def densify_points(streamlines, max_spacing_mm):
+    """
+    Points of the streamlines with every segment subdivided so that consecutive points are at most max_spacing_mm
+    apart.
+    Args:
+        streamlines: ArraySequence (streamlines of at least one point)
+        max_spacing_mm: largest distance between consecutive points (mm)
+    Returns:
+        (N x 3) points, in no particular order
+    """
+    points = streamlines.get_data()
+    is_last = np.zeros(len(points), dtype=bool)
+    is_last[np.cumsum(streamlines._lengths) - 1] = True
+    starts = points[:-1][~is_last[:-1]]
+    steps = points[1:][~is_last[:-1]] - starts
+
+    # Segment i gets n_subdivisions[i] points, at fractions 0, 1/n, ..., (n-1)/n of its length
+    n_subdivisions = np.maximum(1, np.ceil(np.linalg.norm(steps, axis=1) / max_spacing_mm)).astype(np.intp)
+    segment = np.repeat(np.arange(len(starts)), n_subdivisions)
+    first = np.cumsum(n_subdivisions) - n_subdivisions
+    fractions = (np.arange(len(segment)) - first[segment]) / n_subdivisions[segment]
+    return np.concatenate([starts[segment] + fractions[:, None] * steps[segment], points[is_last]])
+
+
+class ModelEnvelopes:
+    """
+    Uniform grid over model space marking, for every model, the cells within its envelope distance of its points.
+    Args:
+        model_points: dictionary mapping model label -> (N x 3) points of its streamlines in model space (RAS mm)
+        distances_mm: dictionary mapping model label -> envelope distance (mm)
+        cell_mm: grid cell size (mm)
+    """
+
+    def __init__(self, model_points, distances_mm, cell_mm=4.0):
+        self.labels = list(model_points)
+        self.cell_mm = cell_mm
+        margin = max(distances_mm.values()) + 2 * cell_mm
+        all_points = np.concatenate([model_points[label] for label in self.labels])
+        self.origin = all_points.min(axis=0) - margin
+        self.shape = tuple(np.ceil((all_points.max(axis=0) + margin - self.origin) / cell_mm).astype(int) + 1)
+
+        # A point lies anywhere in its cell, so distances between cell centres are widened by a cell diagonal
+        self.envelopes = np.zeros((len(self.labels),) + self.shape, dtype=bool)
+        for i, label in enumerate(self.labels):
+            occupied = np.zeros(self.shape, dtype=bool)
+            occupied[tuple(self.get_cells(model_points[label]).T)] = True
+            distances = distance_transform_edt(~occupied, sampling=cell_mm)
+            self.envelopes[i] = distances <= distances_mm[label] + np.sqrt(3) * cell_mm
+        self.union = self.envelopes.any(axis=0)
+
+    def get_cells(self, points):
+        """
+        Grid cell of every point (points outside the grid are clipped to its border cells, which no envelope reaches).
+        """
+        cells = np.floor((points - self.origin) / self.cell_mm).astype(np.intp)
+        return np.clip(cells, 0, np.asarray(self.shape) - 1)
+
+    def candidates(self, points, lengths, label=None):
+        """
+        Which streamlines enter the envelope of a model, or of any model.
+        Args:
+            points: (n_points x 3) concatenated points of the streamlines in model space
+            lengths: number of points of each streamline (all > 0)
+            label: model label (default: any model)
+        Returns:
+            (n_streamlines,) boolean array
+        """
+        envelope = self.union if label is None else self.envelopes[self.labels.index(label)]
+        inside = envelope[tuple(self.get_cells(points).T)]
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.logical_or.reduceat(inside, offsets)
+
+
+def load_model_envelopes(models_directory, config, registration_margin_mm=10.0, cell_mm=4.0):
+    """
+    Builds the envelopes of every model of a bundleseg config, at its pruning threshold plus a registration margin.
+    Models of the same bundle in several atlas folders are pooled, and their streamlines are densified to the cell
+    size.
+    """
+    import nibabel as nib
+
+    model_points = {}
+    distances_mm = {}
+    for bundle_file, model_paths in get_model_paths(models_directory, config).items():
+        if len(model_paths) == 0:
+            continue
+        model_points[bundle_file] = np.concatenate([densify_points(nib.streamlines.load(path).streamlines, cell_mm)
+                                                    for path in model_paths])
+        distances_mm[bundle_file] = config[bundle_file] + registration_margin_mm
+    return ModelEnvelopes(model_points, distances_mm, cell_mm=cell_mm)
+
+
+def iter_streamline_batches(trk_path, batch_size=100000):
+    """
+    Yields the streamlines of a .trk file in batches, as (concatenated RAS mm points, lengths), without loading the
+    whole file.
+    """
+    import nibabel as nib
+
+    points, lengths = [], []
+    for streamline in nib.streamlines.load(trk_path, lazy_load=True).streamlines:
+        points.append(streamline)
+        lengths.append(len(streamline))
+        if len(lengths) == batch_size:
+            yield np.concatenate(points), np.asarray(lengths)
+            points, lengths = [], []
+    if len(lengths) > 0:
+        yield np.concatenate(points), np.asarray(lengths)
+
+
+def get_candidates(trk_path, envelopes, model_to_subject, batch_size=100000):
+    """
+    Which streamlines of a subject tractogram enter the envelope of at least one model.
+    Args:
+        trk_path: whole-brain .trk tractogram
+        envelopes: ModelEnvelopes of the atlas models
+        model_to_subject: 4x4 affine moving model streamlines into subject space (see module docstring)
+        batch_size: number of streamlines transformed at a time
+    Returns:
+        (n_streamlines,) boolean array
+    """
+    subject_to_model = np.linalg.inv(model_to_subject)
+    keep = []
+    for points, lengths in iter_streamline_batches(trk_path, batch_size):
+        model_points = points @ subject_to_model[:3, :3].T + subject_to_model[:3, 3]
+        keep.append(envelopes.candidates(model_points, lengths))
+    return np.concatenate(keep) if keep else np.zeros(0, dtype=bool)
+
+
+def filter_trk(trk_path, out_path, keep):
+    """
+    Writes the streamlines of a .trk file flagged in keep to a new .trk file, copying their records unchanged.
+    Returns:
+        Number of streamlines written
+    """
+    n_streamlines = 0
+    with open(trk_path, "rb") as f, open(out_path, "wb") as out:
+        raw_header, header = read_trk_header(f)
+        out.write(raw_header)
+        for record, kept in zip(iter_trk_records(f, header), keep):
+            if kept:
+                out.write(record)
+                n_streamlines += 1
+        set_trk_count(out, header, n_streamlines)
+    return n_streamlines
+
+
+def prefilter_tractogram(trk_path, out_path, config_file, models_directory, transfo_path, inverse=False,
+                         registration_margin_mm=10.0, cell_mm=4.0):
+    """
+    Writes the streamlines of a whole-brain tractogram that can be recognized by some model of a bundleseg config.
+    Args:
+        trk_path: whole-brain .trk tractogram
+        out_path: output .trk path
+        config_file, models_directory, transfo_path, inverse: the bundleseg inputs
+        registration_margin_mm: extra envelope distance covering bundleseg's local model registration
+        cell_mm: grid cell size (mm)
+    Returns:
+        Number of streamlines in the input and in the output
+    """
+    from scilpy.io.utils import load_matrix_in_any_format
+
+    config = json.load(open(config_file))
+    model_to_subject = load_matrix_in_any_format(transfo_path)
+    if inverse:
+        model_to_subject = np.linalg.inv(model_to_subject)
+    envelopes = load_model_envelopes(models_directory, config, registration_margin_mm=registration_margin_mm, cell_mm=cell_mm)
+    keep = get_candidates(trk_path, envelopes, model_to_subject)
+    return len(keep), filter_trk(trk_path, out_path, keep)
@@ -6,6 +6,10 @@ import os
 from os.path import join as ospj
 import sys
 
+# Scalar maps are read from their uncompressed mirror when it is up to date (see pyafq/build_scalar_mirror.py)
+sys.path.insert(0, ospj(os.path.dirname(os.path.abspath(__file__)), "..", "pyafq"))
+from scalars import resolve_scalar_paths
+
 '''
 This script uses nilearn vol_to_surf to map volumetric diffusion MRI parameter maps at different cortical depths
 '''
@@ -19,6 +23,8 @@ group = "penn_controls"
 surfaces_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/surfaces/{group}/{sub}"
 freesurfer_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/freesurfer/{group}/{sub}"
 qsirecon_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon/{group}/{sub}"
+qsirecon_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon/{group}"
+mirror_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon_mirror/{group}"
 cortical_profiles_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/cortical_profiles/{group}/{sub}"
 if not os.path.exists(cortical_profiles_dir):
     os.makedirs(cortical_profiles_dir)
@@ -31,6 +37,7 @@ white_rh = ospj(surfaces_dir, f"{sub}.rh.white.native_acpc.surf.gii")
 
 # Define path to example diffusion MRI parameter map
 scalar_path = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon/penn_controls/derivatives/qsirecon-DSIStudio/sub-RID0505/ses-research3Tv03/dwi/sub-RID0505_ses-research3Tv03_space-ACPC_model-tensor_param-md_dwimap.nii.gz"
+scalar_path = resolve_scalar_paths({"md": scalar_path}, qsirecon_group_dir, mirror_group_dir)["md"]
 scalar_img = nib.load(scalar_path)
 
 def vol_to_surf_by_depth(img, depths, surf_pial, surf_white):
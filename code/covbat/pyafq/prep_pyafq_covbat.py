@@ -1,10 +1,16 @@
 import os
+import sys
+from functools import lru_cache
 from os.path import join as ospj
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import json
 
+# Per-subject profile stores written by pyafq.py --profile_format store/both
+sys.path.insert(0, ospj(os.path.dirname(os.path.abspath(__file__)), "..", "..", "pyafq"))
+from profile_store import get_profile_store_path, load_profiles
+
 # Specify wm_atlas
 wm_atlas = "HCP1065"
 
@@ -93,6 +99,22 @@ def get_subject_scanner(sub, group):
     row = row.iloc[0]
     return row["scanner_id"]
 
+@lru_cache(maxsize=None)
+def get_subject_profiles(pyafq_dir, group, sub):
+    """
+    Reads all profiles of a subject from its profile store once.
+    Returns:
+        Dictionary mapping (tract, measure) -> profile, or None if the subject has no profile store
+    """
+    store_path = get_profile_store_path(pyafq_dir, group, sub, wm_atlas)
+    if not os.path.exists(store_path):
+        return None
+    profiles, tracts, measures = load_profiles(store_path)
+    return {(tract, measure): profiles[i, j]
+            for i, tract in enumerate(tracts)
+            for j, measure in enumerate(measures)
+            if not np.isnan(profiles[i, j]).all()}
+
 def prep_covbat_pyafq(pyafq_dir):
 
     # Read measures json
@@ -139,14 +161,16 @@ def prep_covbat_pyafq(pyafq_dir):
                     if pd.isnull(scanner_id):
                         continue
 
-                    # Get path to profile
-                    profile_path = ospj(group_dir_path, sub, wm_atlas, tract, "profile", f"{measure}_profile-pyafq.csv")
-                    if not os.path.exists(profile_path):
-                        continue
-
-                    # Read profile
-                    profile = pd.read_csv(profile_path, header=None)
-                    profile = profile.iloc[:, 0].values
+                    # Read profile from the subject's profile store if it has one (rounded as in the .csv files), otherwise from its .csv file
+                    subject_profiles = get_subject_profiles(pyafq_dir, group, sub)
+                    if subject_profiles is not None and (tract, measure) in subject_profiles:
+                        profile = np.round(subject_profiles[(tract, measure)], 6)
+                    else:
+                        profile_path = ospj(group_dir_path, sub, wm_atlas, tract, "profile", f"{measure}_profile-pyafq.csv")
+                        if not os.path.exists(profile_path):
+                            continue
+                        profile = pd.read_csv(profile_path, header=None)
+                        profile = profile.iloc[:, 0].values
 
                     # Save sub and profile to data_dict
                     data_dict[sub] = profile
@@ -0,0 +1,263 @@
+'''
+Benchmarks and numerical checks for the pyafq.py helpers against the dipy code paths they replace
+
+Usage:
+    python bench_pyafq.py profiles --trk BUNDLE.trk --centroid CENTROID.npy --scalars FA.nii.gz MD.nii.gz ...
+    python bench_pyafq.py orient --trk BUNDLE.trk --centroid CENTROID.npy
+    python bench_pyafq.py subsample --trk BUNDLE.trk --centroid CENTROID.npy --scalars FA.nii.gz ... [--caps 500 1000 2000]
+    python bench_pyafq.py density --trk BUNDLE.trk [--reference T1W.nii.gz]
+    python bench_pyafq.py startup --sub sub-RID0505 --group penn_controls [--script pyafq.py]
+'''
+
+# Standard library imports
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+# Third-party imports
+import numpy as np
+from nibabel.streamlines import ArraySequence
+
+# DIPY imports
+import dipy.stats.analysis as dsa
+import dipy.tracking.streamline as dts
+from dipy.io.image import load_nifti
+from dipy.io.stateful_tractogram import StatefulTractogram
+from dipy.io.streamline import load_trk
+from dipy.tracking.utils import density_map
+
+# Local imports
+from density import DensityMaps
+from orientation import orient_streamlines
+from profiles import afq_profiles, gaussian_weights
+from segments import split_streamlines
+from subsample import profile_deviation, stratified_subsample
+
+
+def compare_arrays(label, reference, candidate, fmt='%.6f'):
+    """
+    Prints the largest absolute difference between two arrays and whether they agree once written with fmt.
+    """
+    max_diff = np.nanmax(np.abs(np.asarray(reference, dtype=float) - np.asarray(candidate, dtype=float)))
+    same_text = np.array_equal(np.char.mod(fmt, reference), np.char.mod(fmt, candidate))
+    print(f"{label}: max |diff| = {max_diff:.3e}, identical as {fmt} text: {same_text}")
+    return same_text
+
+
+def bench_profiles(args):
+    """
+    Fused multi-measure profiling (profiles.afq_profiles) vs one dsa.afq_profile call per measure.
+    """
+    trk = load_trk(args.trk, reference="same", bbox_valid_check=False)
+    centroid = np.load(args.centroid)
+    streamlines = dts.orient_by_streamline(trk.streamlines, centroid)
+    weights = dsa.gaussian_weights(streamlines)
+
+    volumes = [load_nifti(path) for path in args.scalars]
+    affine = volumes[0][1]
+    scalars = np.stack([data for data, _ in volumes], axis=-1)
+
+    start = perf_counter()
+    reference = np.array([dsa.afq_profile(data, streamlines, affine, weights=weights) for data, _ in volumes])
+    dipy_time = perf_counter() - start
+
+    start = perf_counter()
+    fused = afq_profiles(scalars, streamlines, affine, weights=weights)
+    fused_time = perf_counter() - start
+
+    print(f"{len(streamlines)} streamlines x {len(volumes)} measures")
+    print(f"dsa.afq_profile per measure: {dipy_time:.3f}s, afq_profiles: {fused_time:.3f}s ({dipy_time / fused_time:.1f}x)")
+    compare_arrays("profiles", reference, fused)
+
+
+def bench_orient(args):
+    """
+    Batched orientation on float32 nodes and Gaussian weights in float64 (orientation.orient_streamlines,
+    profiles.gaussian_weights) vs dts.orient_by_streamline and dsa.gaussian_weights.
+    """
+    trk = load_trk(args.trk, reference="same", bbox_valid_check=False)
+    centroid = np.load(args.centroid)
+
+    start = perf_counter()
+    reference_streamlines = dts.orient_by_streamline(trk.streamlines, centroid)
+    reference_weights = dsa.gaussian_weights(reference_streamlines)
+    dipy_time = perf_counter() - start
+
+    start = perf_counter()
+    streamlines, nodes, flip = orient_streamlines(trk.streamlines, centroid)
+    weights = gaussian_weights(nodes)
+    batched_time = perf_counter() - start
+
+    print(f"{len(streamlines)} streamlines, {flip.sum()} flipped")
+    print(f"orient_by_streamline + gaussian_weights: {dipy_time:.3f}s, batched: {batched_time:.3f}s ({dipy_time / batched_time:.1f}x)")
+    same_streamlines = all(np.array_equal(a, b) for a, b in zip(reference_streamlines, streamlines))
+    print(f"oriented streamlines identical: {same_streamlines}")
+    compare_arrays("weights", reference_weights, weights)
+    print(f"weights: max relative diff = {np.max(np.abs(weights - reference_weights) / reference_weights):.3e}")
+    compare_arrays("mean streamline weights", reference_weights.mean(axis=1), weights.mean(axis=1))
+
+
+def bench_subsample(args):
+    """
+    Profiling time and profile deviation when capping a bundle to several streamline counts, for stratified
+    (subsample.stratified_subsample) vs uniform random subsampling.
+    """
+    trk = load_trk(args.trk, reference="same", bbox_valid_check=False)
+    streamlines, nodes, _ = orient_streamlines(trk.streamlines, np.load(args.centroid))
+    weights = gaussian_weights(nodes)
+    volumes = [load_nifti(path) for path in args.scalars]
+    affine = volumes[0][1]
+    scalars = np.stack([data for data, _ in volumes], axis=-1)
+    measures = [os.path.basename(path).split(".")[0] for path in args.scalars]
+
+    start = perf_counter()
+    full_profiles = afq_profiles(scalars, streamlines, affine, weights=weights, nodes=nodes)
+    full_time = perf_counter() - start
+    print(f"{len(streamlines)} streamlines x {len(measures)} measures, full bundle: {full_time:.3f}s")
+
+    rng = np.random.default_rng(args.seed)
+    for cap in args.caps:
+        start = perf_counter()
+        kept = stratified_subsample(nodes, cap, cell_mm=args.cell_mm, seed=args.seed)
+        stratified_select_time = perf_counter() - start
+        start = perf_counter()
+        capped_profiles = afq_profiles(scalars, streamlines[kept], affine, weights=weights[kept], nodes=nodes[kept])
+        capped_time = perf_counter() - start
+        uniform = np.sort(rng.choice(len(streamlines), min(cap, len(streamlines)), replace=False))
+        uniform_profiles = afq_profiles(scalars, streamlines[uniform], affine, weights=weights[uniform], nodes=nodes[uniform])
+
+        stratified = profile_deviation(measures, full_profiles, capped_profiles, len(streamlines), len(kept))
+        random = profile_deviation(measures, full_profiles, uniform_profiles, len(streamlines), len(uniform))
+        print(f"cap {cap}: selection {stratified_select_time:.3f}s, profiles {capped_time:.3f}s; "
+              f"max |diff| stratified {stratified['max_abs_diff'].max():.3e} (mean {stratified['mean_abs_diff'].mean():.3e}), "
+              f"uniform {random['max_abs_diff'].max():.3e} (mean {random['mean_abs_diff'].mean():.3e})")
+
+
+def bench_density(args):
+    """
+    Single-pass end1/core/end2 density maps (density.DensityMaps) vs one dipy density_map call per segment.
+    """
+    reference = args.reference if args.reference else "same"
+    trk = load_trk(args.trk, reference=reference, bbox_valid_check=False)
+
+    # A 2-point streamline (the first two points of the first one) is added in front: its core is empty, so the
+    # counts of every later streamline only land on the right label if empty segments are kept
+    bundle_streamlines = ArraySequence([trk.streamlines[0][:2]])
+    bundle_streamlines.extend(trk.streamlines)
+    segment_streamlines = {}
+    for segment_label, streamlines in zip(["end1", "core", "end2"], split_streamlines(bundle_streamlines)):
+        segment_tractogram = StatefulTractogram(streamlines, reference=trk.space_attributes, space=trk.space)
+        segment_tractogram.to_vox()
+        segment_tractogram.to_corner()
+        segment_streamlines[segment_label] = segment_tractogram.streamlines
+    dimensions = tuple(int(dim) for dim in trk.dimensions)
+
+    start = perf_counter()
+    # dipy's density_map cannot map an empty streamline (which adds nothing to the counts), so it is given the others
+    reference_maps = {label: density_map(streamlines[streamlines._lengths > 0], np.eye(4), dimensions)
+                      for label, streamlines in segment_streamlines.items()}
+    dipy_time = perf_counter() - start
+
+    start = perf_counter()
+    density_maps = DensityMaps(segment_streamlines, np.eye(4), dimensions)
+    fused_maps = {label: density_maps.volume(label) for label in segment_streamlines}
+    fused_time = perf_counter() - start
+
+    print(f"{len(bundle_streamlines)} streamlines (one with an empty core) x {len(segment_streamlines)} segments on a {dimensions} grid")
+    print(f"density_map per segment: {dipy_time:.3f}s, DensityMaps: {fused_time:.3f}s ({dipy_time / fused_time:.1f}x)")
+    for label in segment_streamlines:
+        print(f"{label}: identical counts: {np.array_equal(reference_maps[label], fused_maps[label])}")
+
+
+def parse_importtime(stderr_text):
+    """
+    Top-level module import times (seconds, cumulative) from the output of python -X importtime.
+    """
+    import_times = {}
+    for line in stderr_text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit() or module[1:].startswith(" "):
+            continue
+        import_times[module.strip()] = int(cumulative) / 1e6
+    return import_times
+
+
+def bench_startup(args):
+    """
+    Start-up latency of pyafq.py in --dry_run mode: time spent importing, time to the first planned tract and total.
+    """
+    script = os.path.abspath(args.script)
+    command = [sys.executable, "-X", "importtime", script, args.sub, args.group, "--dry_run"]
+
+    first_work_times, total_times, import_totals = [], [], []
+    for _ in range(args.repeats):
+        # importtime writes to stderr, which goes to a file so that it can never block the pipe we read from
+        with tempfile.TemporaryFile(mode="w+") as stderr_file:
+            start = perf_counter()
+            process = subprocess.Popen(command, cwd=os.path.dirname(script), stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+            process.stdout.readline()
+            first_work_times.append(perf_counter() - start)
+            process.communicate()
+            total_times.append(perf_counter() - start)
+            if process.returncode != 0:
+                stderr_file.seek(0)
+                raise RuntimeError(f"{' '.join(command)} failed:\n{stderr_file.read()}")
+            stderr_file.seek(0)
+            import_times = parse_importtime(stderr_file.read())
+        import_totals.append(sum(import_times.values()))
+
+    print(f"{script} ({args.repeats} runs, median)")
+    print(f"imports: {np.median(import_totals):.3f}s, first planned tract: {np.median(first_work_times):.3f}s, total: {np.median(total_times):.3f}s")
+    print("slowest top-level imports (last run):")
+    for module, seconds in sorted(import_times.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"    {module}: {seconds:.3f}s")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks for the pyafq.py helpers.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("profiles", help=bench_profiles.__doc__.strip())
+    p.add_argument("--trk", required=True, help="Bundle .trk file (e.g. a bundleseg output)")
+    p.add_argument("--centroid", required=True, help="Model centroid .npy used to orient the bundle")
+    p.add_argument("--scalars", nargs="+", required=True, help="Scalar .nii.gz maps on the same grid")
+    p.set_defaults(func=bench_profiles)
+
+    p = subparsers.add_parser("orient", help=bench_orient.__doc__.strip())
+    p.add_argument("--trk", required=True, help="Bundle .trk file (e.g. a bundleseg output)")
+    p.add_argument("--centroid", required=True, help="Model centroid .npy used to orient the bundle")
+    p.set_defaults(func=bench_orient)
+
+    p = subparsers.add_parser("subsample", help=bench_subsample.__doc__.strip())
+    p.add_argument("--trk", required=True, help="Bundle .trk file (e.g. a bundleseg output)")
+    p.add_argument("--centroid", required=True, help="Model centroid .npy used to orient the bundle")
+    p.add_argument("--scalars", nargs="+", required=True, help="Scalar .nii.gz maps on the same grid")
+    p.add_argument("--caps", nargs="+", type=int, default=[250, 500, 1000, 2000], help="Streamline counts to cap the bundle to")
+    p.add_argument("--cell_mm", type=float, default=10, help="Grid cell size (mm) of the strata")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.set_defaults(func=bench_subsample)
+
+    p = subparsers.add_parser("density", help=bench_density.__doc__.strip())
+    p.add_argument("--trk", required=True, help="Bundle .trk file (e.g. a bundleseg output)")
+    p.add_argument("--reference", help="Reference image defining the output grid (default: the .trk header)")
+    p.set_defaults(func=bench_density)
+
+    p = subparsers.add_parser("startup", help=bench_startup.__doc__.strip())
+    p.add_argument("--sub", required=True, help="Subject label passed to the script")
+    p.add_argument("--group", required=True, help="Subject group passed to the script")
+    p.add_argument("--script", default="pyafq.py", help="pyafq.py to time (e.g. a copy of an older version)")
+    p.add_argument("--repeats", type=int, default=5, help="Number of runs")
+    p.add_argument("--top", type=int, default=8, help="Number of top-level imports to list")
+    p.set_defaults(func=bench_startup)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,62 @@
+'''
+Builds an uncompressed, memory-mappable mirror of a subject's qsirecon scalar maps (every measure in
+scalar_labels_to_filenames.json). pyafq.py and the other scalar consumers load the mirror in place of the
+.nii.gz maps whenever its sidecar still matches the size and mtime of the source
+
+Usage:
+    python build_scalar_mirror.py sub-RID0505 penn_controls [--force]
+'''
+
+# Standard library imports
+import argparse
+import json
+import os
+from os.path import join as ospj
+
+# Local imports
+from scalars import build_mirror, get_mirror_path, get_scalar_paths, is_mirror_valid
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Mirror a subject's qsirecon scalar maps as uncompressed .nii files.")
+    parser.add_argument("sub", help="Subject label (e.g. sub-RID0505)")
+    parser.add_argument("group", choices=["hcpaging", "hcpya", "penn_controls", "penn_epilepsy"], help="Subject group")
+    parser.add_argument("--force", action="store_true", help="Rebuild mirrors that are already up to date")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    sub = args.sub
+    group = args.group
+
+    # Define input/output directories
+    metadata_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/metadata"
+    qsiprep_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsiprep/{group}"
+    qsirecon_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon/{group}"
+    mirror_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon_mirror/{group}"
+
+    # Get session (Penn groups only)
+    if group == "penn_controls" or group == "penn_epilepsy":
+        ses = [d for d in os.listdir(f"{qsiprep_group_dir}/{sub}") if d.startswith("ses-")][0]
+    else:
+        ses = None
+
+    # Load in list of diffusion MRI scalars from .json file (they are the keys of the json)
+    labels_to_filenames = json.load(open(ospj(metadata_dir, "scalar_labels_to_filenames.json")))
+    labels_to_directories = json.load(open(ospj(metadata_dir, "scalar_labels_to_directories.json")))
+    scalar_paths = get_scalar_paths(qsirecon_group_dir, group, sub, labels_to_filenames, labels_to_directories, ses=ses)
+
+    for measure, scalar_path in scalar_paths.items():
+        mirror_path = get_mirror_path(scalar_path, qsirecon_group_dir, mirror_group_dir)
+        if not os.path.exists(scalar_path):
+            print(f"---- Skipping {measure} because {scalar_path} does not exist")
+        elif is_mirror_valid(scalar_path, mirror_path) and not args.force:
+            print(f"---- {measure} mirror is up to date")
+        else:
+            build_mirror(scalar_path, mirror_path)
+            print(f"---- Mirrored {measure} to {mirror_path}")
+
+
+if __name__ == "__main__":
+    main()
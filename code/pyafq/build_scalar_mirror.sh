@@ -0,0 +1,13 @@
+#!/bin/bash
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=4GB
+#SBATCH --job-name=scalar_mirror
+
+sub=${1}
+group=${2}
+
+source activate /mnt/sauce/littlab/users/mjaskir/software/miniconda3/envs/structural_tractometry
+
+echo "Starting scalar mirror at $(date)"
+python build_scalar_mirror.py ${sub} ${group}
+echo "Finished scalar mirror at $(date)"
@@ -0,0 +1,275 @@
+'''
+Model centroid builder and cache for pyafq.py. A tract's centroid is the mean of its model streamlines after
+resampling and orienting them consistently (what QuickBundles with an infinite threshold computes with a running
+mean), and is cached under a content hash of the model .trk file so that a changed atlas is never silently
+ignored. The node order of left centroids is then made consistent with their right homologs (orient_homologs)
+'''
+
+# Standard library imports
+import hashlib
+import json
+import os
+from os.path import join as ospj
+import tempfile
+
+# Third-party imports
+import numpy as np
+import pandas as pd
+
+# Local imports
+from profiles import resample_streamlines
+
+
+def hash_file(path, chunk_size=2**24):
+    """
+    sha256 of a file's contents, read in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_model_hash(model_trk_path, memo_path):
+    """
+    Content hash of a model .trk file. The hash is memoized in a JSON sidecar together with the file's size and
+    mtime, so the model is only re-read when it changes.
+    Args:
+        model_trk_path: model bundle .trk file
+        memo_path: JSON file holding the memoized hash
+    Returns:
+        sha256 hex digest
+    """
+    stat = os.stat(model_trk_path)
+    signature = {"model_path": os.path.abspath(model_trk_path), "model_size": stat.st_size, "model_mtime_ns": stat.st_mtime_ns}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+        if {key: memo.get(key) for key in signature} == signature:
+            return memo["sha256"]
+
+    memo = dict(signature, sha256=hash_file(model_trk_path))
+    write_atomic(memo_path, lambda f: f.write(json.dumps(memo, indent=4).encode()))
+    return memo["sha256"]
+
+
+def write_atomic(path, write, suffix=""):
+    """
+    Writes a file through a temporary file in the same directory that is then renamed over the target, so that
+    concurrent jobs never read a partially written file (the last of several identical writes wins).
+    Args:
+        path: output path
+        write: function called with the open binary temporary file
+        suffix: suffix of the temporary file (e.g. '.npy')
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # mkstemp creates files readable by the owner only; use the permissions a plain open() would give
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def orient_to_reference(nodes, reference):
+    """
+    Flips resampled streamlines whose reversed node order is closer (average pointwise distance) to a reference.
+    Args:
+        nodes: (n_streamlines x n_points x 3) resampled streamlines
+        reference: (n_points x 3) reference streamline
+    Returns:
+        Oriented copy of nodes and the boolean array of flipped streamlines
+    """
+    direct = np.linalg.norm(nodes - reference, axis=2).mean(axis=1)
+    flipped = np.linalg.norm(nodes[:, ::-1] - reference, axis=2).mean(axis=1)
+    flip = flipped < direct
+    return np.where(flip[:, None, None], nodes[:, ::-1], nodes), flip
+
+
+def compute_centroid(streamlines, n_points=100, max_streamlines=None, seed=0, max_iter=20):
+    """
+    Vectorized centroid of a bundle: the streamlines are resampled once, oriented towards the first streamline
+    (as QuickBundles starts from it) and averaged, then re-oriented towards the mean until no streamline flips.
+    Args:
+        streamlines: model bundle streamlines
+        n_points: number of points of the centroid
+        max_streamlines: if set, a random subset of at most this many streamlines is used
+        seed: random seed for the subset
+        max_iter: maximum number of orient/average iterations
+    Returns:
+        (n_points x 3) float32 centroid
+    """
+    if max_streamlines is not None and len(streamlines) > max_streamlines:
+        keep = np.sort(np.random.default_rng(seed).choice(len(streamlines), max_streamlines, replace=False))
+        streamlines = streamlines[keep]
+    nodes = resample_streamlines(streamlines, n_points=n_points).astype(float)
+
+    reference = nodes[0]
+    previous_flip = None
+    for _ in range(max_iter):
+        oriented, flip = orient_to_reference(nodes, reference)
+        reference = oriented.mean(axis=0)
+        if previous_flip is not None and np.array_equal(flip, previous_flip):
+            break
+        previous_flip = flip
+    return reference.astype(np.float32)
+
+
+def compute_centroid_quickbundles(streamlines, n_points=100):
+    """
+    Centroid from QuickBundles with an infinite threshold (all streamlines in one cluster), as originally computed.
+    """
+    from dipy.segment.clustering import QuickBundles
+    from dipy.segment.featurespeed import ResampleFeature
+    from dipy.segment.metricspeed import AveragePointwiseEuclideanMetric
+
+    # Puts all streamlines into one cluster, using the centroid streamline as the standard to orient all streamlines
+    feature = ResampleFeature(nb_points=n_points)
+    metric = AveragePointwiseEuclideanMetric(feature)
+    qb = QuickBundles(np.inf, metric=metric)
+    clusters_model = qb.cluster(streamlines)
+    return clusters_model.centroids[0]
+
+
+def get_centroid_path(centroids_dir, tract_label, model_trk_path, method="mean", n_points=100, max_streamlines=None, seed=0):
+    """
+    Cache path of a model centroid, keyed by the content hash of the model file and the centroid parameters.
+    """
+    model_hash = get_model_hash(model_trk_path, ospj(centroids_dir, f"{tract_label}_model_hash.json"))
+    params = {"model_sha256": model_hash, "method": method, "n_points": n_points}
+    if method == "mean":
+        params.update(max_streamlines=max_streamlines, seed=seed)
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return ospj(centroids_dir, f"{tract_label}_model_centroids_{key}.npy")
+
+
+def get_centroid_record(centroid_paths):
+    """
+    Identity of the centroids that decide a tract's node order: the cache file names (content hash and parameters)
+    of the centroids of the tract and its homolog.
+    """
+    return {label: os.path.basename(path) for label, path in sorted(centroid_paths.items())}
+
+
+def centroid_record_matches(record_path, centroid_paths):
+    """
+    Checks whether a tract's outputs were made with the given centroids, as recorded by save_centroid_record.
+    Outputs without a record (e.g. made with the centroids of earlier pyafq.py versions) never match.
+    """
+    if not os.path.exists(record_path):
+        return False
+    with open(record_path) as f:
+        return json.load(f) == get_centroid_record(centroid_paths)
+
+
+def save_centroid_record(record_path, centroid_paths):
+    """
+    Records which centroids a tract's outputs are made with (see centroid_record_matches). The record is only
+    rewritten when they change, so its mtime is the time from which outputs are made with them.
+    """
+    record = get_centroid_record(centroid_paths)
+    write_atomic(record_path, lambda f: f.write(json.dumps(record, indent=4).encode()))
+
+
+def load_or_build_centroid(centroid_path, model_trk_path, method="mean", n_points=100, max_streamlines=None, seed=0):
+    """
+    Loads a cached model centroid, computing and atomically saving it first if it is not cached yet.
+    Args:
+        centroid_path: cache path (see get_centroid_path)
+        model_trk_path: model bundle .trk file
+        method: 'mean' (vectorized, see compute_centroid) or 'quickbundles'
+    Returns:
+        (n_points x 3) centroid
+    """
+    if os.path.exists(centroid_path):
+        return np.load(centroid_path)
+
+    from dipy.io.streamline import load_trk
+
+    model_trk = load_trk(model_trk_path, "same", bbox_valid_check=False)
+    if method == "mean":
+        centroid = compute_centroid(model_trk.streamlines, n_points=n_points, max_streamlines=max_streamlines, seed=seed)
+    elif method == "quickbundles":
+        centroid = compute_centroid_quickbundles(model_trk.streamlines, n_points=n_points)
+    else:
+        raise ValueError(f"Unknown centroid method: {method}")
+
+    write_atomic(centroid_path, lambda f: np.save(f, centroid), suffix=".npy")
+    return centroid
+
+
+def get_homolog(tract_label):
+    """
+    Label of the contralateral homolog of a lateralized tract (AF_L <-> AF_R), or None for other tracts.
+    """
+    if tract_label.endswith("_L"):
+        return f"{tract_label[:-2]}_R"
+    elif tract_label.endswith("_R"):
+        return f"{tract_label[:-2]}_L"
+    else:
+        return None
+
+
+def orient_homologs(centroids, midline_x=0):
+    """
+    Makes node order proceed comparably between left and right hemispheres: every left centroid is mirrored across
+    the midline and compared (average pointwise distance) in both node orders with its right homolog, and is
+    flipped when the reversed order is closer. All pairs are compared at once; right centroids and tracts without
+    a homolog keep their node order.
+    Args:
+        centroids: dictionary mapping tract label -> (n_points x 3) centroid in RAS mm
+        midline_x: x coordinate (mm) of the midsagittal plane
+    Returns:
+        Dictionary of oriented centroids and a DataFrame with the decision for every tract
+    """
+    oriented = dict(centroids)
+    report = pd.DataFrame({"tract": sorted(centroids)})
+    report["homolog"] = [get_homolog(tract) if get_homolog(tract) in centroids else None for tract in report["tract"]]
+    report["distance"] = np.nan
+    report["distance_flipped"] = np.nan
+    report["decision"] = np.where(report["homolog"].isna(), "no homolog", "reference")
+
+    is_left = report["tract"].str.endswith("_L") & report["homolog"].notna()
+    left_labels = report.loc[is_left, "tract"].tolist()
+    if left_labels:
+        left = np.stack([centroids[tract] for tract in left_labels]).astype(float)
+        right = np.stack([centroids[get_homolog(tract)] for tract in left_labels]).astype(float)
+        left[..., 0] = 2 * midline_x - left[..., 0]
+
+        distance = np.linalg.norm(left - right, axis=2).mean(axis=1)
+        distance_flipped = np.linalg.norm(left[:, ::-1] - right, axis=2).mean(axis=1)
+        flip = distance_flipped < distance
+
+        report.loc[is_left, "distance"] = distance
+        report.loc[is_left, "distance_flipped"] = distance_flipped
+        report.loc[is_left, "decision"] = np.where(flip, "flipped", "kept")
+        for tract, flip_tract in zip(left_labels, flip):
+            if flip_tract:
+                oriented[tract] = centroids[tract][::-1]
+    return oriented, report
+
+
+def load_oriented_centroid(tract_label, centroid_paths, model_trk_paths, method="mean", max_streamlines=None):
+    """
+    Loads (building if necessary) the centroids of a tract and its homolog and returns the tract's centroid with
+    its node order made consistent with the homolog (see orient_homologs).
+    Args:
+        tract_label: tract label
+        centroid_paths: dictionary mapping tract label -> centroid cache path, for the tract and its homolog
+        model_trk_paths: dictionary mapping tract label -> model .trk file
+        method, max_streamlines: see load_or_build_centroid
+    Returns:
+        (n_points x 3) centroid
+    """
+    centroids = {label: load_or_build_centroid(centroid_path, model_trk_paths[label], method=method, max_streamlines=max_streamlines)
+                 for label, centroid_path in centroid_paths.items()}
+    return orient_homologs(centroids)[0][tract_label]
@@ -0,0 +1,65 @@
+'''
+Checks the node order of every model centroid in the atlas at once: each left centroid is mirrored across the
+midline and compared in both node orders with its right homolog (see centroids.orient_homologs). Writes the
+decision for every tract to {atlas_label}_centroid_orientation.csv in the centroids directory, which replaces
+rendering every tract to inspect its orientation
+
+Usage:
+    python check_centroid_orientation.py [--centroid_method mean] [--centroid_max_streamlines 5000]
+'''
+
+# Standard library imports
+import argparse
+import os
+from os.path import join as ospj
+import time
+
+# Third-party imports
+import pandas as pd
+
+# Local imports
+from centroids import get_centroid_path, load_or_build_centroid, orient_homologs
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Report the left/right node order consistency of all model centroids.")
+    parser.add_argument("--centroid_method", choices=["mean", "quickbundles"], default="mean",
+                        help="How model centroids are computed when not cached (see pyafq.py)")
+    parser.add_argument("--centroid_max_streamlines", type=int, default=None,
+                        help="Compute model centroids from a random subset of at most this many model streamlines")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+
+    # Define input/output directories
+    atlas_label = "HCP1065"
+    atlas_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/atlases/{atlas_label}"
+    model_dir = f"{atlas_dir}/all_trk"
+    centroids_dir = f"{atlas_dir}/centroids"
+
+    # Load (building if necessary) the centroid of every model bundle
+    tract_labels = sorted(f[:-len(".trk")] for f in os.listdir(model_dir) if f.endswith(".trk") and not f.startswith("."))
+    centroids = {}
+    for tract_label in tract_labels:
+        model_trk_path = ospj(model_dir, f"{tract_label}.trk")
+        centroid_path = get_centroid_path(centroids_dir, tract_label, model_trk_path, method=args.centroid_method,
+                                          max_streamlines=args.centroid_max_streamlines)
+        centroids[tract_label] = load_or_build_centroid(centroid_path, model_trk_path, method=args.centroid_method,
+                                                        max_streamlines=args.centroid_max_streamlines)
+
+    start = time.perf_counter()
+    _, report = orient_homologs(centroids)
+    elapsed = time.perf_counter() - start
+
+    report_path = ospj(centroids_dir, f"{atlas_label}_centroid_orientation.csv")
+    report.to_csv(report_path, index=False)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(report.round(2).to_string(index=False))
+    print(f"---- Checked {len(centroids)} centroids in {elapsed * 1000:.1f} ms ({(report['decision'] == 'flipped').sum()} flipped)")
+    print(f"---- Saved {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+'''
+Single-pass streamline density maps. Reproduces dipy.tracking.utils.density_map (number of unique streamlines
+passing through each voxel) for any number of labelled streamline sets at once, counting every
+(label, voxel) pair with one bincount over flattened voxel indices
+'''
+
+# Third-party imports
+import nibabel as nib
+import numpy as np
+
+# Local imports
+from segments import make_array_sequence, ranges_to_indices
+
+
+def streamline_voxels(streamlines, affine, vol_dims):
+    """
+    Flat indices of the voxels visited by each streamline, each voxel counted once per streamline
+    (same voxel mapping as dipy's density_map, including its IndexError for points outside the volume).
+    Args:
+        streamlines: ArraySequence / Streamlines
+        affine: mapping from voxel coordinates to streamline points (np.eye(4) for streamlines in voxel space)
+        vol_dims: shape of the output volume
+    Returns:
+        streamline_ids: index of the streamline for every unique (streamline, voxel) pair
+        voxels: flat voxel index for every unique (streamline, voxel) pair
+    """
+    n_voxels = int(np.prod(vol_dims))
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    if lengths.sum() == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Points of sliced views (e.g. segments.split_streamlines(copy=False)) are gathered first
+    if streamlines._data.shape[0] != lengths.sum():
+        streamlines = streamlines.copy()
+
+    inv_affine = np.linalg.inv(affine)
+    inds = np.dot(streamlines._data, inv_affine[:3, :3].T)
+    inds += inv_affine[:3, 3] + .5
+    if inds.min().round(decimals=6) < 0:
+        raise IndexError("streamline has points that map to negative voxel indices")
+    inds = inds.astype(np.intp)
+    if np.any(inds >= np.asarray(vol_dims[:3])):
+        raise IndexError("streamline has points that map outside of the volume")
+
+    # One key per (streamline, voxel); repeated keys of consecutive points are dropped before the sort
+    ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    keys = ids * n_voxels + np.ravel_multi_index(inds.T, vol_dims[:3])
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    keys.sort()
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    return (keys // n_voxels).astype(np.intp), (keys % n_voxels).astype(np.intp)
+
+
+class DensityMaps:
+    """
+    Density maps of several labelled streamline sets, accumulated in one pass and held as one
+    (label, voxel) entry per unique streamline visit until they are written out.
+    Args:
+        streamline_sets: dictionary mapping label -> streamlines (e.g. {"end1": ..., "core": ..., "end2": ...});
+                         empty streamlines are kept and count zero
+        affine: mapping from voxel coordinates to streamline points, as in dipy's density_map
+        vol_dims: shape of the output volumes
+    """
+
+    def __init__(self, streamline_sets, affine, vol_dims):
+        self.labels = list(streamline_sets.keys())
+        self.vol_dims = tuple(int(dim) for dim in vol_dims[:3])
+        self.n_voxels = int(np.prod(self.vol_dims))
+
+        # Concatenate every set into a single buffer, remembering which label each streamline came from. The buffer
+        # is gathered from the _data/_offsets/_lengths of each set, since ArraySequence.extend drops empty streamlines
+        # (e.g. the core of a 2-point streamline), which would shift the labels of every later streamline
+        lengths = [np.asarray(streamline_sets[label]._lengths, dtype=np.intp) for label in self.labels]
+        streamline_labels = np.repeat(np.arange(len(self.labels)), [len(set_lengths) for set_lengths in lengths])
+        points = []
+        for label, set_lengths in zip(self.labels, lengths):
+            data = np.asarray(streamline_sets[label]._data).reshape(-1, 3)
+            points.append(data[ranges_to_indices(streamline_sets[label]._offsets, set_lengths)])
+        all_lengths = np.concatenate(lengths) if lengths else np.empty(0, dtype=np.intp)
+        all_points = np.concatenate(points) if points else np.empty((0, 3))
+        all_streamlines = make_array_sequence(all_points, np.cumsum(all_lengths) - all_lengths, all_lengths)
+
+        streamline_ids, voxels = streamline_voxels(all_streamlines, affine, self.vol_dims)
+
+        # Keys are sorted by streamline, so every label occupies a contiguous block
+        self.keys = streamline_labels[streamline_ids].astype(np.int64) * self.n_voxels + voxels
+        self.bounds = np.searchsorted(self.keys // self.n_voxels, np.arange(len(self.labels) + 1))
+
+    def volume(self, label):
+        """
+        Dense (X x Y x Z) count volume of one label (dtype int, as dipy's density_map).
+        """
+        i = self.labels.index(label)
+        voxels = self.keys[self.bounds[i]:self.bounds[i + 1]] - i * self.n_voxels
+        return np.bincount(voxels, minlength=self.n_voxels).astype(int).reshape(self.vol_dims)
+
+    def to_4d(self):
+        """
+        All labels as one (X x Y x Z x n_labels) count volume, in the order of self.labels.
+        """
+        counts = np.bincount(self.keys, minlength=len(self.labels) * self.n_voxels).astype(int)
+        return np.moveaxis(counts.reshape((len(self.labels),) + self.vol_dims), 0, -1)
+
+    def sparse(self):
+        """
+        Non-zero voxels of every label.
+        Returns:
+            label_index: index into self.labels of each entry
+            voxels: flat voxel index of each entry
+            counts: number of streamlines of the label passing through the voxel
+        """
+        keys = np.sort(self.keys)
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = np.diff(np.append(starts, len(keys)))
+        keys = keys[starts]
+        return keys // self.n_voxels, keys % self.n_voxels, counts
+
+    def save_niftis(self, out_paths, affine, header=None):
+        """
+        Saves one density NIfTI per label, materializing a single dense volume at a time.
+        Args:
+            out_paths: dictionary mapping label -> output .nii.gz path
+            affine, header: voxel-to-world affine and NIfTI header of the output grid
+        """
+        for label, out_path in out_paths.items():
+            nib.save(nib.Nifti1Image(self.volume(label), affine, header), out_path)
+
+    def save_4d(self, out_path, affine, header=None):
+        """
+        Saves all labels as a single 4D NIfTI (one volume per label, in the order of self.labels).
+        """
+        nib.save(nib.Nifti1Image(self.to_4d(), affine, header), out_path)
+
+    def save_sparse(self, out_path, affine):
+        """
+        Saves the non-zero voxels of every label to a compressed .npz (see load_sparse_density).
+        """
+        label_index, voxels, counts = self.sparse()
+        np.savez_compressed(out_path,
+                            labels=np.array(self.labels),
+                            vol_dims=np.array(self.vol_dims),
+                            affine=affine,
+                            label_index=label_index.astype(np.int32),
+                            voxels=voxels,
+                            counts=counts.astype(np.int32))
+
+
+def load_sparse_density(path, label=None):
+    """
+    Loads density maps saved with DensityMaps.save_sparse.
+    Args:
+        path: .npz path
+        label: if given, only this label is densified
+    Returns:
+        Dictionary mapping label -> dense (X x Y x Z) count volume, and the voxel-to-world affine
+    """
+    with np.load(path) as store:
+        labels = list(store["labels"])
+        vol_dims = tuple(store["vol_dims"])
+        label_index = store["label_index"]
+        voxels = store["voxels"]
+        counts = store["counts"]
+        affine = store["affine"]
+
+    volumes = {}
+    for i, store_label in enumerate(labels):
+        if label is not None and store_label != label:
+            continue
+        volume = np.zeros(int(np.prod(vol_dims)), dtype=int)
+        in_label = label_index == i
+        volume[voxels[in_label]] = counts[in_label]
+        volumes[store_label] = volume.reshape(vol_dims)
+    return volumes, affine
@@ -17,14 +17,11 @@ import dipy.tracking.streamline as dts
 from dipy.data.fetcher import get_two_hcp842_bundles
 from dipy.io.image import load_nifti
 from dipy.io.streamline import load_trk
-from dipy.segment.clustering import QuickBundles
-from dipy.segment.featurespeed import ResampleFeature
-from dipy.segment.metricspeed import AveragePointwiseEuclideanMetric
 from dipy.tracking.streamline import set_number_of_points, transform_streamlines
 
-# FURY imports
-from fury import actor, window
-from fury.colormap import create_colormap
+# Local imports
+from centroids import get_centroid_path, get_homolog, load_oriented_centroid
+from render_qc import get_view, render_orientation
 
 # Specify atlas directory
 atlas_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/atlases/hcp1065/all_trk"
@@ -51,15 +48,12 @@ for trk_file in os.listdir(atlas_dir):
         trk = load_trk(trk_path, "same", bbox_valid_check=False)
         trk_streamlines = trk.streamlines
 
-        # Puts all streamlines into one cluster, using the centroid streamline as the standard to orient all streamlines
-        feature = ResampleFeature(nb_points=100)
-        metric = AveragePointwiseEuclideanMetric(feature)
-        qb = QuickBundles(np.inf, metric=metric)
-        clusters_model = qb.cluster(trk_streamlines)
-        centroids_model = clusters_model.centroids[0]
-
-        # Save as .npy file
-        np.save(ospj(centroids_dir, f"{tract_label}_model_centroids.npy"), centroids_model)
+        # Centroid of all streamlines (the standard used to orient them), cached under the content hash of the .trk file
+        # and with node order made consistent with the homolog in the other hemisphere
+        model_trk_paths = {label: ospj(atlas_dir, f"{label}.trk") for label in [tract_label, get_homolog(tract_label)]
+                           if label is not None and os.path.exists(ospj(atlas_dir, f"{label}.trk"))}
+        centroid_paths = {label: get_centroid_path(centroids_dir, label, model_trk_path) for label, model_trk_path in model_trk_paths.items()}
+        centroids_model = load_oriented_centroid(tract_label, centroid_paths, model_trk_paths)
 
         # Reorient streamlines based on centroids
         trk_streamlines_reoriented = dts.orient_by_streamline(trk.streamlines, centroids_model)
@@ -73,51 +67,6 @@ for trk_file in os.listdir(atlas_dir):
         # Transform streamlines to "T1w" space (no-op here, but for consistency)
         trk_streamlines_reoriented_in_t1w = transform_streamlines(trk_streamlines_reoriented, inv_affine)
 
-        # Helper to make lines as tubes
-        def lines_as_tubes(sl, line_width, **kwargs):
-            line_actor = actor.line(sl, **kwargs)
-            line_actor.GetProperty().SetRenderLinesAsTubes(1)
-            line_actor.GetProperty().SetLineWidth(line_width)
-            return line_actor
-
-        # Create scene
-        scene = window.Scene()
-        scene.clear()
-
-        # Add streamlines, colored by node index along the streamline
-        for sl in trk_streamlines_reoriented_in_t1w:
-            n_points = len(sl)
-            colors = create_colormap(np.linspace(0, 100, n_points), 'jet')
-            trk_actor = actor.line([sl], colors=colors)
-            scene.add(trk_actor)
-
-        # Set camera based on tract label
-        if tract_label.endswith('L'):
-            scene.set_camera(
-                position=(25, 0, 0),
-                focal_point=(0, 0, 0),
-                view_up=(0, 0, 1)
-            )
-        elif tract_label.endswith('R'):
-            scene.set_camera(
-                position=(-25, 0, 0),
-                focal_point=(0, 0, 0),
-                view_up=(0, 0, 1)
-            )
-        else:
-            scene.set_camera(
-                position=(0, 0, 25),
-                focal_point=(0, 0, 0),
-                view_up=(0, 0, 1)
-            )
-
-        # Save the image
+        # Save the image (all streamlines drawn as one line collection, colored by node index along the streamline)
         out_img = ospj(centroids_dir, f"{tract_label}_streamline_orientation.png")
-        window.record(
-            scene,
-            out_path=out_img,
-            size=(1200, 1200)
-        )
-
-
-
+        render_orientation(trk_streamlines_reoriented_in_t1w, out_img, view=get_view(tract_label), title=tract_label)
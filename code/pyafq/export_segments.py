@@ -0,0 +1,79 @@
+'''
+Exports the end1/core/end2 segments of a subject's bundles as .trk files from the segment indices written by
+pyafq.py (which no longer writes the .trk copies unless run with --segment_trk)
+
+Usage:
+    python export_segments.py sub-RID0505 penn_controls [--tracts AF_L AF_R] [--force]
+'''
+
+# Standard library imports
+import argparse
+import json
+import os
+from os.path import join as ospj
+
+# Third-party imports
+import pandas as pd
+
+# Local imports
+from segment_index import load_segments, save_segment_trks
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Export the end1/core/end2 segments of a subject's bundles as .trk files.")
+    parser.add_argument("sub", help="Subject label (e.g. sub-RID0505)")
+    parser.add_argument("group", choices=["hcpaging", "hcpya", "penn_controls", "penn_epilepsy"], help="Subject group")
+    parser.add_argument("--tracts", nargs="+", help="Tract labels to export (default: all tracts in the bundleseg config)")
+    parser.add_argument("--force", action="store_true", help="Overwrite .trk files that already exist")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    sub = args.sub
+    group = args.group
+
+    # Define input/output directories
+    atlas_label = "HCP1065"
+    atlas_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/atlases/{atlas_label}"
+    bundleseg_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg/{group}"
+    pyafq_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}"
+    bundleseg_config_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/code/bundleseg/config"
+    template = "/mnt/sauce/littlab/users/mjaskir/software/neuromaps-data/atlases/MNI152/tpl-MNI152NLin2009cAsym_res-1mm_T1w.nii.gz"
+
+    tract_metadata = pd.read_csv(ospj(atlas_dir, f"{atlas_label}_tract_metadata.csv"))
+
+    # Load in tract labels from bundleseg config
+    if args.tracts is not None:
+        tract_labels = args.tracts
+    else:
+        tract_labels = json.load(open(ospj(bundleseg_config_dir, f"config_{atlas_label}_association_projection.json")))
+        tract_labels = [tract_label.replace('.trk', '') for tract_label in tract_labels.keys()]
+
+    for tract_label in tract_labels:
+        trk_path = ospj(bundleseg_group_dir, f"{sub}/{tract_label}.trk")
+        segmentation_dir = ospj(pyafq_group_dir, f"{sub}/{atlas_label}/{tract_label}/segmentation")
+        index_path = ospj(segmentation_dir, f"{tract_label}_segments.npz")
+        if not os.path.exists(trk_path) or not os.path.exists(index_path):
+            print(f"---- Skipping {tract_label} because its .trk file or segment index does not exist")
+            continue
+
+        # Same file names as the .trk files pyafq.py writes with --segment_trk
+        end1_label = tract_metadata.loc[tract_metadata['label'] == tract_label, 'end1'].values[0]
+        end2_label = tract_metadata.loc[tract_metadata['label'] == tract_label, 'end2'].values[0]
+        out_paths = {
+            "end1": ospj(segmentation_dir, f"{tract_label}_end-{end1_label}.trk"),
+            "end2": ospj(segmentation_dir, f"{tract_label}_end-{end2_label}.trk"),
+            "core": ospj(segmentation_dir, f"{tract_label}_core.trk"),
+        }
+        if all(os.path.exists(out_path) for out_path in out_paths.values()) and not args.force:
+            print(f"---- Skipping {tract_label} because its segment .trk files already exist")
+            continue
+
+        trk, _, segments = load_segments(index_path, trk_path)
+        save_segment_trks(segments, out_paths, template, trk.space)
+        print(f"---- Exported {tract_label} segments to {segmentation_dir}")
+
+
+if __name__ == "__main__":
+    main()
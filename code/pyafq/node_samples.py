@@ -0,0 +1,141 @@
+'''
+Per-tract store of the node-wise scalar samples of every streamline (streamlines x nodes x measures), written by
+pyafq.py --save_node_samples so that streamline-level analyses do not need to reload the .trk files and scalar
+maps. Samples are kept in an HDF5 file in float16 or float32, chunked along streamlines and compressed, and are
+read lazily: only the chunks covering the requested streamlines and measures are decompressed
+
+Example:
+    with NodeSamples(path) as samples:
+        fa = samples.measure("fa")                     # (n_streamlines x n_nodes)
+        block = samples[:1000]                         # (1000 x n_nodes x n_measures)
+        profile = samples.profile("fa")                # Gaussian-weighted profile, as in {measure}_profile-pyafq.csv
+'''
+
+# Standard library imports
+import os
+
+# Third-party imports
+import numpy as np
+
+
+def save_node_samples(path, samples, measures, weights=None, streamline_index=None, dtype="float16",
+                      chunk_streamlines=1024, compression="gzip", attrs=None):
+    """
+    Writes node samples atomically (to a temporary file that is then renamed over path).
+    Args:
+        path: output .h5 path
+        samples: (n_streamlines x n_nodes x n_measures) sampled values
+        measures: measure labels (last axis of samples)
+        weights: (n_streamlines x n_nodes) node weights (e.g. Gaussian weights), stored as float32
+        streamline_index: index of every row in the bundle .trk file (e.g. when the bundle was subsampled)
+        dtype: storage dtype, 'float16' or 'float32'
+        chunk_streamlines: number of streamlines per compressed chunk
+        compression: h5py compression filter
+        attrs: extra attributes of the file (e.g. subject and tract labels)
+    """
+    import h5py
+
+    n_streamlines, n_nodes, n_measures = samples.shape
+    chunks = (max(1, min(chunk_streamlines, n_streamlines)), n_nodes, n_measures)
+    if streamline_index is None:
+        streamline_index = np.arange(n_streamlines)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.create_dataset("samples", data=samples.astype(dtype), chunks=chunks, compression=compression, shuffle=True)
+        if weights is not None:
+            f.create_dataset("weights", data=np.asarray(weights, dtype=np.float32), chunks=chunks[:2],
+                             compression=compression, shuffle=True)
+        f.create_dataset("streamline_index", data=np.asarray(streamline_index, dtype=np.int64))
+        f.attrs["measures"] = [str(measure) for measure in measures]
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
+    os.replace(tmp_path, path)
+
+
+class NodeSamples:
+    """
+    Lazy reader of a node sample store written by save_node_samples.
+    Args:
+        path: node sample .h5 file
+    """
+
+    def __init__(self, path):
+        import h5py
+
+        self.path = path
+        self.file = h5py.File(path, "r")
+        self.samples = self.file["samples"]
+        self.measures = [str(measure) for measure in self.file.attrs["measures"]]
+        self.n_streamlines, self.n_nodes, _ = self.samples.shape
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.n_streamlines
+
+    def __getitem__(self, key):
+        """
+        Reads a block of samples with h5py slicing, as float32 (e.g. samples[:1000] or samples[:, 40:60, 0]).
+        """
+        return np.asarray(self.samples[key], dtype=np.float32)
+
+    @property
+    def attrs(self):
+        return dict(self.file.attrs)
+
+    @property
+    def streamline_index(self):
+        return self.file["streamline_index"][:]
+
+    def weights(self, streamlines=slice(None)):
+        """
+        Stored node weights of a slice of streamlines, or None if the store has none.
+        """
+        if "weights" not in self.file:
+            return None
+        return self.file["weights"][streamlines]
+
+    def measure(self, measure, streamlines=slice(None)):
+        """
+        (n_streamlines x n_nodes) samples of one measure for a slice of streamlines.
+        """
+        return self[streamlines, :, self.measures.index(measure)]
+
+    def iter_chunks(self, measures=None):
+        """
+        Yields (streamline slice, (n x n_nodes x n_measures) samples) one storage chunk at a time.
+        Args:
+            measures: measure labels to read (default: all)
+        """
+        columns = slice(None) if measures is None else [self.measures.index(measure) for measure in measures]
+        chunk_streamlines = self.samples.chunks[0] if self.samples.chunks is not None else self.n_streamlines
+        for start in range(0, self.n_streamlines, chunk_streamlines):
+            streamlines = slice(start, min(start + chunk_streamlines, self.n_streamlines))
+            yield streamlines, self[streamlines][..., columns]
+
+    def profile(self, measure, weighted=True):
+        """
+        Profile of a measure recomputed from the stored samples, chunk by chunk.
+        Args:
+            measure: measure label
+            weighted: use the stored node weights (if any) instead of the plain mean
+        Returns:
+            (n_nodes,) profile
+        """
+        weighted = weighted and "weights" in self.file
+        total = np.zeros(self.n_nodes)
+        norm = np.zeros(self.n_nodes)
+        for streamlines, block in self.iter_chunks([measure]):
+            weights = self.weights(streamlines) if weighted else np.ones(block.shape[:2])
+            total += np.sum(weights * block[..., 0], axis=0)
+            norm += np.sum(weights, axis=0)
+        return total / norm
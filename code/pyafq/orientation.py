@@ -0,0 +1,65 @@
+'''
+Batched replacement of dipy.tracking.streamline.orient_by_streamline for pyafq.py. The bundle is resampled once
+into a single (n_streamlines x n_points x 3) float32 buffer that serves the orientation decision, the Gaussian
+weights and the profiles, and flipped streamlines are reversed with one gather over the whole point buffer
+'''
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from profiles import resample_streamlines
+from segments import make_array_sequence
+
+
+def flip_streamlines(streamlines, flip):
+    """
+    Copy of a bundle with the point order of the flagged streamlines reversed.
+    Args:
+        streamlines: ArraySequence / Streamlines
+        flip: (n_streamlines,) boolean array
+    Returns:
+        ArraySequence with its own compact buffer
+    """
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    new_offsets = np.cumsum(lengths) - lengths
+
+    # Position of every point within its streamline, counted from the start or, if flipped, from the end
+    node_index = np.arange(lengths.sum()) - np.repeat(new_offsets, lengths)
+    node_index = np.where(np.repeat(flip, lengths), np.repeat(lengths - 1, lengths) - node_index, node_index)
+    data = streamlines._data[np.repeat(offsets, lengths) + node_index]
+    return make_array_sequence(data, new_offsets, lengths)
+
+
+def orient_streamlines(streamlines, standard, n_points=100, orient_points=12):
+    """
+    Orients a bundle to a standard streamline as dts.orient_by_streamline does: a streamline is flipped when the
+    sum of pointwise distances between it and the standard, both resampled to orient_points, is smaller in
+    reverse order. When (n_points - 1) is a multiple of (orient_points - 1) the decision reuses every k-th node
+    of the n_points resampling instead of resampling the bundle a second time.
+    Args:
+        streamlines: ArraySequence / Streamlines
+        standard: (N x 3) standard streamline (e.g. the model centroid)
+        n_points: number of nodes of the returned resampled bundle
+        orient_points: number of points used for the orientation decision (dipy's default is 12)
+    Returns:
+        oriented: ArraySequence of the oriented streamlines
+        nodes: (n_streamlines x n_points x 3) float32 resampled oriented streamlines
+        flip: (n_streamlines,) boolean array of flipped streamlines
+    """
+    import dipy.tracking.streamline as dts
+
+    nodes = resample_streamlines(streamlines, n_points=n_points).astype(np.float32, copy=False)
+    if (n_points - 1) % (orient_points - 1) == 0:
+        orient_nodes = nodes[:, ::(n_points - 1) // (orient_points - 1)]
+    else:
+        orient_nodes = resample_streamlines(streamlines, n_points=orient_points).astype(np.float32, copy=False)
+    standard = dts.set_number_of_points([np.asarray(standard, dtype=np.float32)], nb_points=orient_points)[0]
+
+    direct = np.linalg.norm(orient_nodes - standard, axis=2).sum(axis=1)
+    flipped = np.linalg.norm(orient_nodes[:, ::-1] - standard, axis=2).sum(axis=1)
+    flip = direct > flipped
+
+    nodes[flip] = nodes[flip, ::-1]
+    return flip_streamlines(streamlines, flip), nodes, flip
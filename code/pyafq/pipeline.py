@@ -0,0 +1,148 @@
+'''
+Pipelined execution of the serial tract loop of pyafq.py (--pipeline). While one tract is computed, a thread
+pool reads the inputs of the next tracts (bundle .trk files and scalar maps) and another thread pool writes the
+outputs of the previous ones (.trk, .nii.gz, .csv, ...). File reads, gzip and zlib release the GIL, so network
+and disk I/O overlap with the computation. The time spent in each background stage, and the time the loop spent
+waiting for it, are recorded and summarized by pipeline_report
+'''
+
+# Standard library imports
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class Prefetcher:
+    """
+    Iterates over (key, load(key)) pairs, with the next keys loaded in background threads.
+    Args:
+        load: function of a key returning its inputs
+        keys: keys in the order they are consumed
+        depth: number of keys loaded ahead of the one being consumed (bounds the inputs held in memory)
+    """
+
+    def __init__(self, load, keys, depth=1):
+        self.load = load
+        self.keys = list(keys)
+        self.depth = depth
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, depth), thread_name_prefix="prefetch")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _timed_load(self, key):
+        start = time.perf_counter()
+        try:
+            return self.load(key)
+        finally:
+            with self._lock:
+                self.busy_seconds += time.perf_counter() - start
+
+    def __iter__(self):
+        n_submitted = 0
+        for position, key in enumerate(self.keys):
+            while n_submitted < len(self.keys) and n_submitted <= position + self.depth:
+                self._futures[n_submitted] = self._executor.submit(self._timed_load, self.keys[n_submitted])
+                n_submitted += 1
+            start = time.perf_counter()
+            inputs = self._futures.pop(position).result()
+            self.wait_seconds += time.perf_counter() - start
+            yield key, inputs
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class BackgroundWriter:
+    """
+    Runs output writes in background threads. At most max_pending writes are queued; submitting another one waits
+    for the oldest, which bounds the memory held by pending outputs. An error raised by a write is re-raised in the
+    caller at a later submit() or at close().
+    Args:
+        max_workers: number of writer threads
+        max_pending: maximum number of queued or running writes
+    """
+
+    def __init__(self, max_workers=1, max_pending=16):
+        self.max_pending = max_pending
+        self.n_writes = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="write")
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def _timed_write(self, fn, args, kwargs):
+        start = time.perf_counter()
+        try:
+            fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.busy_seconds += time.perf_counter() - start
+
+    def _wait_oldest(self):
+        start = time.perf_counter()
+        future = self._pending.popleft()
+        try:
+            future.result()
+        finally:
+            self.wait_seconds += time.perf_counter() - start
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs). The arguments must not be modified by the caller afterwards.
+        """
+        while self._pending and (self._pending[0].done() or len(self._pending) >= self.max_pending):
+            self._wait_oldest()
+        self._pending.append(self._executor.submit(self._timed_write, fn, args, kwargs))
+        self.n_writes += 1
+
+    def close(self):
+        """
+        Waits for every queued write, then re-raises the first error if any write failed.
+        """
+        try:
+            while self._pending:
+                self._wait_oldest()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def pipeline_report(wall_seconds, n_tracts, prefetcher, writer):
+    """
+    Summarizes a pipelined run. Background time the loop did not wait for was overlapped with the computation.
+    Threads competing for the same cores slow each other down, so the background times are not what a serial run
+    would spend on I/O; compare tracts_per_minute with a run without --pipeline to measure the gain.
+    Args:
+        wall_seconds: duration of the tract loop
+        n_tracts: number of tracts iterated over
+        prefetcher, writer: the Prefetcher and BackgroundWriter of the run
+    Returns:
+        Dictionary of timings (s), the fraction of background time overlapped and the throughput
+    """
+    background_seconds = prefetcher.busy_seconds + writer.busy_seconds
+    wait_seconds = prefetcher.wait_seconds + writer.wait_seconds
+    overlapped_seconds = max(0.0, background_seconds - wait_seconds)
+    return {
+        "n_tracts": n_tracts,
+        "n_writes": writer.n_writes,
+        "wall_seconds": wall_seconds,
+        "compute_seconds": max(0.0, wall_seconds - wait_seconds),
+        "read_seconds": prefetcher.busy_seconds,
+        "read_wait_seconds": prefetcher.wait_seconds,
+        "write_seconds": writer.busy_seconds,
+        "write_wait_seconds": writer.wait_seconds,
+        "overlapped_seconds": overlapped_seconds,
+        "overlap": overlapped_seconds / background_seconds if background_seconds > 0 else 0.0,
+        "tracts_per_minute": 60 * n_tracts / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+
+
+def format_report(report):
+    return (f"Pipeline: {report['n_tracts']} tracts in {report['wall_seconds']:.1f} s "
+            f"({report['tracts_per_minute']:.1f} tracts/min), {report['compute_seconds']:.1f} s computing; "
+            f"reads {report['read_seconds']:.1f} s (waited {report['read_wait_seconds']:.1f} s), "
+            f"{report['n_writes']} writes {report['write_seconds']:.1f} s (waited {report['write_wait_seconds']:.1f} s); "
+            f"{100 * report['overlap']:.0f}% of background I/O overlapped with computing")
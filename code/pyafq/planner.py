@@ -0,0 +1,127 @@
+'''
+Incremental planning for pyafq.py. Works out, from file modification times, which outputs of a tract
+(segmentation .trk files, density .nii.gz files, Gaussian weights and per-measure profiles) are missing or
+older than the inputs they are derived from, so that only those are recomputed. Model centroids are compared by
+content instead (see centroids.centroid_record_matches): when they change, the new ones are recorded and the
+record is an input of every output of the tract, so that no output made with the old centroids is ever mixed
+with new ones
+'''
+
+# Standard library imports
+import os
+
+
+def get_mtime(path):
+    """
+    Modification time of a file, or None if it does not exist.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def needs_update(output_paths, input_paths, output_mtimes=()):
+    """
+    Checks whether a set of outputs has to be (re)computed.
+    Args:
+        output_paths: paths of files produced together
+        input_paths: paths of the files they are derived from (missing inputs are ignored)
+        output_mtimes: times at which further outputs were produced (e.g. profile store entries), None if missing
+    Returns:
+        True if any output is missing or older than the newest input
+    """
+    output_mtimes = [get_mtime(path) for path in output_paths] + list(output_mtimes)
+    if any(mtime is None for mtime in output_mtimes):
+        return True
+    input_mtimes = [mtime for mtime in map(get_mtime, input_paths) if mtime is not None]
+    return len(input_mtimes) > 0 and min(output_mtimes) < max(input_mtimes)
+
+
+def plan_tract(paths, scalar_paths, measures, centroids_changed=False, profile_format="csv", profile_store=None, tract_label=None,
+               render_qc=False, segment_trk=False, subsample_path=None, bootstrap=False, node_samples_path=None):
+    """
+    Lists the outputs of a tract that are missing or stale.
+    Args:
+        paths: dictionary of tract paths (see get_tract_paths in pyafq.py); the profiles of every weighting scheme in
+            paths["weighting_csv_paths"] are outputs of their measure, and paths["profile_store_keys"] are the labels
+            of the measures in the profile store
+        scalar_paths: dictionary mapping measure label -> scalar map path
+        measures: measure labels to profile
+        centroids_changed: whether the tract's outputs were made with other model centroids than the current ones
+            (or are not known to have been made with them); all outputs are then planned. Otherwise the centroid
+            record (paths["centroid_record_path"]) is an input of every output
+        profile_format: where weights and profiles are written, 'csv', 'store' or 'both'
+        profile_store: the subject's ProfileStore, required unless profile_format is 'csv'
+        tract_label: label of the tract in the profile store
+        render_qc: whether the orientation QC image is one of the outputs
+        segment_trk: whether the end1/core/end2 .trk files are outputs (the segment index always is)
+        subsample_path: record of the streamlines kept for profiling (see subsample.py), if the bundle is capped;
+            all profiles are recomputed when it is missing or stale. Capped profiles have their own paths and store
+            keys for every cap, so a run with another cap or without one never takes them for its own
+        bootstrap: whether the bootstrap confidence bands of the profiles are outputs
+        node_samples_path: node sample store of the tract (see node_samples.py), if it is an output; it holds every
+            measure, so all profiles are recomputed when it or any one of them is missing or stale
+    Returns:
+        Dictionary with booleans "centroids_changed", "segmentation_index", "segmentation_trk", "segmentation_nii",
+        "weights" and "qc", and the list of "measures" whose profiles need computing
+    """
+    if centroids_changed:
+        return {
+            "centroids_changed": True,
+            "segmentation_index": True,
+            "segmentation_trk": segment_trk,
+            "segmentation_nii": True,
+            "weights": True,
+            "qc": render_qc,
+            "measures": list(measures),
+        }
+
+    bundle_inputs = [paths["trk_path"], paths["centroid_record_path"]]
+    segments = ["end1", "end2", "core"]
+
+    def needs_profile_update(csv_path, store_key, input_paths):
+        csv_paths = [csv_path] if profile_format in ["csv", "both"] else []
+        store_mtimes = [profile_store.get_computed_at(tract_label, store_key)] if profile_format in ["store", "both"] else []
+        return needs_update(csv_paths, input_paths, output_mtimes=store_mtimes)
+
+    subsample_stale = subsample_path is not None and needs_update([subsample_path], bundle_inputs)
+
+    def needs_measure_update(measure):
+        input_paths = bundle_inputs + [scalar_paths[measure]]
+        store_key = paths["profile_store_keys"][measure]
+        return (subsample_stale
+                or needs_profile_update(paths["profile_csv_paths"][measure], store_key, input_paths)
+                or any(needs_profile_update(csv_paths[measure], f"{store_key}_weight-{weighting}", input_paths)
+                       for weighting, csv_paths in paths.get("weighting_csv_paths", {}).items())
+                or (bootstrap and needs_update([paths["profile_ci_csv_paths"][measure]], input_paths)))
+
+    pending_measures = [measure for measure in measures if needs_measure_update(measure)]
+    if node_samples_path is not None and (pending_measures or needs_update([node_samples_path], bundle_inputs + [scalar_paths[measure] for measure in measures])):
+        pending_measures = list(measures)
+
+    return {
+        "centroids_changed": False,
+        "segmentation_index": needs_update([paths["segment_index_path"]], bundle_inputs),
+        "segmentation_trk": segment_trk and needs_update([paths[f"{segment}_trk_path"] for segment in segments], bundle_inputs),
+        "segmentation_nii": needs_update([paths[f"{segment}_nii_path"] for segment in segments], bundle_inputs),
+        "weights": needs_profile_update(paths["weights_csv_path"], "weights", bundle_inputs),
+        "qc": render_qc and needs_update([paths["qc_png_path"]], bundle_inputs),
+        "measures": pending_measures,
+    }
+
+
+def is_up_to_date(plan):
+    return not (plan["segmentation_index"] or plan["segmentation_trk"] or plan["segmentation_nii"] or plan["weights"] or plan["qc"] or plan["measures"])
+
+
+def describe_plan(plan):
+    """
+    One-line summary of the outputs a plan will compute.
+    """
+    todo = [artifact for artifact in ["segmentation_index", "segmentation_trk", "segmentation_nii", "weights", "qc"] if plan[artifact]]
+    if plan["measures"]:
+        todo.append(f"profiles ({', '.join(plan['measures'])})")
+    if plan["centroids_changed"]:
+        return f"{', '.join(todo)} (model centroids changed)"
+    return ", ".join(todo) if todo else "nothing"
@@ -0,0 +1,142 @@
+'''
+Per-subject profile store for pyafq.py. Holds every tract profile of a subject in one compact .npz
+(tracts x measures x nodes array, per-streamline Gaussian weights and streamline counts) instead of one
+{measure}_profile-pyafq.csv per tract and measure
+'''
+
+# Standard library imports
+import os
+from os.path import join as ospj
+
+# Third-party imports
+import numpy as np
+
+
+def get_profile_store_path(pyafq_dir, group, sub, atlas_label):
+    """
+    Path of a subject's profile store (next to its per-tract output directories).
+    """
+    return ospj(pyafq_dir, group, sub, atlas_label, f"{sub}_atlas-{atlas_label}_profiles-pyafq.npz")
+
+
+class ProfileStore:
+    """
+    Profiles, weights and streamline counts of one subject, keyed by tract and measure.
+    Every entry records when it was computed so the planner can tell whether it is stale.
+    Args:
+        n_points: number of nodes per profile
+    """
+
+    def __init__(self, n_points=100):
+        self.n_points = n_points
+        self.profiles = {}
+        self.weights = {}
+        self.n_streamlines = {}
+        self.computed_at = {}
+
+    @classmethod
+    def load(cls, path, n_points=100):
+        """
+        Loads a store saved with save(); a missing file gives an empty store.
+        """
+        store = cls(n_points)
+        if not os.path.exists(path):
+            return store
+
+        with np.load(path) as npz:
+            tracts = npz["tracts"].tolist()
+            measures = npz["measures"].tolist()
+            profiles = npz["profiles"]
+            profiles_computed_at = npz["profiles_computed_at"]
+            weights = npz["weights"]
+            weights_offsets = npz["weights_offsets"]
+            weights_computed_at = npz["weights_computed_at"]
+            n_streamlines = npz["n_streamlines"]
+        store.n_points = profiles.shape[-1]
+
+        for i, tract in enumerate(tracts):
+            for j, measure in enumerate(measures):
+                if not np.isnan(profiles_computed_at[i, j]):
+                    store.profiles[(tract, measure)] = profiles[i, j]
+                    store.computed_at[(tract, measure)] = profiles_computed_at[i, j]
+            if not np.isnan(weights_computed_at[i]):
+                store.weights[tract] = weights[weights_offsets[i]:weights_offsets[i + 1]]
+                store.n_streamlines[tract] = int(n_streamlines[i])
+                store.computed_at[(tract, "weights")] = weights_computed_at[i]
+        return store
+
+    def get_computed_at(self, tract, key):
+        """
+        Time at which a profile (key = measure) or the weights (key = "weights") of a tract were computed, or None.
+        """
+        return self.computed_at.get((tract, key))
+
+    def set_profiles(self, tract, measures, profiles, computed_at):
+        for measure, profile in zip(measures, profiles):
+            self.profiles[(tract, measure)] = np.asarray(profile, dtype=float)
+            self.computed_at[(tract, measure)] = computed_at
+
+    def set_weights(self, tract, streamline_weights, computed_at):
+        self.weights[tract] = np.asarray(streamline_weights, dtype=float)
+        self.n_streamlines[tract] = len(streamline_weights)
+        self.computed_at[(tract, "weights")] = computed_at
+
+    def save(self, path):
+        """
+        Packs the store into dense arrays (NaN where a tract/measure has not been computed) and writes it
+        atomically, so that readers never see a partially written file.
+        """
+        tracts = sorted(set(tract for tract, _ in self.profiles) | set(self.weights))
+        measures = sorted(set(measure for _, measure in self.profiles))
+        tract_index = {tract: i for i, tract in enumerate(tracts)}
+        measure_index = {measure: j for j, measure in enumerate(measures)}
+
+        profiles = np.full((len(tracts), len(measures), self.n_points), np.nan)
+        profiles_computed_at = np.full((len(tracts), len(measures)), np.nan)
+        for (tract, measure), profile in self.profiles.items():
+            profiles[tract_index[tract], measure_index[measure]] = profile
+            profiles_computed_at[tract_index[tract], measure_index[measure]] = self.computed_at[(tract, measure)]
+
+        # Weights are ragged (one value per streamline), so they are concatenated with per-tract offsets
+        n_streamlines = np.array([self.n_streamlines.get(tract, 0) for tract in tracts], dtype=np.int64)
+        weights_offsets = np.concatenate(([0], np.cumsum(n_streamlines)))
+        weights = np.concatenate([self.weights.get(tract, np.empty(0)) for tract in tracts]) if tracts else np.empty(0)
+        weights_computed_at = np.array([self.computed_at.get((tract, "weights"), np.nan) for tract in tracts])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path,
+                            tracts=np.array(tracts, dtype=str),
+                            measures=np.array(measures, dtype=str),
+                            profiles=profiles,
+                            profiles_computed_at=profiles_computed_at,
+                            weights=weights,
+                            weights_offsets=weights_offsets,
+                            weights_computed_at=weights_computed_at,
+                            n_streamlines=n_streamlines)
+        os.replace(tmp_path, path)
+
+
+def load_profiles(path, tracts=None, measures=None):
+    """
+    Reads a block of profiles from a subject's store without building a ProfileStore.
+    Args:
+        path: profile store .npz
+        tracts: tract labels to read (default: all)
+        measures: measure labels to read (default: all)
+    Returns:
+        (tracts x measures x nodes) array, NaN where a profile is missing, and the tract and measure labels
+    """
+    with np.load(path) as npz:
+        store_tracts = npz["tracts"].tolist()
+        store_measures = npz["measures"].tolist()
+        profiles = npz["profiles"]
+
+    tracts = store_tracts if tracts is None else list(tracts)
+    measures = store_measures if measures is None else list(measures)
+    block = np.full((len(tracts), len(measures), profiles.shape[-1]), np.nan)
+    for i, tract in enumerate(tracts):
+        for j, measure in enumerate(measures):
+            if tract in store_tracts and measure in store_measures:
+                block[i, j] = profiles[store_tracts.index(tract), store_measures.index(measure)]
+    return block, tracts, measures
@@ -0,0 +1,289 @@
+'''
+Vectorized tract profiling helpers for pyafq.py. These reproduce dipy.stats.analysis.afq_profile while sampling
+every scalar measure in a single pass over the bundle's node coordinates
+'''
+
+# Third-party imports
+import numpy as np
+
+
+def resample_streamlines(streamlines, n_points=100):
+    """
+    Resamples every streamline to the same number of points.
+    Args:
+        streamlines: Streamlines / list of (N_i x 3) arrays
+        n_points: number of nodes per streamline
+    Returns:
+        (n_streamlines x n_points x 3) array
+    """
+    import dipy.tracking.streamline as dts
+
+    resampled = dts.set_number_of_points(streamlines, nb_points=n_points)
+    if hasattr(resampled, "_data"):
+        return resampled._data.reshape(len(resampled), n_points, 3)
+    return np.asarray(resampled)
+
+
+def trilinear_indices(coords, shape):
+    """
+    Flat voxel indices and trilinear weights of the 8 voxels surrounding each coordinate.
+    Corners that fall outside the volume get zero weight, matching dipy's interpolate_scalar_3d.
+    Args:
+        coords: (P x 3) voxel coordinates
+        shape: spatial shape of the volume
+    Returns:
+        indices: (P x 8) flat voxel indices
+        weights: (P x 8) interpolation weights
+    """
+    base = np.floor(coords)
+    frac = coords - base
+    base = base.astype(np.intp)
+
+    # Per-axis lower/upper voxel indices and weights; voxels outside the volume contribute nothing
+    axis_indices = []
+    axis_weights = []
+    for axis in range(3):
+        index = np.stack([base[:, axis], base[:, axis] + 1], axis=1)
+        weight = np.stack([1 - frac[:, axis], frac[:, axis]], axis=1)
+        outside = (index < 0) | (index >= shape[axis])
+        weight[outside] = 0
+        index[outside] = 0
+        axis_indices.append(index)
+        axis_weights.append(weight)
+
+    # Outer products over the three axes give the 8 corners of the voxel cube
+    strides = (shape[1] * shape[2], shape[2], 1)
+    indices = (axis_indices[0][:, :, None, None] * strides[0]
+               + axis_indices[1][:, None, :, None] * strides[1]
+               + axis_indices[2][:, None, None, :] * strides[2])
+    weights = axis_weights[0][:, :, None, None] * axis_weights[1][:, None, :, None] * axis_weights[2][:, None, None, :]
+    return indices.reshape(-1, 8), weights.reshape(-1, 8)
+
+
+def voxel_coords(nodes, affine):
+    """
+    Voxel coordinates of the nodes of a resampled bundle, rounded to the precision of the streamlines as
+    dipy.tracking.streamline.transform_streamlines does.
+    Args:
+        nodes: (n_streamlines x n_points x 3) node coordinates in world (RAS mm) space
+        affine: voxel-to-world affine of the scalar maps
+    Returns:
+        (n_streamlines * n_points x 3) float64 voxel coordinates
+    """
+    inv_affine = np.linalg.inv(affine)
+    return (nodes.reshape(-1, 3) @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(nodes.dtype).astype(float)
+
+
+def get_bounding_box(nodes, affine, shape, margin=1):
+    """
+    Smallest voxel box of a scalar grid holding every voxel that trilinear interpolation at the nodes reads
+    (plus a margin), clipped to the grid.
+    Args:
+        nodes: (n_streamlines x n_points x 3) node coordinates in world (RAS mm) space
+        affine: voxel-to-world affine of the scalar maps
+        shape: spatial shape of the scalar maps
+        margin: number of extra voxels on every side
+    Returns:
+        Tuple of three slices
+    """
+    coords = voxel_coords(nodes, affine)
+    shape = np.asarray(shape[:3])
+    start = np.clip(np.floor(coords.min(axis=0)).astype(np.intp) - margin, 0, shape)
+    stop = np.clip(np.floor(coords.max(axis=0)).astype(np.intp) + 2 + margin, 0, shape)
+    return tuple(slice(int(a), int(max(a, b))) for a, b in zip(start, stop))
+
+
+def sample_nodes(scalars, nodes, affine, chunk_size=2**16, origin=None):
+    """
+    Interpolates a stack of scalar maps at the node coordinates of a resampled bundle.
+    Args:
+        scalars: (X x Y x Z x M) stacked scalar maps, or a single (X x Y x Z) map
+        nodes: (n_streamlines x n_points x 3) node coordinates in world (RAS mm) space
+        affine: voxel-to-world affine of the scalar maps
+        chunk_size: number of nodes interpolated at a time (bounds the size of the gather buffers)
+        origin: if scalars is a box cropped from the maps (see get_bounding_box), the voxel index of its first
+                voxel; coordinates are shifted into the box after the mapping, so the samples are unchanged
+    Returns:
+        (n_streamlines x n_points x M) array of sampled values
+    """
+    if scalars.ndim == 3:
+        scalars = scalars[..., None]
+    n_streamlines, n_points, _ = nodes.shape
+
+    # Node coordinates are mapped into voxel space once for every measure
+    coords = voxel_coords(nodes, affine)
+    if origin is not None:
+        coords -= np.asarray(origin)
+
+    flat = scalars.reshape(-1, scalars.shape[-1])
+    values = np.empty((len(coords), flat.shape[1]))
+    for start in range(0, len(coords), chunk_size):
+        stop = start + chunk_size
+        indices, weights = trilinear_indices(coords[start:stop], scalars.shape)
+        values[start:stop] = np.einsum("pc,pcm->pm", weights, flat[indices])
+    return values.reshape(n_streamlines, n_points, -1)
+
+
+def weighted_profiles(samples, weights=None):
+    """
+    Weighted average of node samples across streamlines (np.average semantics, as in dsa.afq_profile).
+    Args:
+        samples: (n_streamlines x n_points x M) sampled values
+        weights: (n_streamlines x n_points) weights, or None for the unweighted mean
+    Returns:
+        (M x n_points) profile matrix
+    """
+    if weights is None:
+        return samples.mean(axis=0).T
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim == 1:
+        weights = np.broadcast_to(weights[:, None], samples.shape[:2])
+    return np.einsum("sn,snm->mn", weights, samples) / weights.sum(axis=0)
+
+
+def bootstrap_profiles(samples, weights=None, n_bootstrap=1000, confidence=0.95, seed=0, chunk_size=100):
+    """
+    Node-wise bootstrap confidence bands of the weighted profiles. Every replicate redraws the streamlines with
+    replacement; drawing n streamlines with replacement is a multinomial count per streamline, so a block of
+    replicates is the (replicates x streamlines) count matrix times the weighted node samples, one matrix product
+    instead of one profile computation per replicate. The weights are the full-bundle weights of the drawn
+    streamlines (they are not recomputed for each replicate).
+    Args:
+        samples: (n_streamlines x n_points x M) sampled values (see sample_nodes)
+        weights: (n_streamlines x n_points) weights, or None for the unweighted mean
+        n_bootstrap: number of replicates
+        confidence: coverage of the percentile interval
+        seed: random seed
+        chunk_size: number of replicates computed at a time (bounds the size of the count matrix)
+    Returns:
+        lower, upper: (M x n_points) percentile confidence bounds
+        se: (M x n_points) bootstrap standard error
+    """
+    n_streamlines, n_points, n_measures = samples.shape
+    if weights is None:
+        weights = np.ones((n_streamlines, n_points))
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim == 1:
+        weights = np.broadcast_to(weights[:, None], (n_streamlines, n_points))
+    weighted_samples = (weights[:, :, None] * samples).reshape(n_streamlines, -1)
+
+    rng = np.random.default_rng(seed)
+    replicates = np.empty((n_bootstrap, n_points, n_measures))
+    for start in range(0, n_bootstrap, chunk_size):
+        stop = min(start + chunk_size, n_bootstrap)
+        counts = rng.multinomial(n_streamlines, np.full(n_streamlines, 1 / n_streamlines), size=stop - start).astype(float)
+        replicates[start:stop] = (counts @ weighted_samples).reshape(-1, n_points, n_measures) / (counts @ weights)[:, :, None]
+
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(replicates, [alpha, 1 - alpha], axis=0)
+    return lower.T, upper.T, replicates.std(axis=0, ddof=1).T
+
+
+def gaussian_weights(nodes):
+    """
+    Batched equivalent of dsa.gaussian_weights: every node's weight is the inverse of its Mahalanobis distance
+    from the mean of that node across streamlines, normalized to sum to 1 at each node. The covariances of all
+    nodes are computed and inverted at once, in float64 as dipy does, so that the weights match dipy's to
+    rounding error.
+    Args:
+        nodes: (n_streamlines x n_points x 3) resampled oriented streamlines (see orientation.orient_streamlines)
+    Returns:
+        (n_streamlines x n_points) weights
+    """
+    n_streamlines, n_points, _ = nodes.shape
+
+    # A single streamline gets the entire weighting
+    if n_streamlines == 1:
+        return np.ones((1, n_points))
+
+    # As in dipy, the covariance is computed in float64 (np.cov), while the offsets from the node means are taken in
+    # the precision of the nodes (np.mean and scipy's mahalanobis keep it)
+    nodes64 = nodes.astype(np.float64)
+    centred = (nodes64 - nodes64.mean(axis=0)).transpose(1, 0, 2)
+    cov = np.matmul(centred.transpose(0, 2, 1), centred) / n_streamlines
+    delta = (nodes - nodes.mean(axis=0)).astype(np.float64)
+
+    # dipy inverts the upper triangle of each covariance matrix (not the symmetric matrix), which is kept here so
+    # that the weights match. Nodes where all streamlines coincide get equal weights
+    cov = np.triu(cov)
+    degenerate = np.all(np.isclose(cov, 0), axis=(1, 2))
+    cov[degenerate] = np.eye(3)
+    inv_cov = np.linalg.inv(cov)
+
+    distance = np.sqrt(np.einsum("sni,nij,snj->sn", delta, inv_cov, delta, optimize=True))
+    distance[:, degenerate] = n_streamlines
+    weights = 1 / distance
+    return weights / weights.sum(axis=0)
+
+
+def density_weights(nodes, affine, shape, origin=None):
+    """
+    Node weights proportional to the streamline density of the bundle at each node: the number of streamlines
+    with a node in the same voxel of the scalar grid, each streamline counted once per voxel.
+    Args:
+        nodes: (n_streamlines x n_points x 3) node coordinates in world (RAS mm) space
+        affine: voxel-to-world affine of the scalar maps
+        shape: spatial shape of the scalar maps
+        origin: voxel index of the first voxel, if shape is that of a cropped box (see sample_nodes)
+    Returns:
+        (n_streamlines x n_points) weights
+    """
+    n_streamlines, n_points, _ = nodes.shape
+    n_voxels = int(np.prod(shape[:3]))
+    inv_affine = np.linalg.inv(affine)
+    inds = np.round(nodes.reshape(-1, 3) @ inv_affine[:3, :3].T + inv_affine[:3, 3]).astype(np.intp)
+    if origin is not None:
+        inds -= np.asarray(origin, dtype=np.intp)
+    inds = np.clip(inds, 0, np.asarray(shape[:3]) - 1)
+    voxels = np.ravel_multi_index(inds.T, shape[:3]).reshape(n_streamlines, n_points)
+
+    # Unique (streamline, voxel) pairs by sorting their keys, then the number of streamlines per voxel
+    keys = np.sort((np.arange(n_streamlines, dtype=np.int64)[:, None] * n_voxels + voxels).ravel())
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    counts = np.bincount(keys % n_voxels, minlength=n_voxels)
+    return counts[voxels].astype(float)
+
+
+def weighting_profiles(samples, weightings, weights=None):
+    """
+    Profiles of several weighting schemes from the same node samples.
+    Args:
+        samples: (n_streamlines x n_points x M) sampled values (see sample_nodes)
+        weightings: scheme labels, 'uniform' (plain mean), 'median' (node-wise median) or a key of weights
+        weights: dictionary mapping scheme label -> (n_streamlines x n_points) weights (e.g. 'gaussian', 'density')
+    Returns:
+        Dictionary mapping scheme label -> (M x n_points) profile matrix
+    """
+    profiles = {}
+    for weighting in weightings:
+        if weighting == "uniform":
+            profiles[weighting] = weighted_profiles(samples)
+        elif weighting == "median":
+            profiles[weighting] = np.median(samples, axis=0).T
+        else:
+            profiles[weighting] = weighted_profiles(samples, weights[weighting])
+    return profiles
+
+
+def afq_profiles(scalars, streamlines, affine, weights=None, n_points=100, nodes=None, origin=None):
+    """
+    Multi-measure equivalent of dsa.afq_profile: resamples and maps the oriented streamlines to voxel
+    coordinates once, then interpolates and averages every measure in one vectorized call.
+    Args:
+        scalars: (X x Y x Z x M) stacked scalar maps
+        streamlines: oriented streamlines (see dts.orient_by_streamline)
+        affine: voxel-to-world affine of the scalar maps
+        weights: (n_streamlines x n_points) weights, e.g. from dsa.gaussian_weights
+        n_points: number of nodes per profile
+        nodes: (n_streamlines x n_points x 3) already resampled streamlines (see orientation.orient_streamlines),
+               used in place of resampling the streamlines again
+        origin: voxel index of the first voxel, if scalars is a cropped box (see sample_nodes)
+    Returns:
+        (M x n_points) profile matrix, one row per measure in the order of the last axis of scalars
+    """
+    if len(streamlines) == 0:
+        raise ValueError("The bundle contains no streamlines")
+    if nodes is None:
+        nodes = resample_streamlines(streamlines, n_points=n_points)
+    samples = sample_nodes(scalars, nodes, affine, origin=origin)
+    return weighted_profiles(samples, weights)
@@ -1,38 +1,87 @@
 # Standard library imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import os
 from os.path import join as ospj
-import sys
 import json
+import threading
+import time
 
 # Third-party imports
-import matplotlib.pyplot as plt
-from matplotlib.cm import tab20
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
-# DIPY imports
-import dipy.data as dpd
-import dipy.stats.analysis as dsa
-import dipy.tracking.streamline as dts
-from dipy.data.fetcher import get_two_hcp842_bundles
-from dipy.io.stateful_tractogram import StatefulTractogram
-from dipy.io.image import load_nifti
-from dipy.io.streamline import load_trk, save_tractogram
-from dipy.io.utils import create_nifti_header, get_reference_info
-from dipy.segment.clustering import QuickBundles
-from dipy.segment.featurespeed import ResampleFeature
-from dipy.segment.metricspeed import AveragePointwiseEuclideanMetric
-from dipy.tracking.utils import density_map
-from dipy.tracking.streamline import set_number_of_points, transform_streamlines
-from dipy.viz import window, actor, colormap
-
-# FURY imports
-# from fury import actor, window
-# from fury.colormap import create_colormap
-
-sub = sys.argv[1]
-group = sys.argv[2]
+# DIPY imports are deferred to the functions that use them (importing dipy takes longer than planning a whole
+# subject), so that --dry_run and subjects whose outputs are all up to date never pay for them
+
+# Local imports
+from centroids import centroid_record_matches, get_centroid_path, get_homolog, load_oriented_centroid, save_centroid_record
+from density import DensityMaps
+from node_samples import save_node_samples
+from planner import describe_plan, is_up_to_date, plan_tract
+from profile_store import ProfileStore, get_profile_store_path
+from orientation import orient_streamlines
+from pipeline import BackgroundWriter, Prefetcher, format_report, pipeline_report
+from profiles import (afq_profiles, bootstrap_profiles, density_weights, gaussian_weights, get_bounding_box, sample_nodes,
+                      weighted_profiles, weighting_profiles)
+from render_qc import get_view, render_orientation
+from scalars import ScalarCache, attach_array, get_scalar_paths, resolve_scalar_paths, share_scalar_stack
+from segment_index import save_segment_index
+from segments import split_streamlines
+from subsample import profile_deviation, stratified_subsample
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Segment and profile HCP1065 bundles for one subject.")
+    parser.add_argument("sub", help="Subject label (e.g. sub-RID0505)")
+    parser.add_argument("group", choices=["hcpaging", "hcpya", "penn_controls", "penn_epilepsy"], help="Subject group")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to spread tracts across; scalar maps are shared read-only between them")
+    parser.add_argument("--scalar_cache_gb", type=float, default=4,
+                        help="Memory budget (GB) for scalar maps held across tracts")
+    parser.add_argument("--profile_format", choices=["csv", "store", "both"], default="csv",
+                        help="Write weights and profiles as per-tract .csv files, to a single per-subject .npz store, or both")
+    parser.add_argument("--render_qc", action="store_true",
+                        help="Render a headless image of the node order of each reoriented bundle (see render_qc.py)")
+    parser.add_argument("--centroid_method", choices=["mean", "quickbundles"], default="mean",
+                        help="How model centroids are computed when not cached: vectorized mean of the oriented model streamlines, or QuickBundles")
+    parser.add_argument("--centroid_max_streamlines", type=int, default=None,
+                        help="Compute model centroids from a random subset of at most this many model streamlines (mean method only)")
+    parser.add_argument("--max_streamlines", type=int, default=None,
+                        help="Profile each bundle from at most this many streamlines, drawn by spatially stratified subsampling (see subsample.py); "
+                             "capped profiles are written as {measure}_profile-pyafq_desc-cap{N}.csv, apart from the full-bundle profiles")
+    parser.add_argument("--subsample_report", action="store_true",
+                        help="With --max_streamlines, also profile the full bundle and report how much the capped profiles deviate from it")
+    parser.add_argument("--profile_weightings", nargs="+", choices=["uniform", "density", "median"], default=[],
+                        help="Additional profiles computed from the same node samples as the Gaussian-weighted profile: "
+                             "unweighted mean, streamline density-weighted mean and node-wise median")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap replicates (resampling streamlines) for node-wise profile confidence bands (0: no bands)")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="Coverage of the bootstrap confidence bands")
+    parser.add_argument("--save_node_samples", choices=["float16", "float32"], default=None,
+                        help="Also save the node-wise samples of every streamline and measure to a compressed per-tract .h5 store in this precision (see node_samples.py)")
+    parser.add_argument("--segment_trk", action="store_true",
+                        help="Also write the end1/core/end2 segments as .trk files (they are otherwise only stored as a "
+                             "per-streamline index, see segment_index.py and export_segments.py)")
+    parser.add_argument("--crop_scalars", action="store_true",
+                        help="Read only the box of the scalar maps covering each bundle instead of whole maps, so memory "
+                             "scales with the bundle rather than the head (scalar maps are then neither cached nor shared "
+                             "between workers)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Without --workers, read the next tracts' inputs and write the previous tracts' outputs in "
+                             "background threads while the current tract is computed, and report the overlap (see pipeline.py)")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="With --pipeline, number of tracts whose inputs are read ahead")
+    parser.add_argument("--write_threads", type=int, default=1,
+                        help="With --pipeline, number of threads writing outputs")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only print which outputs of each tract are missing or stale, without computing them")
+    return parser
+
+args = build_arg_parser().parse_args()
+sub = args.sub
+group = args.group
 
 # Define input directories
 atlas_label = "HCP1065"
@@ -43,6 +92,7 @@ metadata_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/met
 hcpya_raw_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/hcpya/hcp1200/HCP1200"
 qsiprep_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsiprep/{group}"
 qsirecon_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon/{group}"
+mirror_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/qsirecon_mirror/{group}"
 bundleseg_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg/{group}"
 bundleseg_config_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/code/bundleseg/config"
 template = "/mnt/sauce/littlab/users/mjaskir/software/neuromaps-data/atlases/MNI152/tpl-MNI152NLin2009cAsym_res-1mm_T1w.nii.gz"
@@ -53,13 +103,12 @@ if group == "penn_controls" or group == "penn_epilepsy":
     ses = [d for d in os.listdir(f"{qsiprep_group_dir}/{sub}") if d.startswith("ses-")][0]
 elif group == "hcpaging":
     ref_t1w_nii = ospj(qsiprep_group_dir, f"{sub}/anat/{sub}_space-ACPC_desc-preproc_T1w.nii.gz")
+    ses = None
 elif group == "hcpya":
+    ses = None
     hcp_id = sub.split("-")[1]
     ref_t1w_nii = ospj(hcpya_raw_dir, f"{hcp_id}/T1w/T1w_acpc_dc_restore.nii.gz")
 ref_t1w = nib.load(ref_t1w_nii)
-t1w = ref_t1w.get_fdata()
-acpc_affine, acpc_dimensions, acpc_voxel_sizes, acpc_voxel_order = get_reference_info(ref_t1w)
-acpc_nifti_header = create_nifti_header(acpc_affine, acpc_dimensions, acpc_voxel_sizes)
 
 # Load in tract metadata
 tract_metadata = pd.read_csv(ospj(atlas_dir, f"{atlas_label}_tract_metadata.csv"))
@@ -67,6 +116,24 @@ tract_metadata = pd.read_csv(ospj(atlas_dir, f"{atlas_label}_tract_metadata.csv"
 # Load in list of diffusion MRI scalars from .json file (they are the keys of the json)
 labels_to_filenames = json.load(open(ospj(metadata_dir, "scalar_labels_to_filenames.json")))
 labels_to_directories = json.load(open(ospj(metadata_dir, "scalar_labels_to_directories.json")))
+measures = list(labels_to_filenames.keys())
+
+# Each scalar map is loaded once per subject and shared across tracts
+scalar_paths = get_scalar_paths(qsirecon_group_dir, group, sub, labels_to_filenames, labels_to_directories, ses=ses)
+# Uncompressed mirrors (see build_scalar_mirror.py) are memory-mapped in place of the .nii.gz maps when up to date
+scalar_cache = ScalarCache(resolve_scalar_paths(scalar_paths, qsirecon_group_dir, mirror_group_dir),
+                           max_bytes=int(args.scalar_cache_gb * 1024**3))
+
+# Per-subject profile store (only read/written when --profile_format is 'store' or 'both')
+write_csv = args.profile_format in ["csv", "both"]
+write_store = args.profile_format in ["store", "both"]
+profile_store_path = get_profile_store_path("/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq", group, sub, atlas_label)
+profile_store = ProfileStore.load(profile_store_path) if write_store else None
+# Planning reads the store while --pipeline prefetches, so reads and updates are serialized
+profile_store_lock = threading.Lock()
+
+# Background writer of tract outputs (only with --pipeline, see write_output)
+writer = None
 
 # Load in tract labels from bundleseg config
 tract_labels = json.load(open(ospj(bundleseg_config_dir, f"config_{atlas_label}_association_projection.json")))
@@ -74,257 +141,457 @@ tract_labels = list(tract_labels.keys())
 tract_labels = [tract_label.replace('.trk', '') for tract_label in tract_labels]
 
 # ---- Utility functions ----
-def get_streamline_segment(sl, which_end, proportion=1/3):
+def get_acpc_reference():
     """
-    Extracts a proportion of points from the start or end of a streamline.
-    Args:
-        sl: streamline (Nx3 array)
-        which_end: 'end1', 'core', 'end2'
-        proportion: float in (0,1], proportion of points to extract
-    Returns:
-        Subset of streamline points
+    Affine, dimensions and NIfTI header of the subject's ACPC T1w grid, read from the image header only.
     """
-    n_points = len(sl)
-    n_extract = max(1, int(np.round(proportion * n_points)))
-    if which_end == 'end1':
-        return sl[:n_extract]
-    elif which_end == 'end2':
-        return sl[-n_extract:]
-    elif which_end == 'core':
-        return sl[n_extract:-n_extract]
-    else:
-        raise ValueError("which_end must be 'end1', 'end2', or 'core'")
-
-for tract_label in tract_labels:
+    from dipy.io.utils import create_nifti_header, get_reference_info
 
-    print(f"{tract_label}")
-
-    # Skip C_PO_L, C_PO_R, SLF2_L, SLF2_R
-    if tract_label in ["C_PO_L", "C_PO_R", "SLF2_L", "SLF2_R"]:
-        print(f"---- Skipping {tract_label} because it is a Cingulum-PO or SLF2 are unsuitable for profiling")
-        continue
+    acpc_affine, acpc_dimensions, acpc_voxel_sizes, acpc_voxel_order = get_reference_info(ref_t1w)
+    acpc_nifti_header = create_nifti_header(acpc_affine, acpc_dimensions, acpc_voxel_sizes)
+    return acpc_affine, acpc_dimensions, acpc_nifti_header
 
+def get_tract_paths(tract_label):
+    """
+    Defines the output directories and input/output file paths for a tract.
+    Returns:
+        Dictionary of paths
+    """
     # Define output directories
     outputs_profile_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/profile"
     outputs_weights_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/weights"
     outputs_segmentation_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/segmentation"
-    if not os.path.exists(outputs_profile_dir):
-        os.makedirs(outputs_profile_dir)
-    if not os.path.exists(outputs_weights_dir):
-        os.makedirs(outputs_weights_dir)
-    if not os.path.exists(outputs_segmentation_dir):
-        os.makedirs(outputs_segmentation_dir)
-
-    # Save segmentation (by thirds) if not already saved
+    outputs_samples_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/samples"
+    outputs_subsample_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/subsample"
+
+    # Get endpoint labels for the segmentation (by thirds)
     end1_label = tract_metadata.loc[tract_metadata['label'] == tract_label, 'end1'].values[0]
     end2_label = tract_metadata.loc[tract_metadata['label'] == tract_label, 'end2'].values[0]
 
-    # Define output nii and trk paths
-    end1_trk_path = ospj(outputs_segmentation_dir, f"{tract_label}_end-{end1_label}.trk")
-    end2_trk_path = ospj(outputs_segmentation_dir, f"{tract_label}_end-{end2_label}.trk")
-    core_trk_path = ospj(outputs_segmentation_dir, f"{tract_label}_core.trk")
-    end1_nii_path = ospj(outputs_segmentation_dir, f"{tract_label}_end-{end1_label}.nii.gz")
-    end2_nii_path = ospj(outputs_segmentation_dir, f"{tract_label}_end-{end2_label}.nii.gz")
-    core_nii_path = ospj(outputs_segmentation_dir, f"{tract_label}_core.nii.gz")
-    
-    # If trk paths exist, skip
-    if os.path.exists(end1_trk_path) and os.path.exists(end2_trk_path) and os.path.exists(core_trk_path):
-        print(f"---- Skipping {tract_label} because endpoint trk files already exist")
-        continue
-
-    # Get .trk file path
-    trk_path = ospj(bundleseg_group_dir, f"{sub}/{tract_label}.trk")
+    # Model centroids of the tract and of its homolog (which decides its node order), cached under the content hash
+    # of the model .trk file and the centroid parameters
+    model_trk_paths = {}
+    centroid_paths = {}
+    for label in [tract_label, get_homolog(tract_label)]:
+        if label is not None and os.path.exists(ospj(model_dir, f"{label}.trk")):
+            model_trk_paths[label] = ospj(model_dir, f"{label}.trk")
+            centroid_paths[label] = get_centroid_path(centroids_dir, label, model_trk_paths[label], method=args.centroid_method,
+                                                      max_streamlines=args.centroid_max_streamlines)
+
+    # Profiles of a capped bundle (--max_streamlines) are named after the cap, so they never stand in for the
+    # full-bundle profiles and a different cap is planned as a different output
+    profile_desc = f"_desc-cap{args.max_streamlines}" if args.max_streamlines is not None else ""
+
+    return {
+        "outputs_profile_dir": outputs_profile_dir,
+        "outputs_weights_dir": outputs_weights_dir,
+        "outputs_segmentation_dir": outputs_segmentation_dir,
+        "outputs_samples_dir": outputs_samples_dir,
+        "outputs_subsample_dir": outputs_subsample_dir,
+        "trk_path": ospj(bundleseg_group_dir, f"{sub}/{tract_label}.trk"),
+        "end1_trk_path": ospj(outputs_segmentation_dir, f"{tract_label}_end-{end1_label}.trk"),
+        "end2_trk_path": ospj(outputs_segmentation_dir, f"{tract_label}_end-{end2_label}.trk"),
+        "core_trk_path": ospj(outputs_segmentation_dir, f"{tract_label}_core.trk"),
+        "segment_index_path": ospj(outputs_segmentation_dir, f"{tract_label}_segments.npz"),
+        "end1_nii_path": ospj(outputs_segmentation_dir, f"{tract_label}_end-{end1_label}.nii.gz"),
+        "end2_nii_path": ospj(outputs_segmentation_dir, f"{tract_label}_end-{end2_label}.nii.gz"),
+        "core_nii_path": ospj(outputs_segmentation_dir, f"{tract_label}_core.nii.gz"),
+        "weights_csv_path": ospj(outputs_weights_dir, f"{tract_label}_gaussian_weights.csv"),
+        "profile_csv_paths": {measure: ospj(outputs_profile_dir, f"{measure}_profile-pyafq{profile_desc}.csv") for measure in measures},
+        "weighting_csv_paths": {weighting: {measure: ospj(outputs_profile_dir, f"{measure}_profile-pyafq{profile_desc}_weight-{weighting}.csv") for measure in measures}
+                                for weighting in args.profile_weightings},
+        "profile_ci_csv_paths": {measure: ospj(outputs_profile_dir, f"{measure}_profile-pyafq{profile_desc}_ci.csv") for measure in measures},
+        "profile_store_keys": {measure: f"{measure}{profile_desc}" for measure in measures},
+        "model_trk_paths": model_trk_paths,
+        "centroid_paths": centroid_paths,
+        "centroid_record_path": f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/{tract_label}_centroids.json",
+        "subsample_csv_path": ospj(outputs_subsample_dir, f"{tract_label}{profile_desc}_profile_streamlines.csv"),
+        "subsample_report_path": ospj(outputs_subsample_dir, f"{tract_label}{profile_desc}_subsample_deviation.csv"),
+        "node_samples_path": ospj(outputs_samples_dir, f"{sub}_{tract_label}{profile_desc}_node-samples.h5"),
+        "qc_png_path": f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}/{sub}/{atlas_label}/{tract_label}/qc/{sub}_{tract_label}_streamline_orientation.png",
+    }
+
+def get_skip_reason(tract_label, paths):
+    """
+    Checks, without loading any data, whether a tract should be skipped.
+    Returns:
+        Reason for skipping the tract, or None if it needs processing
+    """
+    # Skip C_PO_L, C_PO_R, SLF2_L, SLF2_R
+    if tract_label in ["C_PO_L", "C_PO_R", "SLF2_L", "SLF2_R"]:
+        return "it is a Cingulum-PO or SLF2 are unsuitable for profiling"
 
     # Check that .trk file exists
-    if not os.path.exists(trk_path):
-        print(f"---- Skipping {tract_label} because .trk file does not exist")
-        continue
+    if not os.path.exists(paths["trk_path"]):
+        return ".trk file does not exist"
 
-    # Load .trk file
-    trk = load_trk(trk_path, reference="same", bbox_valid_check=False)
+    # Check that the model .trk file (needed for the centroid) exists
+    if tract_label not in paths["centroid_paths"]:
+        return "model .trk file does not exist"
 
-    # Check that .trk file contains at least 1 streamline
-    if len(trk.streamlines) == 0:
-        print(f"---- Skipping {tract_label} because .trk file contains no streamlines")
-        continue
-
-    # Make model centroids file if necessary
-    if os.path.exists(ospj(centroids_dir, f"{tract_label}_model_centroids.npy")):
-        centroids_model = np.load(ospj(centroids_dir, f"{tract_label}_model_centroids.npy"))
+    return None
 
+def get_tract_plan(tract_label, paths):
+    """
+    Lists the outputs of a tract that are missing or older than the bundle or scalar maps they come from (all of
+    them if they were made with other model centroids).
+    """
+    centroids_changed = not centroid_record_matches(paths["centroid_record_path"], paths["centroid_paths"])
+    with profile_store_lock:
+        return plan_tract(paths, scalar_paths, measures, centroids_changed=centroids_changed,
+                          profile_format=args.profile_format, profile_store=profile_store, tract_label=tract_label,
+                          render_qc=args.render_qc,
+                          segment_trk=args.segment_trk,
+                          subsample_path=paths["subsample_csv_path"] if args.max_streamlines is not None else None,
+                          bootstrap=args.bootstrap > 0,
+                          node_samples_path=paths["node_samples_path"] if args.save_node_samples is not None else None)
+
+def write_output(fn, *args, **kwargs):
+    """
+    Calls an output writer now, or queues it on the background writer with --pipeline (its arguments must not be
+    modified afterwards).
+    """
+    if writer is None:
+        fn(*args, **kwargs)
     else:
+        writer.submit(fn, *args, **kwargs)
 
-        # Create model centroids directory if it doesn't exist
-        os.makedirs(centroids_dir, exist_ok=True)
+def load_tract_inputs(tract_label):
+    """
+    Reads what a tract needs before any computation: its paths and plan, its bundle and (unless --crop_scalars)
+    the scalar maps of its missing measures, which are left in the scalar cache. --pipeline runs this ahead of the
+    tract loop in a background thread.
+    Returns:
+        Dictionary with "paths", "skip_reason", "plan" and "trk" (the bundle is None for skipped tracts)
+    """
+    paths = get_tract_paths(tract_label)
+    inputs = {"paths": paths, "skip_reason": get_skip_reason(tract_label, paths), "plan": None, "trk": None}
+    if inputs["skip_reason"] is not None:
+        return inputs
+
+    # Only the outputs that are missing or stale are computed
+    inputs["plan"] = get_tract_plan(tract_label, paths)
+    if is_up_to_date(inputs["plan"]):
+        inputs["skip_reason"] = "all outputs are up to date"
+        return inputs
 
-        # Get model .trk file
-        model_trk_path = ospj(model_dir, f"{tract_label}.trk")
-        model_trk = load_trk(model_trk_path, "same", bbox_valid_check=False)
-        model_trk_streamlines = model_trk.streamlines
+    from dipy.io.streamline import load_trk
 
-        # Puts all streamlines into one cluster, using the centroid streamline as the standard to orient all streamlines
-        feature = ResampleFeature(nb_points=100)
-        metric = AveragePointwiseEuclideanMetric(feature)
-        qb = QuickBundles(np.inf, metric=metric)
-        clusters_model = qb.cluster(model_trk_streamlines)
-        centroids_model = clusters_model.centroids[0]
+    # Load .trk file
+    inputs["trk"] = load_trk(paths["trk_path"], reference="same", bbox_valid_check=False)
+
+    # Check that .trk file contains at least 1 streamline
+    if len(inputs["trk"].streamlines) == 0:
+        inputs["skip_reason"] = ".trk file contains no streamlines"
+        return inputs
 
-        # Enforce centroids of model trk to have node order proceed comparably between left and right hemispheres
-        # C_FPH_L is the only one that currently needs to be flipped after visually inspecting the profiles with the plotting code below, but should double check
-        if tract_label == "C_FPH_L":
-            centroids_model = centroids_model[::-1]
-        
-        # Save as .npy file
-        np.save(ospj(centroids_dir, f"{tract_label}_model_centroids.npy"), centroids_model)
+    if len(inputs["plan"]["measures"]) > 0 and not args.crop_scalars:
+        scalar_cache.prefetch(inputs["plan"]["measures"])
+    return inputs
 
-    # Reorient streamlines
-    trk_streamlines_reoriented = dts.orient_by_streamline(trk.streamlines, centroids_model)
-    trk_streamlines_reoriented_weights = dsa.gaussian_weights(trk_streamlines_reoriented)
+def save_segmentation(plan, paths, trk_streamlines_reoriented, space):
+    """
+    Splits the oriented streamlines of a bundle into end1/core/end2 thirds and saves the planned .trk files and
+    density maps of the segments.
+    """
+    from dipy.io.stateful_tractogram import StatefulTractogram
+    from dipy.io.streamline import save_tractogram
+
+    end1_trk_path, end2_trk_path, core_trk_path = paths["end1_trk_path"], paths["end2_trk_path"], paths["core_trk_path"]
+    end1_nii_path, end2_nii_path, core_nii_path = paths["end1_nii_path"], paths["end2_nii_path"], paths["core_nii_path"]
+
+    # Split streamlines into thirds (each segment gets its own buffer, since to_vox() below transforms in place)
+    end1_streamlines, core_streamlines, end2_streamlines = split_streamlines(trk_streamlines_reoriented, proportion=1/3)
+
+    end1_tractogram = StatefulTractogram(end1_streamlines, reference=template, space=space)
+    end2_tractogram = StatefulTractogram(end2_streamlines, reference=template, space=space)
+    core_tractogram = StatefulTractogram(core_streamlines, reference=template, space=space)
+
+    # Save .trk files (only with --segment_trk)
+    if plan["segmentation_trk"]:
+        save_tractogram(end1_tractogram, end1_trk_path, bbox_valid_check=False)
+        save_tractogram(end2_tractogram, end2_trk_path, bbox_valid_check=False)
+        save_tractogram(core_tractogram, core_trk_path, bbox_valid_check=False)
+
+    # Save .nii.gz files (density maps of the three segments accumulated in a single pass)
+    if plan["segmentation_nii"]:
+        acpc_affine, acpc_dimensions, acpc_nifti_header = get_acpc_reference()
+        for segment_tractogram in [end1_tractogram, end2_tractogram, core_tractogram]:
+            segment_tractogram.to_vox()
+            segment_tractogram.to_corner()
+        segment_densities = DensityMaps({"end1": end1_tractogram.streamlines,
+                                         "end2": end2_tractogram.streamlines,
+                                         "core": core_tractogram.streamlines},
+                                        np.eye(4), acpc_dimensions)
+        segment_densities.save_niftis({"end1": end1_nii_path, "end2": end2_nii_path, "core": core_nii_path},
+                                      acpc_affine, acpc_nifti_header)
+
+def process_tract(tract_label, inputs=None):
+    """
+    Segments a bundle into end1/core/end2 thirds and saves its density maps, Gaussian weights and tract profiles.
+    Args:
+        tract_label: tract label
+        inputs: the tract's inputs if already read (see load_tract_inputs)
+    Returns:
+        Weights and profiles to add to the profile store (None if there are none)
+    """
+    print(f"{tract_label}")
 
-    # Save Gaussian weights if not already saved
-    if not os.path.exists(ospj(outputs_weights_dir, f"{tract_label}_gaussian_weights.csv")):
+    if inputs is None:
+        inputs = load_tract_inputs(tract_label)
+    if inputs["skip_reason"] is not None:
+        print(f"---- Skipping {tract_label} because {inputs['skip_reason']}")
+        return
+    paths, plan, trk = inputs["paths"], inputs["plan"], inputs["trk"]
+    print(f"---- Computing {describe_plan(plan)}")
+
+    # Create output directories
+    outputs_profile_dir = paths["outputs_profile_dir"]
+    outputs_weights_dir = paths["outputs_weights_dir"]
+    outputs_segmentation_dir = paths["outputs_segmentation_dir"]
+    outputs_dirs = [outputs_segmentation_dir] + ([outputs_profile_dir, outputs_weights_dir] if write_csv else [])
+    if args.bootstrap > 0 and not write_csv:
+        outputs_dirs.append(outputs_profile_dir)
+    if args.max_streamlines is not None:
+        outputs_dirs.append(paths["outputs_subsample_dir"])
+    if args.save_node_samples is not None:
+        outputs_dirs.append(paths["outputs_samples_dir"])
+    for outputs_dir in outputs_dirs:
+        os.makedirs(outputs_dir, exist_ok=True)
+
+    # When the model centroids have changed (or are not recorded), the new ones are recorded before any output is
+    # written: the record is an input of every output of the tract, so outputs left from the old centroids,
+    # including those this run does not compute, are stale from now on
+    if plan["centroids_changed"]:
+        save_centroid_record(paths["centroid_record_path"], paths["centroid_paths"])
+
+    trk_path = paths["trk_path"]
+
+    # Load model centroids (computing and caching them if necessary), with node order proceeding comparably between
+    # left and right hemispheres (see centroids.orient_homologs and check_centroid_orientation.py)
+    centroids_model = load_oriented_centroid(tract_label, paths["centroid_paths"], paths["model_trk_paths"],
+                                             method=args.centroid_method, max_streamlines=args.centroid_max_streamlines)
+
+    # Store entries are stamped once all inputs are in place (the centroids and their record may have just been written)
+    store_result = {"tract_label": tract_label, "computed_at": time.time(), "weights": None, "measures": [], "profiles": None}
+
+    # Reorient streamlines (the bundle is resampled once; its nodes are reused by the Gaussian weights and the profiles)
+    trk_streamlines_reoriented, trk_nodes_reoriented, trk_flip = orient_streamlines(trk.streamlines, centroids_model)
+
+    # Gaussian weights are only needed for the weights file and the profiles
+    if plan["weights"] or plan["measures"]:
+        trk_streamlines_reoriented_weights = gaussian_weights(trk_nodes_reoriented)
+
+    # Save Gaussian weights if missing or stale (they are kept up to date in the store whenever they are computed)
+    if plan["weights"] or (write_store and plan["measures"]):
 
         # Compute mean weights across each streamline (quantifies streamline distance from centroid streamline)
         streamline_mean_weights = trk_streamlines_reoriented_weights.mean(axis=1)
-        np.savetxt(ospj(outputs_weights_dir, f"{tract_label}_gaussian_weights.csv"), streamline_mean_weights, delimiter=',', fmt='%.6f')
-
-    # Get streamlines
-    end1_streamlines = [get_streamline_segment(sl, 'end1') for sl in trk_streamlines_reoriented]
-    end2_streamlines = [get_streamline_segment(sl, 'end2') for sl in trk_streamlines_reoriented]
-    core_streamlines = [get_streamline_segment(sl, 'core') for sl in trk_streamlines_reoriented]
-
-    end1_tractogram = StatefulTractogram(end1_streamlines, reference=template, space=trk.space)
-    end2_tractogram = StatefulTractogram(end2_streamlines, reference=template, space=trk.space)
-    core_tractogram = StatefulTractogram(core_streamlines, reference=template, space=trk.space)
-    
-    # Save .trk files
-    save_tractogram(end1_tractogram, end1_trk_path, bbox_valid_check=False)
-    save_tractogram(end2_tractogram, end2_trk_path, bbox_valid_check=False)
-    save_tractogram(core_tractogram, core_trk_path, bbox_valid_check=False)
-
-    # Save .nii.gz files
-    end1_tractogram.to_vox()
-    end1_tractogram.to_corner()
-    end1_acpc_density = density_map(end1_tractogram.streamlines, np.eye(4), acpc_dimensions)
-    nib.save(nib.Nifti1Image(end1_acpc_density, acpc_affine, acpc_nifti_header), end1_nii_path)
-
-    end2_tractogram.to_vox()
-    end2_tractogram.to_corner()
-    end2_acpc_density = density_map(end2_tractogram.streamlines, np.eye(4), acpc_dimensions)
-    nib.save(nib.Nifti1Image(end2_acpc_density, acpc_affine, acpc_nifti_header), end2_nii_path)
-    
-    core_tractogram.to_vox()
-    core_tractogram.to_corner()
-    core_acpc_density = density_map(core_tractogram.streamlines, np.eye(4), acpc_dimensions)
-    nib.save(nib.Nifti1Image(core_acpc_density, acpc_affine, acpc_nifti_header), core_nii_path)
-    
-    for measure in labels_to_filenames.keys():
-
-        print(f"Running pyAFQ for {tract_label} - {measure}")
-
-        filename = labels_to_filenames[measure]
-        directory = labels_to_directories[measure]
-
-        # Get scalar file
-        if group == "penn_controls" or group == "penn_epilepsy":
-            scalar_nii = ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/{ses}/dwi/{sub}_{ses}_space-ACPC_{filename}_dwimap.nii.gz")
-        elif group == "hcpaging":
-            scalar_nii = ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/dwi/{sub}_space-ACPC_{filename}_dwimap.nii.gz")
-        elif group == "hcpya":
-            scalar_nii = ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/ses-01/dwi/{sub}_space-T1w_{filename}_dwimap.nii.gz")
-        scalar, scalar_affine = load_nifti(scalar_nii)
-
-        # Use the weights to calculate the tract profile for each bundle
-        profile_trk = dsa.afq_profile(scalar, 
-                                            trk_streamlines_reoriented, 
-                                            scalar_affine, 
-                                            weights=trk_streamlines_reoriented_weights)
-        
+        if write_csv and plan["weights"]:
+            write_output(np.savetxt, paths["weights_csv_path"], streamline_mean_weights, delimiter=',', fmt='%.6f')
+        store_result["weights"] = streamline_mean_weights
+
+    # Save the segmentation as a per-streamline index into the bundle .trk file (see segment_index.py)
+    if plan["segmentation_index"]:
+        write_output(save_segment_index, paths["segment_index_path"], trk_path, trk_flip, trk_streamlines_reoriented._lengths,
+                     proportion=1/3)
+
+    # Save the segment .trk files (only with --segment_trk) and density maps
+    if plan["segmentation_trk"] or plan["segmentation_nii"]:
+        write_output(save_segmentation, plan, paths, trk_streamlines_reoriented, trk.space)
+
+    # Render the node order of the reoriented streamlines (replaces the FURY-based QC that only ran locally)
+    if plan["qc"]:
+        write_output(render_orientation, trk_streamlines_reoriented, paths["qc_png_path"], view=get_view(tract_label),
+                     title=f"{sub} {tract_label}")
+
+    if len(plan["measures"]) == 0:
+        return store_result if write_store else None
+
+    # Cap the number of streamlines that are profiled (the weights and segmentation always cover the full bundle),
+    # recording which streamlines were kept
+    kept = slice(None)
+    if args.max_streamlines is not None:
+        kept = stratified_subsample(trk_nodes_reoriented, args.max_streamlines)
+        write_output(np.savetxt, paths["subsample_csv_path"], kept, fmt='%d')
+        print(f"---- Profiling {len(kept)} of {len(trk_streamlines_reoriented)} streamlines of {tract_label}")
+
+    # Use the weights to calculate the tract profiles of the missing measures in one pass over the bundle
+    print(f"Running pyAFQ for {tract_label} - {len(plan['measures'])} measures")
+    if args.crop_scalars:
+        # The box covers the full bundle, so that the subsample report can also profile every streamline
+        scalar_shape, scalar_affine = scalar_cache.grid(plan["measures"][0])
+        scalar_box = get_bounding_box(trk_nodes_reoriented, scalar_affine, scalar_shape)
+        scalars, scalar_affine = scalar_cache.stack_box(plan["measures"], scalar_box)
+        scalar_origin = [box_slice.start for box_slice in scalar_box]
+        print(f"---- Reading a {'x'.join(str(n) for n in scalars.shape[:3])} box of the "
+              f"{'x'.join(str(n) for n in scalar_shape)} scalar maps")
+    else:
+        scalars, scalar_affine = scalar_cache.stack(plan["measures"])
+        scalar_origin = None
+    samples_trk = sample_nodes(scalars, trk_nodes_reoriented[kept], scalar_affine, origin=scalar_origin)
+    profiles_trk = weighted_profiles(samples_trk, trk_streamlines_reoriented_weights[kept])
+
+    # Keep the node samples of every streamline for streamline-level analyses (the planner recomputes all measures
+    # whenever the store is written, so it always holds every measure)
+    if args.save_node_samples is not None:
+        write_output(save_node_samples, paths["node_samples_path"], samples_trk, plan["measures"],
+                          weights=trk_streamlines_reoriented_weights[kept],
+                          streamline_index=np.arange(len(trk_streamlines_reoriented))[kept],
+                          dtype=args.save_node_samples,
+                          attrs={"sub": sub, "tract": tract_label, "atlas": atlas_label})
+
+    # Profiles of the other weighting schemes from the same node samples
+    scheme_weights = {}
+    if "density" in args.profile_weightings:
+        scheme_weights["density"] = density_weights(trk_nodes_reoriented[kept], scalar_affine, scalars.shape,
+                                                     origin=scalar_origin)
+    weighting_profiles_trk = weighting_profiles(samples_trk, args.profile_weightings, scheme_weights)
+
+    # Bootstrap confidence bands from the same node samples (one weighted reduction per block of replicates)
+    if args.bootstrap > 0:
+        lower_trk, upper_trk, se_trk = bootstrap_profiles(samples_trk, trk_streamlines_reoriented_weights[kept],
+                                                          n_bootstrap=args.bootstrap, confidence=args.confidence)
+        for i, measure in enumerate(plan["measures"]):
+            write_output(np.savetxt, paths["profile_ci_csv_paths"][measure], np.column_stack([lower_trk[i], upper_trk[i], se_trk[i]]),
+                         delimiter=',', fmt='%.6f', header="lower,upper,se", comments='')
+
+    # Compare with the full-bundle profiles to measure the accuracy traded for the cap
+    if args.subsample_report and args.max_streamlines is not None:
+        full_profiles_trk = afq_profiles(scalars,
+                                         trk_streamlines_reoriented,
+                                         scalar_affine,
+                                         weights=trk_streamlines_reoriented_weights,
+                                         nodes=trk_nodes_reoriented,
+                                         origin=scalar_origin)
+        deviation = profile_deviation(plan["measures"], full_profiles_trk, profiles_trk, len(trk_streamlines_reoriented), len(kept))
+        write_output(deviation.to_csv, paths["subsample_report_path"], index=False)
+
+    # Other weighting schemes are kept in the store as measures labelled {measure}_weight-{weighting} (with the cap
+    # in the measure label of capped bundles, see get_tract_paths)
+    store_keys = [paths["profile_store_keys"][measure] for measure in plan["measures"]]
+    store_result["measures"] = store_keys + [f"{store_key}_weight-{weighting}" for weighting in args.profile_weightings
+                                             for store_key in store_keys]
+    store_result["profiles"] = np.concatenate([profiles_trk] + [weighting_profiles_trk[weighting] for weighting in args.profile_weightings])
+
+    for i, (measure, profile_trk) in enumerate(zip(plan["measures"], profiles_trk)):
+
         # Save numpy array profile as a .csv file
-        np.savetxt(ospj(outputs_profile_dir, f"{measure}_profile-pyafq.csv"), profile_trk, delimiter=',', fmt='%.6f')
-
-        ### PLOT ###
-
-        # BELOW is the plotting code for visualizing/QC-ing orientation of along-streamline segments. Unfortunately, only able to get this working if run locally, but will test on GPU when resources are available.
-
-        # # Get inverse affine matrix
-        # inv_affine = np.linalg.inv(ref_t1w.affine)
-
-        # # Transform streamlines to T1w space
-        # trk_streamlines_reoriented_in_t1w = transform_streamlines(trk_streamlines_reoriented, inv_affine)
-
-        # def lines_as_tubes(sl, line_width, **kwargs):
-        #     line_actor = actor.line(sl, **kwargs)
-        #     line_actor.GetProperty().SetRenderLinesAsTubes(1)
-        #     line_actor.GetProperty().SetLineWidth(line_width)
-        #     return line_actor
-
-        # def slice_volume(data, x=None, y=None, z=None):
-        #     slicer_actors = []
-        #     slicer_actor_z = actor.slicer(data)
-        #     if z is not None:
-        #         slicer_actor_z.display_extent(
-        #             0, data.shape[0] - 1,
-        #             0, data.shape[1] - 1,
-        #             z, z)
-        #         slicer_actors.append(slicer_actor_z)
-        #     if y is not None:
-        #         slicer_actor_y = slicer_actor_z.copy()
-        #         slicer_actor_y.display_extent(
-        #             0, data.shape[0] - 1,
-        #             y, y,
-        #             0, data.shape[2] - 1)
-        #         slicer_actors.append(slicer_actor_y)
-        #     if x is not None:
-        #         slicer_actor_x = slicer_actor_z.copy()
-        #         slicer_actor_x.display_extent(
-        #             x, x,
-        #             0, data.shape[1] - 1,
-        #             0, data.shape[2] - 1)
-        #         slicer_actors.append(slicer_actor_x)
-
-        #     return slicer_actors
-
-        # slicers = slice_volume(t1w, x=t1w.shape[0] // 2, z=t1w.shape[-1] // 4)
-
-        # # Create scene
-        # scene = window.Scene()
-        # scene.clear()
-
-        # # Add streamlines
-        # for sl in trk_streamlines_reoriented_in_t1w:
-        #     trk_actor = actor.line([sl], colors=create_colormap(np.linspace(0,100, len(sl)), 'jet'))
-        #     scene.add(trk_actor)
-
-        # for slicer in slicers:
-        #     scene.add(slicer)
-
-        # # If tract label ends with L, set camera to left
-        # if tract_label.endswith('L'):
-        #     scene.set_camera(
-        #         position=(25, 0, 0),         
-        #         focal_point=(0, 0, 0),
-        #         view_up=(0, 0, 1)
-        #     )
-        # elif tract_label.endswith('R'):
-        #     scene.set_camera(
-        #         position=(-25, 0, 0),         
-        #         focal_point=(0, 0, 0),
-        #         view_up=(0, 0, 1)
-        #     )
-        # else:
-        #     scene.set_camera(
-        #         position=(0, 0, 25),         
-        #         focal_point=(0, 0, 0),
-        #         view_up=(0, 0, 1)
-        #     )
-
-        # window.record(
-        #     scene,
-        #     out_path=ospj(outputs_dir, f'{sub}_{tract_label}_streamline_orientation.png'),
-        #     size=(2400, 2400))
-
-        # window.show(scene)
-
-
-        
\ No newline at end of file
+        if write_csv:
+            write_output(np.savetxt, paths["profile_csv_paths"][measure], profile_trk, delimiter=',', fmt='%.6f')
+            for weighting in args.profile_weightings:
+                write_output(np.savetxt, paths["weighting_csv_paths"][weighting][measure], weighting_profiles_trk[weighting][i],
+                             delimiter=',', fmt='%.6f')
+
+    return store_result if write_store else None
+
+def save_store_result(store_result):
+    """
+    Adds the weights and profiles of a tract to the subject's profile store and rewrites it.
+    """
+    if store_result is None:
+        return
+    tract_label, computed_at = store_result["tract_label"], store_result["computed_at"]
+    with profile_store_lock:
+        if store_result["weights"] is not None:
+            profile_store.set_weights(tract_label, store_result["weights"], computed_at)
+        if len(store_result["measures"]) > 0:
+            profile_store.set_profiles(tract_label, store_result["measures"], store_result["profiles"], computed_at)
+        profile_store.save(profile_store_path)
+
+# ---- Worker processes ----
+def init_worker(shared_measures, scalars_spec, scalar_affine):
+    """
+    Attaches a worker process to the scalar maps shared by the parent, so they are never pickled or reloaded.
+    """
+    global scalars_shm
+    scalars_shm, scalars = attach_array(scalars_spec)
+    scalar_cache.pin_stack(shared_measures, scalars, scalar_affine)
+
+def print_plans():
+    """
+    Prints, for every tract, why it is skipped or which of its outputs would be computed.
+    """
+    for tract_label in tract_labels:
+        paths = get_tract_paths(tract_label)
+        skip_reason = get_skip_reason(tract_label, paths)
+        if skip_reason is not None:
+            print(f"{tract_label}: skip ({skip_reason})")
+        else:
+            print(f"{tract_label}: {describe_plan(get_tract_plan(tract_label, paths))}")
+
+def run_pipeline():
+    """
+    Runs the tract loop with the inputs of the next tracts read, and the outputs of the previous tracts written, in
+    background threads (see pipeline.py), then prints how much of that I/O overlapped with the computation.
+    """
+    global writer
+
+    prefetcher = Prefetcher(load_tract_inputs, tract_labels, depth=args.prefetch)
+    writer = BackgroundWriter(max_workers=args.write_threads)
+    start = time.perf_counter()
+    try:
+        for tract_label, inputs in prefetcher:
+            save_store_result(process_tract(tract_label, inputs))
+    finally:
+        prefetcher.close()
+        writer.close()
+    print(format_report(pipeline_report(time.perf_counter() - start, len(tract_labels), prefetcher, writer)))
+
+def main():
+
+    if args.dry_run:
+        print_plans()
+        return
+
+    if args.workers <= 1 and args.pipeline:
+        run_pipeline()
+        print(f"Scalar cache: {scalar_cache.summary()}")
+        return
+
+    if args.workers <= 1:
+        start = time.perf_counter()
+        for tract_label in tract_labels:
+            save_store_result(process_tract(tract_label))
+        wall_seconds = time.perf_counter() - start
+        print(f"Serial: {len(tract_labels)} tracts in {wall_seconds:.1f} s ({60 * len(tract_labels) / wall_seconds:.1f} tracts/min)")
+        print(f"Scalar cache: {scalar_cache.summary()}")
+        return
+
+    # Only tracts with work left are sent to the pool, and only the measures they still need are loaded
+    pending_tract_labels = []
+    pending_measures = set()
+    for tract_label in tract_labels:
+        paths = get_tract_paths(tract_label)
+        skip_reason = get_skip_reason(tract_label, paths)
+        if skip_reason is None and is_up_to_date(get_tract_plan(tract_label, paths)):
+            skip_reason = "all outputs are up to date"
+        if skip_reason is not None:
+            print(f"{tract_label}\n---- Skipping {tract_label} because {skip_reason}")
+        else:
+            pending_tract_labels.append(tract_label)
+            pending_measures.update(get_tract_plan(tract_label, paths)["measures"])
+    if len(pending_tract_labels) == 0:
+        return
+
+    # Load the needed scalar maps once into shared memory for all workers
+    # (with --crop_scalars every worker reads only the boxes of its own bundles instead)
+    shared_measures = [measure for measure in measures if measure in pending_measures]
+    if len(shared_measures) == 0 or args.crop_scalars:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for store_result in pool.map(process_tract, pending_tract_labels):
+                save_store_result(store_result)
+        return
+
+    scalars_shm, scalars_spec, scalar_affine = share_scalar_stack(scalar_cache, shared_measures)
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(shared_measures, scalars_spec, scalar_affine)) as pool:
+            for store_result in pool.map(process_tract, pending_tract_labels):
+                save_store_result(store_result)
+    finally:
+        scalars_shm.close()
+        scalars_shm.unlink()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 #!/bin/bash
-#SBATCH --cpus-per-task=1
+# One worker per CPU; each worker holds a whole tract (about 1 GB at peak for bundles of ~90k streamlines), so
+# 4 workers fit in 8GB with headroom where 8 would not
+#SBATCH --cpus-per-task=4
 #SBATCH --mem=8GB
 #SBATCH --job-name=pyafq
 
@@ -9,5 +11,5 @@ group=${2}
 source activate /mnt/sauce/littlab/users/mjaskir/software/miniconda3/envs/structural_tractometry
 
 echo "Starting pyafq at $(date)"
-python pyafq.py ${sub} ${group}
+python pyafq.py ${sub} ${group} --workers ${SLURM_CPUS_PER_TASK:-1}
 echo "Finished pyafq at $(date)"
\ No newline at end of file
@@ -0,0 +1,204 @@
+'''
+Headless QC renderer for the orientation of reoriented streamlines. Projects a whole bundle onto a 2D view and
+draws every streamline segment, colored by its position along the streamline (end1 -> end2), as a single
+matplotlib line collection on the Agg backend, so that it needs no display, GPU, VTK or FURY and can run in
+worker processes across tracts and subjects
+
+Usage:
+    python render_qc.py hcpaging sub-0001 sub-0002 ... [--workers 8] [--tracts AF_L AF_R] [--force]
+'''
+
+# Standard library imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from os.path import join as ospj
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from centroids import get_centroid_path, get_homolog, load_oriented_centroid
+
+# Projection axes (screen x, screen y, depth) and their signs for each view, matching the FURY cameras used before.
+# Streamlines are in RAS mm, where +x is right: left tracts are seen from a camera at +x (from the right, i.e. their
+# medial side, anterior to the right of the image), right tracts from a camera at -x (from the left, their medial
+# side, anterior to the left) and commissural tracts from above (+z, anterior up)
+VIEWS = {
+    "left": ((1, 2, 0), (1, 1, 1)),
+    "right": ((1, 2, 0), (-1, 1, -1)),
+    "axial": ((0, 1, 2), (1, 1, 1)),
+}
+
+
+def get_view(tract_label):
+    """
+    View used for a tract: 'left' for tracts ending in L, 'right' for tracts ending in R, otherwise 'axial'.
+    """
+    if tract_label.endswith('L'):
+        return "left"
+    elif tract_label.endswith('R'):
+        return "right"
+    else:
+        return "axial"
+
+
+def project_segments(streamlines, view):
+    """
+    Projects every segment between consecutive points of every streamline onto a view, without a
+    per-streamline loop.
+    Args:
+        streamlines: ArraySequence / Streamlines
+        view: 'left', 'right' or 'axial'
+    Returns:
+        segments: (n_segments x 2 x 2) screen coordinates of the segment end points, sorted back to front
+        positions: (n_segments,) position of each segment along its streamline, from 0 (end1) to 1 (end2)
+    """
+    axes, signs = VIEWS[view]
+    if streamlines._data.shape[0] != np.sum(streamlines._lengths):
+        streamlines = streamlines.copy()
+    points = np.asarray(streamlines._data, dtype=float)[:, axes] * signs
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+
+    # Start index of every segment: all points except the last point of each streamline
+    n_segments = np.maximum(lengths - 1, 0)
+    first_segment = np.cumsum(n_segments) - n_segments
+    node_index = np.arange(n_segments.sum()) - np.repeat(first_segment, n_segments)
+    starts = np.repeat(offsets, n_segments) + node_index
+    positions = node_index / np.repeat(np.maximum(n_segments - 1, 1), n_segments)
+
+    segments = np.stack([points[starts, :2], points[starts + 1, :2]], axis=1)
+
+    # Painter's algorithm: far segments are drawn first
+    order = np.argsort(points[starts, 2] + points[starts + 1, 2], kind="stable")
+    return segments[order], positions[order]
+
+
+def render_orientation(streamlines, out_path, view="axial", title=None, colormap="jet", linewidth=0.3, alpha=0.8,
+                       size=(1200, 1200), dpi=200, max_streamlines=None, seed=0):
+    """
+    Renders the node order of a bundle to a .png file.
+    Args:
+        streamlines: reoriented streamlines (see dts.orient_by_streamline), in world (RAS mm) coordinates
+        out_path: output .png path
+        view: 'left', 'right' or 'axial' (see get_view)
+        title: figure title
+        colormap: matplotlib colormap for the position along the streamline
+        linewidth, alpha: line style
+        size: image size in pixels
+        dpi: image resolution
+        max_streamlines: if set, a random subset of at most this many streamlines is drawn
+        seed: random seed for the subset
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    if max_streamlines is not None and len(streamlines) > max_streamlines:
+        keep = np.sort(np.random.default_rng(seed).choice(len(streamlines), max_streamlines, replace=False))
+        streamlines = streamlines[keep]
+
+    segments, positions = project_segments(streamlines, view)
+
+    # A bare Figure with an Agg canvas keeps no global pyplot state, so it is safe in worker processes
+    fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    lines = LineCollection(segments, cmap=colormap, linewidths=linewidth, alpha=alpha)
+    lines.set_array(positions)
+    lines.set_clim(0, 1)
+    ax.add_collection(lines)
+    if len(segments) > 0:
+        ax.autoscale()
+    ax.set_aspect("equal")
+    ax.set_axis_off()
+    colorbar = fig.colorbar(lines, ax=ax, fraction=0.04, pad=0.02)
+    colorbar.set_ticks([0, 1])
+    colorbar.set_ticklabels(["end1", "end2"])
+    if title is not None:
+        ax.set_title(title, fontsize=8)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    fig.savefig(out_path, dpi=dpi)
+
+
+def render_tract_qc(job):
+    """
+    Loads, orients and renders one bundle of one subject (a worker task of main()).
+    Args:
+        job: (tract_label, trk_path, centroid_paths, model_trk_paths, out_path, title) tuple, where the centroid and
+            model paths cover the tract and its homolog (see centroids.load_oriented_centroid)
+    Returns:
+        Status message
+    """
+    import dipy.tracking.streamline as dts
+    from dipy.io.streamline import load_trk
+
+    tract_label, trk_path, centroid_paths, model_trk_paths, out_path, title = job
+    trk = load_trk(trk_path, reference="same", bbox_valid_check=False)
+    if len(trk.streamlines) == 0:
+        return f"---- Skipping {title} because .trk file contains no streamlines"
+    centroid = load_oriented_centroid(tract_label, centroid_paths, model_trk_paths)
+    streamlines = dts.orient_by_streamline(trk.streamlines, centroid)
+    render_orientation(streamlines, out_path, view=get_view(tract_label), title=title)
+    return f"---- Saved {out_path}"
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Render streamline orientation QC images for the bundles of one or more subjects.")
+    parser.add_argument("group", choices=["hcpaging", "hcpya", "penn_controls", "penn_epilepsy"], help="Subject group")
+    parser.add_argument("subs", nargs="+", help="Subject labels (e.g. sub-RID0505)")
+    parser.add_argument("--tracts", nargs="+", help="Tract labels to render (default: all tracts in the bundleseg config)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to spread (subject, tract) renders across")
+    parser.add_argument("--force", action="store_true", help="Re-render images that already exist")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    group = args.group
+
+    # Define input/output directories
+    atlas_label = "HCP1065"
+    atlas_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/data/atlases/{atlas_label}"
+    model_dir = f"{atlas_dir}/all_trk"
+    centroids_dir = f"{atlas_dir}/centroids"
+    bundleseg_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/bundleseg/{group}"
+    pyafq_group_dir = f"/mnt/sauce/littlab/users/mjaskir/structural_tractometry/derivatives/pyafq/{group}"
+    bundleseg_config_dir = "/mnt/sauce/littlab/users/mjaskir/structural_tractometry/code/bundleseg/config"
+
+    # Load in tract labels from bundleseg config
+    if args.tracts is not None:
+        tract_labels = args.tracts
+    else:
+        tract_labels = json.load(open(ospj(bundleseg_config_dir, f"config_{atlas_label}_association_projection.json")))
+        tract_labels = [tract_label.replace('.trk', '') for tract_label in tract_labels.keys()]
+
+    jobs = []
+    for sub in args.subs:
+        for tract_label in tract_labels:
+            trk_path = ospj(bundleseg_group_dir, f"{sub}/{tract_label}.trk")
+            model_trk_paths = {label: ospj(model_dir, f"{label}.trk") for label in [tract_label, get_homolog(tract_label)]
+                               if label is not None and os.path.exists(ospj(model_dir, f"{label}.trk"))}
+            centroid_paths = {label: get_centroid_path(centroids_dir, label, model_trk_path) for label, model_trk_path in model_trk_paths.items()}
+            out_path = ospj(pyafq_group_dir, f"{sub}/{atlas_label}/{tract_label}/qc/{sub}_{tract_label}_streamline_orientation.png")
+            if not os.path.exists(trk_path) or tract_label not in model_trk_paths:
+                print(f"---- Skipping {sub} {tract_label} because its .trk file or model .trk file does not exist")
+            elif os.path.exists(out_path) and not args.force:
+                print(f"---- Skipping {sub} {tract_label} because {out_path} already exists")
+            else:
+                jobs.append((tract_label, trk_path, centroid_paths, model_trk_paths, out_path, f"{sub} {tract_label}"))
+
+    if args.workers <= 1:
+        for job in jobs:
+            print(render_tract_qc(job))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for message in pool.map(render_tract_qc, jobs):
+                print(message)
+
+
+if __name__ == "__main__":
+    main()
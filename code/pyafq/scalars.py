@@ -0,0 +1,363 @@
+'''
+Helpers for locating and loading the qsirecon diffusion MRI scalar maps that pyafq.py samples along each tract
+'''
+
+# Standard library imports
+from collections import OrderedDict
+import gzip
+import json
+from multiprocessing import shared_memory
+import os
+from os.path import join as ospj
+import shutil
+import threading
+
+# Third-party imports
+import nibabel as nib
+import numpy as np
+
+
+def load_nifti(path):
+    """
+    Same as dipy.io.image.load_nifti (data in its stored dtype, memory-mapped for uncompressed files, and the
+    affine), without importing dipy.
+    """
+    img = nib.load(path)
+    return np.asanyarray(img.dataobj), img.affine
+
+
+def get_scalar_path(qsirecon_group_dir, group, sub, filename, directory, ses=None):
+    """
+    Builds the path to a qsirecon scalar map for a subject.
+    Args:
+        qsirecon_group_dir: qsirecon derivatives directory for the group
+        group: 'penn_controls', 'penn_epilepsy', 'hcpaging' or 'hcpya'
+        sub: subject label (e.g. 'sub-RID0505')
+        filename: scalar filename entity (value in scalar_labels_to_filenames.json)
+        directory: qsirecon derivatives subdirectory (value in scalar_labels_to_directories.json)
+        ses: session label, required for the Penn groups
+    Returns:
+        Path to the scalar .nii.gz file
+    """
+    if group == "penn_controls" or group == "penn_epilepsy":
+        return ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/{ses}/dwi/{sub}_{ses}_space-ACPC_{filename}_dwimap.nii.gz")
+    elif group == "hcpaging":
+        return ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/dwi/{sub}_space-ACPC_{filename}_dwimap.nii.gz")
+    elif group == "hcpya":
+        return ospj(qsirecon_group_dir, f"derivatives/{directory}/{sub}/ses-01/dwi/{sub}_space-T1w_{filename}_dwimap.nii.gz")
+    else:
+        raise ValueError(f"Unknown group: {group}")
+
+
+def get_scalar_paths(qsirecon_group_dir, group, sub, labels_to_filenames, labels_to_directories, ses=None):
+    """
+    Builds the scalar map path for every measure in scalar_labels_to_filenames.json.
+    Returns:
+        Dictionary mapping measure label -> scalar .nii.gz path
+    """
+    return {
+        measure: get_scalar_path(qsirecon_group_dir, group, sub, filename, labels_to_directories[measure], ses=ses)
+        for measure, filename in labels_to_filenames.items()
+    }
+
+
+def get_mirror_path(scalar_path, qsirecon_group_dir, mirror_group_dir):
+    """
+    Path of the uncompressed mirror of a scalar map: same relative path under mirror_group_dir, as .nii.
+    """
+    relative_path = os.path.relpath(scalar_path, qsirecon_group_dir)
+    if relative_path.endswith(".gz"):
+        relative_path = relative_path[:-len(".gz")]
+    return ospj(mirror_group_dir, relative_path)
+
+
+def get_mirror_sidecar_path(mirror_path):
+    return f"{mirror_path[:-len('.nii')]}.json"
+
+
+def get_source_signature(scalar_path):
+    """
+    Size and modification time of a source scalar map, recorded in the sidecar of its mirror.
+    """
+    stat = os.stat(scalar_path)
+    return {"source_path": scalar_path, "source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def is_mirror_valid(scalar_path, mirror_path):
+    """
+    Checks that a mirror exists and was built from the current version of its source (same size and mtime).
+    """
+    sidecar_path = get_mirror_sidecar_path(mirror_path)
+    if not (os.path.exists(mirror_path) and os.path.exists(sidecar_path) and os.path.exists(scalar_path)):
+        return False
+    with open(sidecar_path) as f:
+        sidecar = json.load(f)
+    return sidecar == get_source_signature(scalar_path)
+
+
+def build_mirror(scalar_path, mirror_path):
+    """
+    Decompresses a scalar map into its mirror. The .nii is a byte-for-byte copy of the decompressed
+    .nii.gz (same header and data), so nibabel memory-maps it instead of inflating it on every load.
+    The sidecar is written last, so an interrupted build is never considered valid.
+    """
+    os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+    signature = get_source_signature(scalar_path)
+    tmp_path = f"{mirror_path}.tmp"
+    with gzip.open(scalar_path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=2**24)
+    os.replace(tmp_path, mirror_path)
+    with open(get_mirror_sidecar_path(mirror_path), "w") as f:
+        json.dump(signature, f, indent=4)
+
+
+def resolve_scalar_paths(scalar_paths, qsirecon_group_dir, mirror_group_dir):
+    """
+    Swaps each scalar map for its uncompressed mirror when the mirror is up to date.
+    Args:
+        scalar_paths: dictionary mapping measure label -> scalar .nii.gz path
+        qsirecon_group_dir: qsirecon derivatives directory for the group
+        mirror_group_dir: mirror directory for the group (see build_scalar_mirror.py)
+    Returns:
+        Dictionary mapping measure label -> path to load
+    """
+    resolved_paths = {}
+    for measure, scalar_path in scalar_paths.items():
+        mirror_path = get_mirror_path(scalar_path, qsirecon_group_dir, mirror_group_dir)
+        resolved_paths[measure] = mirror_path if is_mirror_valid(scalar_path, mirror_path) else scalar_path
+    return resolved_paths
+
+
+class ScalarCache:
+    """
+    Subject-scoped cache of scalar volumes. Each map is decompressed once and then served to every tract,
+    holding at most max_bytes of voxel data and evicting the least-recently-used volume when full.
+
+    Note that a budget smaller than the full set of measures makes the tract x measure loop cycle through
+    the cache, so every request misses; size the budget to hold all measures of a subject where possible.
+    Args:
+        scalar_paths: dictionary mapping measure label -> scalar .nii.gz path
+        max_bytes: maximum number of bytes of voxel data held in the cache
+    """
+
+    def __init__(self, scalar_paths, max_bytes):
+        self.scalar_paths = scalar_paths
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pinned = {}
+        # Serializes access from the main thread and a prefetching thread (see pipeline.py)
+        self._lock = threading.RLock()
+
+    def __contains__(self, measure):
+        return measure in self._entries
+
+    def get(self, measure):
+        """
+        Returns the (data, affine) pair for a measure, loading it on a cache miss.
+        The returned array is read-only since it is shared between tracts.
+        """
+        with self._lock:
+            if measure in self._entries:
+                self._entries.move_to_end(measure)
+                self.hits += 1
+                return self._entries[measure]
+
+            self.misses += 1
+            data, affine = load_nifti(self.scalar_paths[measure])
+            data.flags.writeable = False
+            self._put(measure, (data, affine), data.nbytes)
+            return data, affine
+
+    def stack(self, measures, out=None):
+        """
+        Returns the scalar maps of several measures stacked along a last axis, as an (X x Y x Z x M) array.
+        The stack is cached as a single entry; measures not yet resident are loaded straight into it.
+        Args:
+            measures: list of measure labels
+            out: optional preallocated (X x Y x Z x M) array to fill instead (e.g. backed by shared memory);
+                 it is owned by the caller and not retained by the cache
+        Returns:
+            (stacked data, affine) pair
+        """
+        with self._lock:
+            key = ("stack",) + tuple(measures)
+            for pinned_key, (pinned_data, pinned_affine) in self._pinned.items():
+                if set(measures) <= set(pinned_key[1:]):
+                    self.hits += 1
+                    if pinned_key == key:
+                        return pinned_data, pinned_affine
+                    # A subset of a pinned stack is gathered into a new array
+                    return pinned_data[..., [pinned_key[1:].index(measure) for measure in measures]], pinned_affine
+            if out is None and key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            data = out
+            affine = None
+            for i, measure in enumerate(measures):
+                if measure in self._entries:
+                    self.hits += 1
+                    volume, volume_affine = self._entries[measure]
+                else:
+                    self.misses += 1
+                    volume, volume_affine = load_nifti(self.scalar_paths[measure])
+                if data is None:
+                    data = np.empty(volume.shape + (len(measures),), dtype=self.stack_dtype(measures))
+                if affine is None:
+                    affine = volume_affine
+                if volume.shape != data.shape[:3] or not np.allclose(volume_affine, affine):
+                    raise ValueError(f"Scalar map for {measure} is not on the same grid as {measures[0]}")
+                data[..., i] = volume
+                del volume
+
+            data.flags.writeable = False
+            if out is None:
+                self._put(key, (data, affine), data.nbytes)
+            return data, affine
+
+    def prefetch(self, measures):
+        """
+        Loads the stack of several measures into the cache ahead of its use (e.g. from a background thread), unless
+        it is larger than the budget and would not be retained.
+        """
+        shape, _ = self.grid(measures[0])
+        if int(np.prod(shape)) * len(measures) * self.stack_dtype(measures).itemsize <= self.max_bytes:
+            self.stack(measures)
+
+    def stack_box(self, measures, box):
+        """
+        Returns the scalar maps of several measures inside a voxel box (see profiles.get_bounding_box), as an
+        (x x y x z x M) array. Resident and pinned stacks are sliced; otherwise only the box is read from each file
+        and nothing is cached, so memory scales with the box rather than the head. Uncompressed mirrors are
+        read with seeks, so only the slabs covering the box are read; .nii.gz maps are decompressed up to the end
+        of the box (with random access from seek points if indexed_gzip is installed, which nibabel then uses).
+        Args:
+            measures: list of measure labels
+            box: tuple of three voxel slices
+        Returns:
+            (cropped data, affine) pair; the affine is that of the full maps
+        """
+        with self._lock:
+            key = ("stack",) + tuple(measures)
+            for pinned_key, (pinned_data, pinned_affine) in self._pinned.items():
+                if set(measures) <= set(pinned_key[1:]):
+                    self.hits += 1
+                    return pinned_data[box + ([pinned_key[1:].index(measure) for measure in measures],)], pinned_affine
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                data, affine = self._entries[key]
+                return data[box], affine
+
+            data = None
+            affine = None
+            for i, measure in enumerate(measures):
+                if measure in self._entries:
+                    self.hits += 1
+                    volume, volume_affine = self._entries[measure]
+                    volume = volume[box]
+                else:
+                    self.misses += 1
+                    img = nib.load(self.scalar_paths[measure])
+                    volume, volume_affine = np.asanyarray(img.dataobj[box]), img.affine
+                if data is None:
+                    data = np.empty(volume.shape + (len(measures),), dtype=self.stack_dtype(measures))
+                if affine is None:
+                    affine = volume_affine
+                if volume.shape != data.shape[:3] or not np.allclose(volume_affine, affine):
+                    raise ValueError(f"Scalar map for {measure} is not on the same grid as {measures[0]}")
+                data[..., i] = volume
+                del volume
+
+            data.flags.writeable = False
+            return data, affine
+
+    def grid(self, measure):
+        """
+        Spatial shape and affine of a measure's scalar map, read from the NIfTI header only.
+        """
+        img = nib.load(self.scalar_paths[measure])
+        return img.shape[:3], img.affine
+
+    def stack_dtype(self, measures):
+        """
+        Smallest dtype holding every measure without loss, read from the NIfTI headers only
+        (maps with scl_slope/scl_inter scaling are loaded as float64).
+        """
+        dtypes = []
+        for measure in measures:
+            proxy = nib.load(self.scalar_paths[measure]).dataobj
+            scaled = getattr(proxy, "slope", 1.0) != 1.0 or getattr(proxy, "inter", 0.0) != 0.0
+            dtypes.append(np.dtype(np.float64) if scaled else proxy.dtype)
+        return np.result_type(*dtypes)
+
+    def pin_stack(self, measures, data, affine):
+        """
+        Registers an already stacked array (e.g. attached from shared memory) for stack(measures) and for
+        stacks of any subset of these measures.
+        Pinned stacks are never evicted and do not count towards the memory budget.
+        """
+        with self._lock:
+            self._pinned[("stack",) + tuple(measures)] = (data, affine)
+
+    def _put(self, key, value, nbytes):
+        # Volumes larger than the whole budget are served but never retained
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        self._entries[key] = value
+        self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self.nbytes = 0
+
+    def summary(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self._entries)} volumes ({self.nbytes / 1024**3:.2f} GB) resident"
+
+
+def share_scalar_stack(scalar_cache, measures):
+    """
+    Loads the stacked scalar maps of a subject straight into a shared-memory block, so that worker
+    processes can attach to them read-only instead of receiving a pickled copy each.
+    The caller must close() and unlink() the returned block once the workers are done.
+    Returns:
+        shm: SharedMemory block holding the (X x Y x Z x M) stack
+        spec: (name, shape, dtype) tuple to pass to attach_array in the workers
+        affine: voxel-to-world affine of the scalar maps
+    """
+    # Shape and dtype are read from the headers only
+    shape = tuple(nib.load(scalar_cache.scalar_paths[measures[0]]).shape[:3]) + (len(measures),)
+    dtype = scalar_cache.stack_dtype(measures)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _, affine = scalar_cache.stack(measures, out=data)
+        del data
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm, (shm.name, shape, dtype.str), affine
+
+
+def attach_array(spec):
+    """
+    Attaches to an array shared by share_scalar_stack.
+    Returns:
+        shm: SharedMemory handle (keep a reference for as long as the array is used)
+        array: read-only view of the shared array
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
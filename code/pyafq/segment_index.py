@@ -0,0 +1,124 @@
+'''
+End1/core/end2 segmentation of a bundle stored as an index instead of three .trk copies of its points: for every
+streamline of the bundle .trk file, whether the orientation step flipped it and the point indices at which its
+core and its end2 segment start. Segments are materialized on demand as views on the oriented bundle, and .trk
+files are only written when asked for (see export_segments.py)
+'''
+
+# Standard library imports
+import os
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from orientation import flip_streamlines
+from segments import SEGMENT_LABELS, get_end_lengths, make_array_sequence
+
+
+def save_segment_index(path, trk_path, flip, lengths, proportion=1/3):
+    """
+    Writes the segment index of an oriented bundle (atomically, so readers never see a partial file).
+    Args:
+        path: output .npz path
+        trk_path: bundle .trk file the index refers to (its size and mtime are recorded to detect changes)
+        flip: (n_streamlines,) boolean array of streamlines reversed by the orientation step
+        lengths: number of points of each streamline
+        proportion: proportion of points in each end segment (see segments.split_streamlines)
+    """
+    lengths = np.asarray(lengths, dtype=np.intp)
+    end_lengths = get_end_lengths(lengths, proportion)
+    splits = np.stack([end_lengths, lengths - end_lengths], axis=1).astype(np.int32)
+    stat = os.stat(trk_path)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_path,
+                        flip=np.asarray(flip, dtype=bool),
+                        splits=splits,
+                        proportion=proportion,
+                        trk_size=stat.st_size,
+                        trk_mtime_ns=stat.st_mtime_ns)
+    os.replace(tmp_path, path)
+
+
+def load_segment_index(path):
+    """
+    Reads a segment index.
+    Returns:
+        Dictionary with "flip", "splits" ((n_streamlines x 2) core and end2 start indices), "proportion",
+        "trk_size" and "trk_mtime_ns"
+    """
+    with np.load(path) as npz:
+        return {key: npz[key] if npz[key].ndim > 0 else npz[key].item() for key in npz.files}
+
+
+def is_index_current(index, trk_path):
+    """
+    Whether the bundle .trk file is still the one the index was built from.
+    """
+    stat = os.stat(trk_path)
+    return index["trk_size"] == stat.st_size and index["trk_mtime_ns"] == stat.st_mtime_ns
+
+
+def get_segments(streamlines, index):
+    """
+    Orients a bundle and splits it into its segments without copying any segment.
+    Args:
+        streamlines: streamlines of the bundle .trk file the index was built from
+        index: segment index (see load_segment_index)
+    Returns:
+        Oriented streamlines and a dictionary mapping 'end1', 'core' and 'end2' to ArraySequence views on their
+        buffer (an in-place transform of one view, e.g. StatefulTractogram.to_vox(), moves every point of the
+        buffer, so copy a segment before transforming it)
+    """
+    if len(streamlines) != len(index["flip"]):
+        raise ValueError(f"The bundle has {len(streamlines)} streamlines but its segment index has {len(index['flip'])}")
+    oriented = flip_streamlines(streamlines, index["flip"])
+    offsets = np.asarray(oriented._offsets, dtype=np.intp)
+    lengths = np.asarray(oriented._lengths, dtype=np.intp)
+    core_starts, end2_starts = index["splits"][:, 0].astype(np.intp), index["splits"][:, 1].astype(np.intp)
+
+    ranges = {
+        "end1": (offsets, core_starts),
+        "core": (offsets + core_starts, np.maximum(0, end2_starts - core_starts)),
+        "end2": (offsets + end2_starts, lengths - end2_starts),
+    }
+    return oriented, {label: make_array_sequence(oriented._data, *ranges[label]) for label in SEGMENT_LABELS}
+
+
+def load_segments(index_path, trk_path):
+    """
+    Loads a bundle and materializes its segments from its segment index.
+    Args:
+        index_path: segment index .npz (see save_segment_index)
+        trk_path: bundle .trk file the index was built from
+    Returns:
+        The bundle's StatefulTractogram, its oriented streamlines and the dictionary of segment views (see get_segments)
+    """
+    from dipy.io.streamline import load_trk
+
+    index = load_segment_index(index_path)
+    if not is_index_current(index, trk_path):
+        raise ValueError(f"{trk_path} has changed since {index_path} was written; rerun pyafq.py")
+    trk = load_trk(trk_path, reference="same", bbox_valid_check=False)
+    oriented, segments = get_segments(trk.streamlines, index)
+    return trk, oriented, segments
+
+
+def save_segment_trks(segments, out_paths, reference, space):
+    """
+    Exports segments as .trk files.
+    Args:
+        segments: dictionary mapping segment label -> streamlines (see get_segments)
+        out_paths: dictionary mapping segment label -> output .trk path
+        reference: reference image of the output tractograms
+        space: dipy Space of the streamlines
+    """
+    from dipy.io.stateful_tractogram import StatefulTractogram
+    from dipy.io.streamline import save_tractogram
+
+    for segment_label, out_path in out_paths.items():
+        # Saving may transform the points in place, which would move the other segments sharing the buffer
+        segment_tractogram = StatefulTractogram(segments[segment_label].copy(), reference=reference, space=space)
+        save_tractogram(segment_tractogram, out_path, bbox_valid_check=False)
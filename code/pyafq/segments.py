@@ -0,0 +1,84 @@
+'''
+Vectorized splitting of streamlines into end1/core/end2 segments, working directly on the ArraySequence
+_data/_offsets/_lengths buffers instead of slicing each streamline in Python
+'''
+
+# Third-party imports
+import numpy as np
+from nibabel.streamlines import ArraySequence
+
+SEGMENT_LABELS = ("end1", "core", "end2")
+
+
+def get_end_lengths(lengths, proportion=1/3):
+    """
+    Number of points in each end segment, max(1, round(proportion * n_points)) per streamline.
+    Args:
+        lengths: number of points of each streamline
+        proportion: float in (0,1], proportion of points in each end segment
+    Returns:
+        Array of end segment lengths
+    """
+    return np.maximum(1, np.round(proportion * np.asarray(lengths))).astype(np.intp)
+
+
+def get_segment_ranges(offsets, lengths, end_lengths):
+    """
+    Start offsets and lengths of the end1/core/end2 segments of every streamline in a shared point buffer.
+    Returns:
+        Dictionary mapping segment label -> (starts, counts)
+    """
+    core_lengths = np.maximum(0, lengths - 2 * end_lengths)
+    return {
+        "end1": (offsets, end_lengths),
+        "core": (offsets + end_lengths, core_lengths),
+        "end2": (offsets + lengths - end_lengths, end_lengths),
+    }
+
+
+def ranges_to_indices(starts, counts):
+    """
+    Flat indices of the concatenated ranges [start, start + count), built without a Python loop.
+    """
+    counts = np.asarray(counts, dtype=np.intp)
+    new_offsets = np.cumsum(counts) - counts
+    return np.repeat(np.asarray(starts, dtype=np.intp) - new_offsets, counts) + np.arange(counts.sum())
+
+
+def make_array_sequence(data, offsets, lengths):
+    """
+    Wraps existing buffers in an ArraySequence without copying them.
+    """
+    sequence = ArraySequence()
+    sequence._data = data
+    sequence._offsets = np.asarray(offsets, dtype=np.intp)
+    sequence._lengths = np.asarray(lengths, dtype=np.intp)
+    return sequence
+
+
+def split_streamlines(streamlines, proportion=1/3, copy=True):
+    """
+    Splits every streamline into its first, middle and last portions: end1 = sl[:n], core = sl[n:-n] and
+    end2 = sl[-n:] with n = max(1, round(proportion * len(sl))).
+    Args:
+        streamlines: ArraySequence / Streamlines
+        proportion: float in (0,1], proportion of points in each end segment
+        copy: if True, each segment sequence gets its own compact buffer, gathered in one bulk copy.
+              If False, the segments are views on the input buffer; in-place transforms of one of them
+              (e.g. StatefulTractogram.to_vox()) then also move the points of the input streamlines.
+    Returns:
+        (end1, core, end2) ArraySequences
+    """
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+    lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+    ranges = get_segment_ranges(offsets, lengths, get_end_lengths(lengths, proportion))
+
+    segments = []
+    for segment_label in SEGMENT_LABELS:
+        starts, counts = ranges[segment_label]
+        if copy:
+            data = streamlines._data[ranges_to_indices(starts, counts)]
+            segments.append(make_array_sequence(data, np.cumsum(counts) - counts, counts))
+        else:
+            segments.append(make_array_sequence(streamlines._data, starts, counts))
+    return tuple(segments)